@@ -0,0 +1,14 @@
+from django.db.backends.mysql import base
+
+from app.dbpool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """django's MySQL backend with pooled connections, ENGINE 'app.backends.mysql'"""
+
+    def ping_connection(self, connection):
+        try:
+            connection.ping()
+            return True
+        except self.Database.Error:
+            return False
@@ -0,0 +1,7 @@
+from django.db.backends.sqlite3 import base
+
+from app.dbpool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """django's SQLite backend with pooled connections, ENGINE 'app.backends.sqlite3', for local runs and tests"""
@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import uuid
+import weakref
+
+import httpx
+import requests
+import urllib3
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('default')
+
+DEFAULT_BANK_API = {
+    'URL': 'http://www.mocky.io/v2/5acadd1b2e00005600bbaa36?mocky-delay=3000ms',
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    'POOL_SIZE': 10,
+    'ASYNC_POOL_SIZE': 100,
+    # retries of a call that failed before it reached the bank, e.g. the connection was refused
+    'MAX_RETRIES': 2,
+    'BACKOFF_FACTOR': 0.1,
+    'BACKOFF_MAX': 2,
+    # the bank deduplicates deductions on the Idempotency-Key header sent with every call: read timeouts
+    # and RETRY_STATUS responses, after which the bank may have deducted, are retried too
+    'IDEMPOTENT': False,
+    'RETRY_STATUS': (502, 503, 504),
+    'CIRCUIT_FAILURE_THRESHOLD': 5,
+    'CIRCUIT_RESET_TIMEOUT': 30,
+}
+
+
+def bank_api_settings():
+    config = dict(DEFAULT_BANK_API)
+    config.update(getattr(settings, 'BANK_API', {}))
+    return config
+
+
+class CircuitBreaker:
+    """
+    closed: calls go through, consecutive failures are counted
+    open: calls fail fast until `reset_timeout` seconds have passed
+    half-open: a single trial call decides whether to close or re-open the circuit
+    """
+    class CircuitOpenError(Exception):
+        """circuit is open, call rejected"""
+
+    Closed, Open, HalfOpen = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.Closed
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == CircuitBreaker.Closed:
+                return
+            if self.state == CircuitBreaker.Open and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = CircuitBreaker.HalfOpen
+                return
+            raise CircuitBreaker.CircuitOpenError(f"[CircuitOpenError] Bank circuit is {self.state}")
+
+    def record_success(self):
+        with self._lock:
+            self.state = CircuitBreaker.Closed
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HalfOpen or self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.Open:
+                    logger.error('Bank circuit opened after %s failures', self.failures)
+                self.state = CircuitBreaker.Open
+                self.opened_at = time.monotonic()
+
+
+class BankApiClient:
+    """
+    Process-wide bank api client: one pooled keep-alive session, connect/read timeouts,
+    bounded retries with jittered exponential backoff and a circuit breaker. A deduction is not
+    idempotent, so only calls that cannot have reached the bank are retried, unless the bank
+    deduplicates them on their Idempotency-Key.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, url, connect_timeout, read_timeout, pool_size, max_retries,
+                 backoff_factor, backoff_max, retry_status, circuit_breaker, idempotent=False):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.retry_status = set(retry_status) if idempotent else set()
+        self.idempotent = idempotent
+        self.circuit_breaker = circuit_breaker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_settings(cls):
+        config = bank_api_settings()
+        return cls(url=config['URL'],
+                   connect_timeout=config['CONNECT_TIMEOUT'],
+                   read_timeout=config['READ_TIMEOUT'],
+                   pool_size=config['POOL_SIZE'],
+                   max_retries=config['MAX_RETRIES'],
+                   backoff_factor=config['BACKOFF_FACTOR'],
+                   backoff_max=config['BACKOFF_MAX'],
+                   retry_status=config['RETRY_STATUS'],
+                   circuit_breaker=CircuitBreaker(config['CIRCUIT_FAILURE_THRESHOLD'],
+                                                  config['CIRCUIT_RESET_TIMEOUT']),
+                   idempotent=config['IDEMPOTENT'])
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls.from_settings()
+        return cls._instance
+
+    @classmethod
+    def reset(cls):
+        with cls._instance_lock:
+            if cls._instance is not None:
+                cls._instance.session.close()
+            cls._instance = None
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** attempt)))
+
+    @staticmethod
+    def unsent(e):
+        """whether a call failed before its request was sent, so the bank cannot have processed it"""
+        if isinstance(e, requests.exceptions.ConnectTimeout):
+            return True
+        # a connection dropped while the request was sent or answered is a ProtocolError instead
+        reason = getattr(e.args[0], 'reason', None) if isinstance(e, requests.exceptions.ConnectionError) else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def get(self):
+        """
+        Return the decoded json body of the bank api. Calls that never reached the bank are retried,
+        with `idempotent` also timeouts, dropped connections and `retry_status` responses; all attempts
+        of a call send the same Idempotency-Key. The circuit breaker counts one failure per call.
+        """
+        self.circuit_breaker.before_call()
+        headers = {'Idempotency-Key': uuid.uuid4().hex}
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(self.url, headers=headers, timeout=self.timeout)
+                if response.status_code in self.retry_status and attempt < self.max_retries:
+                    response.close()
+                    raise requests.exceptions.RetryError(f"bank returned {response.status_code}")
+                response.raise_for_status()
+                response_dic = response.json()
+            except requests.exceptions.RequestException as e:
+                retryable = self.unsent(e) or self.idempotent and isinstance(
+                    e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                        requests.exceptions.RetryError))
+                if retryable and attempt < self.max_retries:
+                    delay = self.backoff(attempt)
+                    logger.warning('Bank API attempt %s failed: <%s>, retry in %.3fs', attempt + 1, e, delay)
+                    attempt += 1
+                    time.sleep(delay)
+                    continue
+                self.circuit_breaker.record_failure()
+                raise
+            except ValueError:
+                self.circuit_breaker.record_failure()
+                raise
+            self.circuit_breaker.record_success()
+            return response_dic
+
+
+class AsyncBankApiClient:
+    """
+    Non-blocking bank api client for async views. httpx clients are bound to the event loop
+    they were created on, so there is one pooled client per running loop; the circuit breaker
+    is shared with the process-wide `BankApiClient`.
+    """
+    _instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, url, connect_timeout, read_timeout, pool_size, max_retries,
+                 backoff_factor, backoff_max, retry_status, circuit_breaker, idempotent=False):
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.retry_status = set(retry_status) if idempotent else set()
+        self.idempotent = idempotent
+        self.circuit_breaker = circuit_breaker
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+
+    @classmethod
+    def instance(cls):
+        loop = asyncio.get_event_loop()
+        client = cls._instances.get(loop)
+        if client is None:
+            config = bank_api_settings()
+            client = cls(url=config['URL'],
+                         connect_timeout=config['CONNECT_TIMEOUT'],
+                         read_timeout=config['READ_TIMEOUT'],
+                         pool_size=config['ASYNC_POOL_SIZE'],
+                         max_retries=config['MAX_RETRIES'],
+                         backoff_factor=config['BACKOFF_FACTOR'],
+                         backoff_max=config['BACKOFF_MAX'],
+                         retry_status=config['RETRY_STATUS'],
+                         circuit_breaker=BankApiClient.instance().circuit_breaker,
+                         idempotent=config['IDEMPOTENT'])
+            cls._instances[loop] = client
+        return client
+
+    @classmethod
+    def reset(cls):
+        instances, cls._instances = cls._instances, weakref.WeakKeyDictionary()
+        for loop, client in list(instances.items()):
+            client.close(loop)
+
+    def close(self, loop):
+        """close the pooled connections on the loop they are bound to"""
+        if loop.is_closed():
+            return
+        if not loop.is_running():
+            loop.run_until_complete(self.client.aclose())
+            return
+        try:
+            current = asyncio.get_event_loop()
+        except RuntimeError:
+            current = None
+        if current is loop:
+            loop.create_task(self.client.aclose())
+        else:
+            asyncio.run_coroutine_threadsafe(self.client.aclose(), loop)
+
+    backoff = BankApiClient.backoff
+
+    async def get(self):
+        """async counterpart of `BankApiClient.get`"""
+        self.circuit_breaker.before_call()
+        headers = {'Idempotency-Key': uuid.uuid4().hex}
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.get(self.url, headers=headers)
+                if response.status_code in self.retry_status and attempt < self.max_retries:
+                    raise httpx.HTTPStatusError(f"bank returned {response.status_code}",
+                                                request=response.request, response=response)
+                response.raise_for_status()
+                response_dic = response.json()
+            except httpx.HTTPError as e:
+                # no connection was made, or none was free in the pool
+                unsent = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+                retryable = unsent or self.idempotent and (isinstance(e, httpx.TransportError) or (
+                    isinstance(e, httpx.HTTPStatusError) and e.response.status_code in self.retry_status))
+                if retryable and attempt < self.max_retries:
+                    delay = self.backoff(attempt)
+                    logger.warning('Bank API attempt %s failed: <%s>, retry in %.3fs', attempt + 1, e, delay)
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                self.circuit_breaker.record_failure()
+                raise
+            except ValueError:
+                self.circuit_breaker.record_failure()
+                raise
+            self.circuit_breaker.record_success()
+            return response_dic
+
+
+@receiver(setting_changed)
+def reset_bank_api_client(sender, setting, **kwargs):
+    if setting == 'BANK_API':
+        BankApiClient.reset()
+        AsyncBankApiClient.reset()
@@ -0,0 +1,225 @@
+import json
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+OPERATIONS = ('create', 'deposit', 'transfer', 'statements')
+
+
+def percentiles(values, points=(50, 95, 99)):
+    """nearest-rank percentiles of `values` plus the max, in milliseconds rounded to 0.01"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    result = {f'p{point}': round(ordered[max(0, -(-point * len(ordered) // 100) - 1)] * 1000, 2) for point in points}
+    result['max'] = round(ordered[-1] * 1000, 2)
+    return result
+
+
+def parse_mix(text):
+    """'deposit=4,transfer=4,statements=1' -> {'deposit': 4, 'transfer': 4, 'statements': 1}"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f'unknown operation {name!r}, expected one of {", ".join(OPERATIONS)}')
+        mix[name] = int(weight or 1)
+        if mix[name] < 0:
+            raise ValueError(f'weight of {name} must not be negative')
+    if not any(mix.values()):
+        raise ValueError('mix has no operation with a positive weight')
+    return mix
+
+
+class InProcessClient:
+    """drive the wallet apis through the django test client, counting the SQL queries of every request"""
+    target = 'in-process'
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = Client()
+        return self._local.client
+
+    def request(self, method, path, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            if method == 'POST':
+                response = self.client().post(path, data=json.dumps(data), content_type='application/json')
+            else:
+                response = self.client().get(path, data)
+        return response.status_code, response.content, len(queries)
+
+    def close(self):
+        connection.close()
+
+
+class HttpClient:
+    """drive the wallet apis of a running server, e.g. gunicorn with sync or gevent workers"""
+    def __init__(self, url, pool_size):
+        self.target = url.rstrip('/')
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, data=None):
+        if method == 'POST':
+            response = self.session.post(self.target + path, json=data, timeout=60)
+        else:
+            response = self.session.get(self.target + path, params=data, timeout=60)
+        return response.status_code, response.content, None
+
+    def close(self):
+        pass
+
+
+class Benchmark:
+    """
+    Run a weighted mix of create wallet, deposit, transfer and statement query requests from
+    `concurrency` threads against a set of pre-funded wallets and report latency percentiles,
+    throughput, SQL queries per request and error and lock retry rates.
+    """
+    def __init__(self, client, mix, concurrency=10, requests=1000, wallets=20, seed=None):
+        self.client = client
+        self.mix = mix
+        self.concurrency = concurrency
+        self.requests = requests
+        self.wallets = wallets
+        self.random = random.Random(seed)
+        self.wallet_ids = []
+        self.created_ids = []
+        self._lock = threading.Lock()
+        self._issued = 0
+        self.samples = {name: [] for name in OPERATIONS}
+        self.errors = {name: 0 for name in OPERATIONS}
+        self.queries = {name: [] for name in OPERATIONS}
+
+    def setup(self):
+        """create and fund the wallets the measured requests work on"""
+        for i in range(self.wallets):
+            wallet_id = self.create_wallet(f'benchmark-{i}')
+            self.wallet_ids.append(wallet_id)
+            self.call('POST', reverse('deposit'), {'wallet_id': wallet_id, 'amount': 1000000})
+        self.client.close()
+
+    def create_wallet(self, name):
+        status, content, _ = self.call('POST', reverse('create_wallet'), {'name': name})
+        wallet_id = json.loads(content)['ResultObject']['wallet_id']
+        with self._lock:
+            self.created_ids.append(wallet_id)
+        return wallet_id
+
+    def call(self, method, path, data=None):
+        status, content, queries = self.client.request(method, path, data)
+        if status != 200:
+            raise RuntimeError(f'{method} {path} returned {status}: {content[:200]!r}')
+        return status, content, queries
+
+    def next_operation(self):
+        with self._lock:
+            if self._issued >= self.requests:
+                return None
+            self._issued += 1
+            name = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            from_id, to_id = self.random.sample(self.wallet_ids, 2)
+            return name, from_id, to_id
+
+    def request_for(self, name, from_id, to_id):
+        if name == 'create':
+            return 'POST', reverse('create_wallet'), {'name': f'benchmark-{from_id}-{to_id}'}
+        if name == 'deposit':
+            return 'POST', reverse('deposit'), {'wallet_id': to_id, 'amount': 1}
+        if name == 'transfer':
+            return 'POST', reverse('transfer'), {'from_wallet_id': from_id, 'to_wallet_id': to_id, 'amount': 1}
+        return 'GET', reverse('statements', args=[from_id]), {'limit': 20}
+
+    def worker(self):
+        try:
+            while True:
+                operation = self.next_operation()
+                if operation is None:
+                    return
+                name = operation[0]
+                method, path, data = self.request_for(*operation)
+                start = time.perf_counter()
+                try:
+                    status, content, queries = self.client.request(method, path, data)
+                    body = json.loads(content)
+                    failed = status != 200 or body.get('Result') != 1
+                    if name == 'create' and not failed:
+                        with self._lock:
+                            self.created_ids.append(body['ResultObject']['wallet_id'])
+                except (requests.exceptions.RequestException, ValueError):
+                    failed, queries = True, None
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.samples[name].append(elapsed)
+                    self.errors[name] += failed
+                    if queries is not None:
+                        self.queries[name].append(queries)
+        finally:
+            self.client.close()
+
+    def lock_retries(self):
+        """current (retries, exhausted) of the DeadlockRetry counters, scraped from the metrics endpoint"""
+        status, content, _ = self.client.request('GET', reverse('metrics'))
+        text = content.decode('utf-8')
+        values = []
+        for name in ('wallet_lock_retries_total', 'wallet_lock_retries_exhausted_total'):
+            values.append(sum(float(value) for value in re.findall(rf'^{name}(?:{{[^}}]*}})? (\S+)$', text, re.M)))
+        return values
+
+    def run(self):
+        if len(self.wallet_ids) < 2:
+            self.setup()
+        retries_before, exhausted_before = self.lock_retries()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for future in [executor.submit(self.worker) for _ in range(self.concurrency)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+        retries_after, exhausted_after = self.lock_retries()
+        self.client.close()
+        return self.report(elapsed, retries_after - retries_before, exhausted_after - exhausted_before)
+
+    def report(self, elapsed, lock_retries, lock_retries_exhausted):
+        all_samples = [sample for samples in self.samples.values() for sample in samples]
+        errors = sum(self.errors.values())
+        operations = {}
+        for name in OPERATIONS:
+            count = len(self.samples[name])
+            if not count:
+                continue
+            queries = self.queries[name]
+            operations[name] = dict(
+                requests=count,
+                errors=self.errors[name],
+                error_rate=round(self.errors[name] / count, 4),
+                latency_ms=percentiles(self.samples[name]),
+                queries_per_request=round(sum(queries) / len(queries), 2) if queries else None,
+            )
+        return dict(
+            target=self.client.target,
+            concurrency=self.concurrency,
+            requests=len(all_samples),
+            seconds=round(elapsed, 3),
+            requests_per_second=round(len(all_samples) / elapsed, 1) if elapsed else None,
+            latency_ms=percentiles(all_samples),
+            errors=errors,
+            error_rate=round(errors / len(all_samples), 4) if all_samples else 0,
+            lock_retries=int(lock_retries),
+            lock_retry_rate=round(lock_retries / len(all_samples), 4) if all_samples else 0,
+            lock_retries_exhausted=int(lock_retries_exhausted),
+            operations=operations,
+        )
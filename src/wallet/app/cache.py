@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Sum
+from django.dispatch import receiver
+
+from . import metrics
+from .models import Account, BalanceShard
+
+DEFAULT_BALANCE_CACHE = {
+    'MAX_SIZE': 100000,
+    # staleness bound in seconds: a cached balance is never served longer than this after it was read or written
+    'TTL': 5,
+    # alias of a django cache (e.g. redis or memcached) shared by all processes, None to only cache locally
+    'SHARED_BACKEND': None,
+}
+
+
+def balance_cache_settings():
+    config = dict(DEFAULT_BALANCE_CACHE)
+    config.update(getattr(settings, 'WALLET_BALANCE_CACHE', {}))
+    return config
+
+
+class LRUCache:
+    """thread-safe in-process LRU with a per-entry time to live"""
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class BalanceCache:
+    """
+    Read-through wallet balance cache: an in-process LRU in front of an optional shared django cache,
+    in front of the database. Deposits and transfers write the new balance through once they commit.
+    """
+    _local = None
+    _lock = threading.Lock()
+
+    hits = metrics.counter('wallet_balance_cache_hits_total', 'Balance reads served from the cache', ['layer'])
+    misses = metrics.counter('wallet_balance_cache_misses_total', 'Balance reads that went to the database')
+
+    @classmethod
+    def local(cls):
+        if cls._local is None:
+            with cls._lock:
+                if cls._local is None:
+                    config = balance_cache_settings()
+                    cls._local = LRUCache(config['MAX_SIZE'], config['TTL'])
+        return cls._local
+
+    @classmethod
+    def shared(cls):
+        alias = balance_cache_settings()['SHARED_BACKEND']
+        return caches[alias] if alias else None
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._local = None
+
+    @staticmethod
+    def key(wallet_id):
+        return f'wallet:balance:{wallet_id}'
+
+    @classmethod
+    def get_balance(cls, wallet_id):
+        balance = cls.local().get(wallet_id)
+        if balance is not None:
+            cls.hits.inc(layer='local')
+            return balance
+
+        shared = cls.shared()
+        if shared is not None:
+            balance = shared.get(cls.key(wallet_id))
+            if balance is not None:
+                cls.hits.inc(layer='shared')
+                cls.local().set(wallet_id, balance)
+                return balance
+
+        cls.misses.inc()
+        balance = cls.read_balance(wallet_id)
+        cls.set(wallet_id, balance)
+        return balance
+
+    @classmethod
+    def read_balance(cls, wallet_id):
+        """
+        current balance from the database, the aggregate of all sub-balances for a sharded wallet. The
+        wallet row and its shards are read by one statement, so a concurrent fold of the shards into the
+        row is seen either entirely or not at all.
+        """
+        shard_total = (BalanceShard.objects.filter(account_id=OuterRef('id')).order_by().values('account_id')
+                       .annotate(total=Sum('balance')).values('total'))
+        row = (Account.objects.filter(id=wallet_id).annotate(shard_total=Subquery(shard_total))
+               .values_list('balance', 'shard_total').first())
+        if row is None:
+            raise Account.DoesNotExist(f"[AccountNotExist] Wallet {wallet_id} does not exist.")
+        balance, shard_total = row
+        return balance + (shard_total or 0)
+
+    @classmethod
+    def set(cls, wallet_id, balance):
+        cls.local().set(wallet_id, balance)
+        shared = cls.shared()
+        if shared is not None:
+            shared.set(cls.key(wallet_id), balance, timeout=balance_cache_settings()['TTL'])
+
+    @classmethod
+    def invalidate(cls, wallet_id):
+        cls.local().delete(wallet_id)
+        shared = cls.shared()
+        if shared is not None:
+            shared.delete(cls.key(wallet_id))
+
+    @classmethod
+    def set_on_commit(cls, balances):
+        """write {wallet_id: balance} through to the cache once the current transaction commits"""
+        def write_through():
+            for wallet_id, balance in balances.items():
+                cls.set(wallet_id, balance)
+        transaction.on_commit(write_through)
+
+
+@receiver(setting_changed)
+def reset_balance_cache(sender, setting, **kwargs):
+    if setting == 'WALLET_BALANCE_CACHE':
+        BalanceCache.reset()
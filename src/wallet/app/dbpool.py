@@ -0,0 +1,228 @@
+import functools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import OperationalError
+from django.dispatch import receiver
+
+from . import metrics
+
+logger = logging.getLogger('default')
+
+DEFAULT_DB_POOL = {
+    # take connections from the pool; False opens a connection per request and closes it afterwards
+    'ENABLED': True,
+    # max number of open connections per database and process, shared by all its threads and greenlets
+    'MAX_SIZE': 20,
+    # seconds after which a connection is closed instead of being reused, keep it below MySQL's wait_timeout
+    'MAX_LIFETIME': 1800,
+    # seconds a request waits for a free connection before PoolTimeoutError is raised
+    'WAIT_TIMEOUT': 5,
+    # check that an idle connection still works before handing it out
+    'PRE_PING': True,
+}
+
+
+def pool_settings():
+    config = dict(DEFAULT_DB_POOL)
+    config.update(getattr(settings, 'WALLET_DB_POOL', {}))
+    return config
+
+
+connections_opened = metrics.counter('wallet_db_connections_opened_total', 'Database connections opened',
+                                     ['database'])
+pool_connections = metrics.gauge('wallet_db_pool_connections', 'Pooled database connections', ['database', 'state'])
+pool_wait_seconds = metrics.histogram('wallet_db_pool_wait_seconds', 'Time spent waiting for a pooled connection',
+                                      ['database'])
+pool_timeouts = metrics.counter('wallet_db_pool_timeouts_total', 'Requests that gave up waiting for a connection',
+                                ['database'])
+pool_discarded = metrics.counter('wallet_db_pool_discarded_total', 'Pooled connections closed instead of reused',
+                                 ['database', 'reason'])
+
+
+class PooledConnection:
+    __slots__ = ('connection', 'created', 'uses')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.monotonic()
+        self.uses = 0
+
+
+class ConnectionPool:
+    """
+    Bounded pool of DB-API connections of one database. At most `max_size` connections are open;
+    a checkout waits up to `wait_timeout` seconds for one to be released. Idle connections are reused
+    newest first, closed once older than `max_lifetime` and pinged before reuse with `pre_ping`.
+    """
+    class PoolTimeoutError(OperationalError):
+        """等待資料庫連線逾時"""
+
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, alias, connect, ping, max_size, max_lifetime, wait_timeout, pre_ping):
+        self.alias = alias
+        self.connect = connect
+        self.ping = ping
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.wait_timeout = wait_timeout
+        self.pre_ping = pre_ping
+        self.idle = []
+        self.size = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    @classmethod
+    def get(cls, alias, key, connect, ping):
+        """the pool of database `alias` with the connection parameters `key`, created on first use"""
+        pool = cls._pools.get((alias, key))
+        if pool is None:
+            with cls._pools_lock:
+                pool = cls._pools.get((alias, key))
+                if pool is None:
+                    config = pool_settings()
+                    pool = cls._pools[(alias, key)] = ConnectionPool(
+                        alias, connect, ping, config['MAX_SIZE'], config['MAX_LIFETIME'], config['WAIT_TIMEOUT'],
+                        config['PRE_PING'])
+        return pool
+
+    @classmethod
+    def reset(cls):
+        """close the idle connections of all pools and forget them, connections in use are closed on release"""
+        with cls._pools_lock:
+            pools, cls._pools = list(cls._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+    def acquire(self):
+        start = time.monotonic()
+        while True:
+            with self._cond:
+                while not self.idle and self.size >= self.max_size:
+                    remaining = start + self.wait_timeout - time.monotonic()
+                    if remaining <= 0:
+                        pool_timeouts.inc(database=self.alias)
+                        raise ConnectionPool.PoolTimeoutError(
+                            f"[PoolTimeoutError] no free connection to {self.alias} after {self.wait_timeout}s, "
+                            f"all {self.max_size} are in use")
+                    self._cond.wait(remaining)
+                pooled = self.idle.pop() if self.idle else None
+                if pooled is None:
+                    self.size += 1
+                self.update_gauges()
+
+            if pooled is None:
+                try:
+                    pooled = PooledConnection(self.connect())
+                except BaseException:
+                    self.forget()
+                    raise
+                connections_opened.inc(database=self.alias)
+            elif self.expired(pooled):
+                self.discard(pooled, 'lifetime')
+                continue
+            elif self.pre_ping and not self.ping(pooled.connection):
+                self.discard(pooled, 'ping')
+                continue
+            pooled.uses += 1
+            pool_wait_seconds.observe(time.monotonic() - start, database=self.alias)
+            return pooled
+
+    def release(self, pooled, reusable=True):
+        if not reusable:
+            self.discard(pooled, 'error')
+        elif self.expired(pooled):
+            self.discard(pooled, 'lifetime')
+        else:
+            with self._cond:
+                if not self.closed:
+                    self.idle.append(pooled)
+                    self.update_gauges()
+                    self._cond.notify()
+                    return
+            # the pool was reset while the connection was in use
+            self.discard(pooled, 'reset')
+
+    def expired(self, pooled):
+        return time.monotonic() - pooled.created >= self.max_lifetime
+
+    def discard(self, pooled, reason):
+        pool_discarded.inc(database=self.alias, reason=reason)
+        try:
+            pooled.connection.close()
+        except Exception as e:
+            logger.warning('Closing a pooled connection to %s failed: %s', self.alias, e)
+        self.forget()
+
+    def forget(self):
+        """give back the slot of a connection that was closed or never opened"""
+        with self._cond:
+            self.size -= 1
+            self.update_gauges()
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for pooled in idle:
+            self.discard(pooled, 'reset')
+
+    def update_gauges(self):
+        pool_connections.set(len(self.idle), database=self.alias, state='idle')
+        pool_connections.set(self.size - len(self.idle), database=self.alias, state='in_use')
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Mixin of a backend's DatabaseWrapper: django's connect takes a connection from the process-wide
+    pool and close gives it back, so requests (CONN_MAX_AGE = 0) reuse a bounded set of connections
+    instead of opening one each. A connection left in a transaction or after an error is not reused.
+    """
+    pooled = None
+    connection_pool = None
+
+    def get_new_connection(self, conn_params):
+        config = pool_settings()
+        if not config['ENABLED']:
+            connections_opened.inc(database=self.alias)
+            return super().get_new_connection(conn_params)
+        pool = ConnectionPool.get(self.alias, repr(sorted(conn_params.items())),
+                                  functools.partial(super().get_new_connection, conn_params), self.ping_connection)
+        self.pooled = pool.acquire()
+        self.connection_pool = pool
+        return self.pooled.connection
+
+    def init_connection_state(self):
+        # a reused connection keeps the session state set when it was opened
+        if self.pooled is None or self.pooled.uses == 1:
+            super().init_connection_state()
+
+    def ping_connection(self, connection):
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+            return True
+        except self.Database.Error:
+            return False
+
+    def _close(self):
+        if self.pooled is None:
+            return super()._close()
+        pooled, self.pooled = self.pooled, None
+        reusable = self.autocommit and not self.in_atomic_block and not self.errors_occurred
+        self.connection_pool.release(pooled, reusable)
+
+
+@receiver(setting_changed)
+def reset_pools(sender, setting, **kwargs):
+    if setting == 'WALLET_DB_POOL':
+        ConnectionPool.reset()
@@ -26,3 +26,39 @@ class TransferForm(forms.Form):
         if amount <= 0:
             raise forms.ValidationError('invalid amount')
         return amount
+
+
+class StatementQueryForm(forms.Form):
+    limit = forms.IntegerField(min_value=1, required=False, label="筆數")
+    cursor = forms.CharField(max_length=200, required=False, label="分頁游標")
+    type = forms.TypedChoiceField(choices=[(1, 'deposit'), (2, 'transfer')], coerce=int, required=False,
+                                  empty_value=None, label="交易類型")
+    min_amount = forms.DecimalField(max_digits=18, decimal_places=2, required=False, label="最小金額")
+    max_amount = forms.DecimalField(max_digits=18, decimal_places=2, required=False, label="最大金額")
+    since = forms.DateTimeField(required=False, label="起始時間")
+    until = forms.DateTimeField(required=False, label="結束時間")
+
+
+class StatementExportForm(forms.Form):
+    format = forms.ChoiceField(choices=[('csv', 'csv'), ('ndjson', 'ndjson')], required=False, label="匯出格式")
+    since = forms.DateTimeField(required=False, label="起始時間")
+    until = forms.DateTimeField(required=False, label="結束時間")
+
+
+class DailyReportForm(forms.Form):
+    since = forms.DateField(required=False, label="起始日期")
+    until = forms.DateField(required=False, label="結束日期")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        since, until = cleaned_data.get('since'), cleaned_data.get('until')
+        if since and until and since > until:
+            raise forms.ValidationError('since must not be after until')
+        return cleaned_data
+
+
+class AccountSearchForm(forms.Form):
+    q = forms.CharField(max_length=200, required=False, strip=True, label="帳戶名稱或編號開頭")
+    field = forms.ChoiceField(choices=[('name', 'name'), ('id', 'id')], required=False, label="搜尋欄位")
+    limit = forms.IntegerField(min_value=1, required=False, label="筆數")
+    cursor = forms.CharField(max_length=500, required=False, label="分頁游標")
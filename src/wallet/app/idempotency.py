@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from datetime import timedelta
+from enum import IntEnum
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import LRUCache
+from .models import IdempotencyKey
+
+logger = logging.getLogger('default')
+
+DEFAULT_IDEMPOTENCY = {
+    # seconds a key (and its stored response) is kept
+    'TTL': 24 * 60 * 60,
+    # seconds a duplicate request waits for the first request with the same key to finish
+    'WAIT': 15,
+    # seconds a key stays reserved for a request that has not finished; a retry after that takes the key
+    # over, e.g. from a worker that was killed, so keep it above the longest request (bank retries included)
+    'LEASE': 60,
+    # completed responses kept in the in-process front cache
+    'CACHE_SIZE': 10000,
+    # seconds between background purges of expired keys, None to only purge with `manage.py purge_idempotency_keys`
+    'PURGE_INTERVAL': 300,
+}
+
+
+def idempotency_settings():
+    config = dict(DEFAULT_IDEMPOTENCY)
+    config.update(getattr(settings, 'WALLET_IDEMPOTENCY', {}))
+    return config
+
+
+class KeyStatus(IntEnum):
+    InProgress = 1
+    Completed = 2
+
+
+class IdempotencyService:
+    """
+    Idempotency-Key store: an indexed key table, fronted by an in-process LRU of completed responses.
+    The first request claims the key by inserting its row, duplicates replay the stored response
+    or wait for the first request to finish.
+    """
+    class KeyReusedError(Exception):
+        """Idempotency-Key 已用於不同的請求"""
+    class InProgressError(Exception):
+        """相同 Idempotency-Key 的請求仍在處理中"""
+
+    _local = None
+    _purger = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def local(cls):
+        if cls._local is None:
+            with cls._lock:
+                if cls._local is None:
+                    config = idempotency_settings()
+                    cls._local = LRUCache(config['CACHE_SIZE'], config['TTL'])
+        return cls._local
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._local = None
+
+    @staticmethod
+    def fingerprint(request):
+        digest = hashlib.sha256(request.method.encode('utf-8') + b' ' + request.path.encode('utf-8') + b'\n')
+        digest.update(request.body)
+        return digest.hexdigest()
+
+    @classmethod
+    def begin(cls, scope, key, fingerprint):
+        """
+        Return (None, (status_code, content)) stored by a finished request with the same key, or
+        (claim id, None) once this request has claimed the key and should run; the claim id is passed to
+        `complete` or `release`. A duplicate of a request in progress polls for up to WAIT seconds.
+        """
+        waits = cls.waits()
+        while True:
+            try:
+                return cls.claim(scope, key, fingerprint)
+            except IdempotencyService.InProgressError:
+                delay = next(waits, None)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    @classmethod
+    async def abegin(cls, scope, key, fingerprint, run):
+        """`begin` of async views: the attempts are made with `run`, e.g. OrmExecutor.run, the waits on the loop"""
+        waits = cls.waits()
+        while True:
+            try:
+                return await run(cls.claim, scope, key, fingerprint)
+            except IdempotencyService.InProgressError:
+                delay = next(waits, None)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def waits():
+        """delays between the attempts of a duplicate request, WAIT seconds in total"""
+        deadline = time.monotonic() + idempotency_settings()['WAIT']
+        delay = 0.05
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            yield min(delay, remaining)
+            delay = min(delay * 2, 0.5)
+
+    @classmethod
+    def claim(cls, scope, key, fingerprint):
+        """one attempt of `begin`, InProgressError while another request holds the key"""
+        cls.start_purger()
+        stored = cls.local().get((scope, key))
+        if stored is not None:
+            return None, cls._check(stored[0], fingerprint, stored[1:])
+
+        config = idempotency_settings()
+        while True:
+            now = timezone.now()
+            record = IdempotencyKey.objects.filter(scope=scope, key=key)[:1]
+            record = record[0] if record else None
+            if record is None:
+                try:
+                    with transaction.atomic():
+                        # reserved for the lease only, `complete` keeps it for the TTL
+                        record = IdempotencyKey.objects.create(scope=scope, key=key, fingerprint=fingerprint,
+                                                               status=KeyStatus.InProgress,
+                                                               expire_time=now + timedelta(seconds=config['LEASE']))
+                    return record.id, None
+                except IntegrityError:
+                    # another request claimed the key first
+                    continue
+            if record.expire_time <= now:
+                if record.status == KeyStatus.InProgress:
+                    logger.warning('Idempotency key %s of %s was not finished within its lease, taken over',
+                                   key, scope)
+                IdempotencyKey.objects.filter(id=record.id, expire_time__lte=now).delete()
+                continue
+            if record.status == KeyStatus.Completed:
+                stored = (record.status_code, record.response)
+                cls.local().set((scope, key), (record.fingerprint,) + stored)
+                return None, cls._check(record.fingerprint, fingerprint, stored)
+            if record.fingerprint != fingerprint:
+                raise IdempotencyService.KeyReusedError(f"[KeyReusedError] {scope} key {key}")
+            raise IdempotencyService.InProgressError(f"[InProgressError] {scope} key {key}")
+
+    @staticmethod
+    def _check(stored_fingerprint, fingerprint, stored):
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyService.KeyReusedError("[KeyReusedError] key was used with a different request")
+        return stored
+
+    @classmethod
+    def complete(cls, scope, key, claim, fingerprint, status_code, content):
+        """
+        Store the response of the request holding `claim`. False if its lease expired and another request
+        took the key over: that request's row is left alone and the response is not stored.
+        """
+        expire_time = timezone.now() + timedelta(seconds=idempotency_settings()['TTL'])
+        if not IdempotencyKey.objects.filter(id=claim, status=KeyStatus.InProgress).update(
+                status=KeyStatus.Completed, status_code=status_code, response=content, expire_time=expire_time):
+            logger.error('Idempotency key %s of %s was taken over before its request finished, response not stored',
+                         key, scope)
+            return False
+        cls.local().set((scope, key), (fingerprint, status_code, content))
+        return True
+
+    @classmethod
+    def release(cls, claim):
+        """forget a claimed key whose request failed unexpectedly, so the client can retry with it"""
+        return IdempotencyKey.objects.filter(id=claim, status=KeyStatus.InProgress).delete()[0] > 0
+
+    @classmethod
+    def purge_expired(cls, batch_size=1000):
+        purged = 0
+        while True:
+            ids = list(IdempotencyKey.objects.filter(expire_time__lte=timezone.now())
+                       .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return purged
+            purged += IdempotencyKey.objects.filter(id__in=ids).delete()[0]
+
+    @classmethod
+    def start_purger(cls):
+        interval = idempotency_settings()['PURGE_INTERVAL']
+        if not interval or cls._purger is not None:
+            return
+        with cls._lock:
+            if cls._purger is None:
+                cls._purger = threading.Thread(target=cls._purge_forever, args=(interval,),
+                                               name='idempotency-purger', daemon=True)
+                cls._purger.start()
+
+    @classmethod
+    def _purge_forever(cls, interval):
+        from django.db import connection
+        while True:
+            time.sleep(interval)
+            try:
+                purged = cls.purge_expired()
+                if purged:
+                    logger.info('Purged %s expired idempotency keys', purged)
+            except Exception as e:
+                logger.error("Error: <%s>", e)
+            finally:
+                connection.close()
+
+
+@receiver(setting_changed)
+def reset_idempotency_cache(sender, setting, **kwargs):
+    if setting == 'WALLET_IDEMPOTENCY':
+        IdempotencyService.reset()
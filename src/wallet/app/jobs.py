@@ -0,0 +1,221 @@
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+
+from . import log, metrics
+from .models import Account, Deposit, DepositJob
+from .services import CallBankApiService, DeadlockRetry, DepositStatus, JobStatus, WalletService
+
+logger = logging.getLogger('default')
+
+DEFAULT_DEPOSIT_JOBS = {
+    # answer every deposit with 202 and a deposit id and leave the bank call to `deposit_worker`;
+    # with False only requests sending `Prefer: respond-async` are accepted this way
+    'ACCEPT': False,
+    # threads per worker process, each calls the bank for one deposit at a time
+    'CONCURRENCY': 8,
+    # worker processes started by one `deposit_worker`
+    'PROCESSES': 1,
+    # seconds a worker sleeps when the queue is empty
+    'POLL_INTERVAL': 0.5,
+    # seconds a claimed job is reserved for its worker; a job still running after that is taken over,
+    # so keep it well above the bank timeout and retries
+    'LEASE': 60,
+}
+
+
+def deposit_job_settings():
+    config = dict(DEFAULT_DEPOSIT_JOBS)
+    config.update(getattr(settings, 'WALLET_DEPOSIT_JOBS', {}))
+    return config
+
+
+queued_jobs = metrics.gauge('wallet_deposit_jobs', 'Deposit jobs waiting for or claimed by a worker', ['state'])
+oldest_job_age = metrics.gauge('wallet_deposit_job_oldest_age_seconds', 'Age of the oldest queued deposit job')
+job_wait_seconds = metrics.histogram('wallet_deposit_job_wait_seconds',
+                                     'Time from accepting a deposit to a worker starting it')
+finished_jobs = metrics.counter('wallet_deposit_jobs_finished_total', 'Deposit jobs finished', ['result'])
+
+
+class DepositJobService:
+    """
+    Accepted deposits: the api records the deposit intent and a job in one transaction and answers
+    right away; `deposit_worker` processes claim the oldest jobs, call the bank concurrently and settle
+    the deposits like a synchronous deposit would, and clients poll the deposit status.
+    """
+    @classmethod
+    def accepts(cls, request):
+        """whether a deposit request is answered with 202 instead of waiting for the bank"""
+        return deposit_job_settings()['ACCEPT'] or 'respond-async' in request.headers.get('Prefer', '')
+
+    @classmethod
+    def enqueue(cls, wallet_id, amount):
+        log.bind(wallet_ids=[wallet_id])
+        try:
+            if amount <= 0:
+                raise WalletService.MoneyValueError("[MoneyInvalidError] Deposit money error.")
+            with transaction.atomic():
+                deposit = WalletService.create_deposit_intent(wallet_id, amount)
+                DepositJob.objects.create(deposit=deposit)
+        except (Account.DoesNotExist, WalletService.MoneyValueError) as e:
+            logger.error("Error: <%s>", e)
+            raise WalletService.DepositError(e)
+        return dict(error=0, deposit_id=deposit.id, status=DepositStatus.Pending.name.lower())
+
+    @classmethod
+    def status(cls, deposit_id):
+        """a deposit's status, with its balance once settled and its job if it was accepted"""
+        deposit = Deposit.objects.select_related('statement', 'job').filter(id=deposit_id).first()
+        if deposit is None:
+            return None
+        result_object = dict(error=0, deposit_id=deposit.id, wallet_id=deposit.account_id, amount=deposit.amount,
+                             status=DepositStatus(deposit.status).name.lower(), create_time=deposit.create_time,
+                             modified_time=deposit.modified_time)
+        if deposit.statement is not None:
+            result_object['new_balance'] = deposit.statement.balance_after_transaction
+        job = getattr(deposit, 'job', None)
+        if job is not None:
+            result_object['job'] = dict(status=JobStatus(job.status).name.lower(), attempts=job.attempts,
+                                        error=job.error or None)
+        return result_object
+
+    @classmethod
+    def claim(cls, worker, limit):
+        """reserve up to `limit` of the oldest queued jobs, and of the jobs whose lease expired, for `worker`"""
+        now = timezone.now()
+        claimable = DepositJob.objects.filter(Q(status=JobStatus.Queued)
+                                              | Q(status=JobStatus.Running, lease_time__lt=now))
+        lease = dict(status=JobStatus.Running, worker=worker, attempts=F('attempts') + 1,
+                     lease_time=now + timedelta(seconds=deposit_job_settings()['LEASE']), modified_time=now)
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                jobs = list(claimable.select_for_update(skip_locked=True).order_by('id')[:limit])
+                if jobs:
+                    DepositJob.objects.filter(id__in=[job.id for job in jobs]).update(**lease)
+        else:
+            # no SKIP LOCKED (MySQL before 8.0, SQLite): each job is taken by a conditional UPDATE,
+            # which matches for only one of the workers that read it in the same state
+            jobs = [job for job in claimable.order_by('id')[:limit]
+                    if claimable.filter(id=job.id, attempts=job.attempts).update(**lease)]
+        for job in jobs:
+            if job.status == JobStatus.Queued:
+                job_wait_seconds.observe((now - job.create_time).total_seconds())
+            else:
+                logger.warning('Deposit job %s of worker %s expired, taken over by %s', job.id, job.worker, worker)
+        return jobs
+
+    @classmethod
+    def run(cls, job):
+        """call the bank for the job's deposit and settle it, at most once per deposit"""
+        deposit = Deposit.objects.get(id=job.deposit_id)
+        log.bind(wallet_ids=[deposit.account_id])
+        try:
+            # `job` holds the status it was claimed in
+            if deposit.status == DepositStatus.Pending and job.status == JobStatus.Running:
+                # a job taken over from an expired lease: whether the bank deducted is unknown, so like
+                # `recover_deposits` the deposit goes under review instead of calling the bank twice
+                cls.mark(deposit, DepositStatus.Review)
+                raise CallBankApiService.CallBankServiceError("[DepositJobExpired] Bank confirmation is unknown.")
+            if deposit.status == DepositStatus.Pending:
+                try:
+                    CallBankApiService.call_bank_api()
+                except CallBankApiService.CallBankServiceError:
+                    cls.mark(deposit, DepositStatus.Failed)
+                    raise
+                if not cls.mark(deposit, DepositStatus.Confirmed):
+                    logger.error('Deposit %s changed during its bank call, the bank deducted %s',
+                                 deposit.id, deposit.amount)
+            result = WalletService.settle_confirmed(deposit.id, shard=deposit.shard)
+        except (Account.DoesNotExist, CallBankApiService.CallBankServiceError, WalletService.DepositError,
+                DeadlockRetry.RetryExhaustedError) as e:
+            logger.error("Error: <%s>", e)
+            cls.finish(job, JobStatus.Failed, str(e))
+            return None
+        cls.finish(job, JobStatus.Done)
+        return result
+
+    @staticmethod
+    def mark(deposit, status):
+        return DeadlockRetry.run('deposit_job', WalletService.mark_deposit, deposit.id, DepositStatus.Pending, status)
+
+    @classmethod
+    def finish(cls, job, status, error=''):
+        # a job taken over by another worker meanwhile belongs to that worker
+        jobs = DepositJob.objects.filter(id=job.id, status=JobStatus.Running, attempts=job.attempts + 1)
+        DeadlockRetry.run('deposit_job', jobs.update, status=status, error=error[:200], lease_time=None,
+                          modified_time=timezone.now())
+        finished_jobs.inc(result=JobStatus(status).name.lower())
+
+    @classmethod
+    def queue_stats(cls):
+        """number of queued and running jobs and the age of the oldest queued one, also set as gauges"""
+        rows = (DepositJob.objects.filter(status__in=[JobStatus.Queued, JobStatus.Running]).order_by()
+                .values('status').annotate(jobs=Count('id'), oldest=Min('create_time')))
+        stats = dict(queued=0, running=0, oldest_queued_seconds=0)
+        for row in rows:
+            stats[JobStatus(row['status']).name.lower()] = row['jobs']
+            if row['status'] == JobStatus.Queued:
+                stats['oldest_queued_seconds'] = round((timezone.now() - row['oldest']).total_seconds(), 3)
+        queued_jobs.set(stats['queued'], state='queued')
+        queued_jobs.set(stats['running'], state='running')
+        oldest_job_age.set(stats['oldest_queued_seconds'])
+        return stats
+
+
+class DepositWorker:
+    """one worker process: a pool of `concurrency` threads fed with claimed jobs by the main thread"""
+    def __init__(self, concurrency, poll_interval, name=None):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = threading.Event()
+        self.slots = threading.Semaphore(concurrency)
+
+    def run_job(self, job):
+        close_old_connections()
+        try:
+            DepositJobService.run(job)
+        except Exception:
+            logger.exception('Deposit job %s crashed', job.id)
+        finally:
+            close_old_connections()
+            self.slots.release()
+
+    def run(self, max_jobs=None, drain=False):
+        """process jobs until stopped, `max_jobs` were claimed or, with `drain`, the queue is empty"""
+        claimed = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='deposit-worker') as executor:
+            while not self.stopping.is_set() and (max_jobs is None or claimed < max_jobs):
+                self.slots.acquire()
+                if self.stopping.is_set():
+                    # stopped while waiting for a running job to finish: claim nothing more
+                    self.slots.release()
+                    break
+                free = 1
+                while free < self.concurrency and self.slots.acquire(blocking=False):
+                    free += 1
+                if max_jobs is not None:
+                    free = min(free, max_jobs - claimed)
+                try:
+                    jobs = DeadlockRetry.run('deposit_claim', DepositJobService.claim, self.name, free)
+                except Exception:
+                    logger.exception('Claiming deposit jobs failed')
+                    jobs = []
+                for _ in range(free - len(jobs)):
+                    self.slots.release()
+                for job in jobs:
+                    executor.submit(self.run_job, job)
+                claimed += len(jobs)
+                if not jobs:
+                    if drain:
+                        break
+                    self.stopping.wait(self.poll_interval)
+        return claimed
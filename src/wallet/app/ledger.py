@@ -0,0 +1,177 @@
+import logging
+from datetime import timedelta
+from enum import IntEnum
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min, Sum
+from django.utils import timezone
+
+from .models import Account, BalanceShard, BalanceSnapshot, LedgerCursor, Statement
+
+logger = logging.getLogger('default')
+
+DEFAULT_LEDGER = {
+    # statements become append-only: saving, updating or deleting statements raises, and so does
+    # deleting a wallet that has statements
+    'ENABLED': False,
+    # snapshot a wallet once this many statements were appended since its last snapshot
+    'SNAPSHOT_EVERY': 1000,
+    # ... or once its last snapshot is this many seconds old and it has new statements
+    'SNAPSHOT_INTERVAL': 3600,
+    # statements younger than this many seconds are left to the next run, so a transaction still in
+    # flight cannot commit a statement below an existing snapshot
+    'SETTLE_LAG': 5,
+}
+
+
+def ledger_settings():
+    config = dict(DEFAULT_LEDGER)
+    config.update(getattr(settings, 'WALLET_LEDGER', {}))
+    return config
+
+
+class SnapshotStatus(IntEnum):
+    Pending = 1     # not verified yet
+    Verified = 2    # matches its predecessor plus the statements in between
+    Mismatch = 3    # a statement in its range was changed, removed or has a wrong balance
+
+
+class LedgerService:
+    """
+    Ledger mode: statements are the append-only source of truth and the account balance (plus its
+    shards) is kept as their running total, which `verify` reconciles. Snapshots record a wallet's
+    balance after its statements up to some id, so a balance or a verification only reads the
+    statements appended since the last snapshot instead of the wallet's whole history.
+    """
+    SNAPSHOT_CURSOR = 'snapshot'
+
+    @classmethod
+    def horizon(cls, settle_lag):
+        """id of the newest statement that is older than `settle_lag` seconds"""
+        before = timezone.now() - timedelta(seconds=settle_lag)
+        return Statement.objects.filter(create_time__lte=before).order_by('-id').values_list('id', flat=True).first() or 0
+
+    @classmethod
+    def latest_snapshots(cls, account_ids):
+        """{account_id: latest snapshot} of the given wallets that have one"""
+        latest_ids = (BalanceSnapshot.objects.filter(account_id__in=account_ids)
+                      .values('account_id').annotate(latest=Max('id')).values('latest'))
+        return {snapshot.account_id: snapshot for snapshot in BalanceSnapshot.objects.filter(id__in=latest_ids)}
+
+    @classmethod
+    def balance(cls, account_id):
+        """wallet balance from the ledger: its latest snapshot plus the statements appended after it"""
+        # a snapshot found not to match its statements is no base for a balance
+        snapshot = (BalanceSnapshot.objects.filter(account_id=account_id).exclude(status=SnapshotStatus.Mismatch)
+                    .order_by('-id').first())
+        after, balance = (snapshot.last_statement_id, snapshot.balance) if snapshot else (0, 0)
+        total = Statement.objects.filter(account_id=account_id, id__gt=after).aggregate(total=Sum('amount'))['total']
+        return balance + (total or 0)
+
+    @classmethod
+    def reconcile(cls, account_ids):
+        """
+        {account_id: (balance, ledger balance)} of the wallets whose balance, the account row plus its
+        shards, differs from the ledger. The rows are locked while the statements are summed, so no
+        deposit or transfer of the wallet commits in between.
+        """
+        drifted = {}
+        for account_id in account_ids:
+            with transaction.atomic():
+                balance = (Account.objects.select_for_update().filter(id=account_id)
+                           .values_list('balance', flat=True).first())
+                if balance is None:
+                    continue
+                balance += sum(BalanceShard.objects.select_for_update().filter(account_id=account_id)
+                               .values_list('balance', flat=True))
+                ledger = cls.balance(account_id)
+            if balance != ledger:
+                drifted[account_id] = (balance, ledger)
+        return drifted
+
+    @classmethod
+    def take_snapshots(cls, batch_size=500, max_statements=100000):
+        """
+        Snapshot the wallets that got statements since the last run and are due by `SNAPSHOT_EVERY`
+        or `SNAPSHOT_INTERVAL`. Only statements after the snapshot cursor are scanned; the cursor
+        stops before the first statement of a wallet that is not due yet.
+        """
+        config = ledger_settings()
+        now = timezone.now()
+        interval = timedelta(seconds=config['SNAPSHOT_INTERVAL'])
+        with transaction.atomic():
+            # the cursor row lock keeps concurrent runs from snapshotting the same statements twice
+            cursor, _ = LedgerCursor.objects.select_for_update().get_or_create(name=cls.SNAPSHOT_CURSOR)
+            horizon = min(cls.horizon(config['SETTLE_LAG']), cursor.statement_id + max_statements)
+            if horizon <= cursor.statement_id:
+                return dict(accounts=0, snapshots=0, cursor=cursor.statement_id)
+
+            touched = list(Statement.objects.filter(id__gt=cursor.statement_id, id__lte=horizon)
+                           .order_by('account_id').values_list('account_id', flat=True).distinct())
+            next_cursor = horizon
+            written = 0
+            for start in range(0, len(touched), batch_size):
+                batch = touched[start:start + batch_size]
+                latest = cls.latest_snapshots(batch)
+                snapshots = []
+                for account_id in batch:
+                    previous = latest.get(account_id)
+                    after = previous.last_statement_id if previous else 0
+                    pending = (Statement.objects.filter(account_id=account_id, id__gt=after, id__lte=horizon)
+                               .aggregate(total=Sum('amount'), entries=Count('id'), first=Min('id'), last=Max('id')))
+                    if not pending['entries']:
+                        continue
+                    due = (previous is None or pending['entries'] >= config['SNAPSHOT_EVERY']
+                           or now - previous.create_time >= interval)
+                    if not due:
+                        next_cursor = min(next_cursor, pending['first'] - 1)
+                        continue
+                    snapshots.append(BalanceSnapshot(
+                        account_id=account_id, previous=previous, last_statement_id=pending['last'],
+                        balance=(previous.balance if previous else 0) + pending['total'], entries=pending['entries']))
+                BalanceSnapshot.objects.bulk_create(snapshots)
+                written += len(snapshots)
+
+            cursor.statement_id = max(next_cursor, cursor.statement_id)
+            cursor.save(update_fields=['statement_id', 'modified_time'])
+        return dict(accounts=len(touched), snapshots=written, cursor=cursor.statement_id)
+
+    @classmethod
+    def verify(cls, batch_size=1000):
+        """
+        Verify the snapshots written since the last run, oldest first: each must equal its predecessor
+        plus the statements between the two, and match the balance recorded by its last statement.
+        The balances of their wallets are then reconciled with the ledger, see `reconcile`.
+        """
+        snapshots = list(BalanceSnapshot.objects.filter(status=SnapshotStatus.Pending)
+                         .select_related('previous', 'account').order_by('id')[:batch_size])
+        verified, mismatched = [], []
+        for snapshot in snapshots:
+            previous = snapshot.previous
+            after, base = (previous.last_statement_id, previous.balance) if previous else (0, 0)
+            totals = (Statement.objects.filter(account_id=snapshot.account_id, id__gt=after,
+                                               id__lte=snapshot.last_statement_id)
+                      .aggregate(total=Sum('amount'), entries=Count('id')))
+            last_balance = (Statement.objects.filter(id=snapshot.last_statement_id)
+                            .values_list('balance_after_transaction', flat=True).first())
+            # a sharded wallet's statements record no running balance, its shards are reconciled below
+            ok = (base + (totals['total'] or 0) == snapshot.balance and totals['entries'] == snapshot.entries
+                  and (snapshot.account.shards or last_balance == snapshot.balance))
+            if ok:
+                verified.append(snapshot.id)
+            else:
+                logger.error('Ledger mismatch: wallet %s snapshot %s expects %s after %s statements, '
+                             'statements sum to %s after %s, last statement records %s',
+                             snapshot.account_id, snapshot.id, snapshot.balance, snapshot.entries,
+                             base + (totals['total'] or 0), totals['entries'], last_balance)
+                mismatched.append(snapshot.id)
+
+        now = timezone.now()
+        BalanceSnapshot.objects.filter(id__in=verified).update(status=SnapshotStatus.Verified, verify_time=now)
+        BalanceSnapshot.objects.filter(id__in=mismatched).update(status=SnapshotStatus.Mismatch, verify_time=now)
+        drifted = cls.reconcile(sorted({snapshot.account_id for snapshot in snapshots}))
+        for account_id, (balance, ledger) in drifted.items():
+            logger.error('Ledger drift: wallet %s has balance %s, its statements sum to %s',
+                         account_id, balance, ledger)
+        return dict(verified=len(verified), mismatched=mismatched, drifted=sorted(drifted))
@@ -0,0 +1,196 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+
+from asgiref.local import Local
+from django.utils.decorators import sync_and_async_middleware
+
+from . import metrics, profiling
+
+logger = logging.getLogger('default')
+
+records_dropped = metrics.counter('wallet_log_records_dropped_total', 'Log records dropped because the queue was full',
+                                  ['level'])
+
+_local = Local()
+
+# attributes every LogRecord has, anything else was passed through `extra`
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def context():
+    """log context of the request being handled, fields in it are added to every record it logs"""
+    return getattr(_local, 'context', None)
+
+
+@contextmanager
+def activate(log_context):
+    previous = context()
+    _local.context = log_context
+    try:
+        yield log_context
+    finally:
+        _local.context = previous
+
+
+def bind(**fields):
+    """add fields, e.g. wallet ids, to the records logged for the rest of the current request"""
+    log_context = context()
+    if log_context is not None:
+        log_context.update(fields)
+
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        log_context = context()
+        if log_context:
+            for key, value in log_context.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """one JSON object per line: time, level, logger, message, request context and `extra` fields"""
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}'
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hand records to a bounded queue drained by a `QueueListener` thread. When the queue is full,
+    records below `block_level` are dropped at once; records at or above it wait up to `block_timeout`
+    seconds for space (back-pressure) before they are dropped too.
+
+    With a `target` handler the queue is drained by a listener thread of the process that logs. It is
+    started by the first record, so a process forked after logging was configured (a gunicorn worker
+    with --preload, a `deposit_worker` child) starts its own listener and queue instead of using the
+    parent's, whose thread does not exist in the child.
+    """
+    def __init__(self, queue_, block_level=logging.ERROR, block_timeout=0, target=None):
+        super().__init__(queue_)
+        self.block_level = block_level
+        self.block_timeout = block_timeout
+        self.target = target
+        self.listener = None
+        self.pid = None
+        self.addFilter(RequestContextFilter())
+
+    def start_listener(self):
+        # called with the handler lock held
+        if self.listener is not None:
+            # inherited from the parent process: its queue may even have been locked at the time of the fork
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def stop_listener(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+
+    def close(self):
+        # called by logging.shutdown, at exit or by a process that exits without running atexit
+        self.stop_listener()
+        if self.target is not None:
+            self.target.close()
+        super().close()
+
+    def prepare(self, record):
+        # only merge the arguments here, formatting to JSON is left to the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.target is not None and self.pid != os.getpid():
+            self.start_listener()
+        try:
+            if self.block_timeout and record.levelno >= self.block_level:
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            records_dropped.inc(level=record.levelname)
+
+
+def queue_file_handler(filename=None, queue_size=10000, block_level='ERROR', block_timeout=0):
+    """
+    `LOGGING` handler factory: JSON records are written to `filename`, or to stdout without one, by a
+    background listener; the logging call itself only puts the record on a bounded queue. Every process
+    appends to the same file and none rotates it: rotate it externally (e.g. logrotate), the file is
+    reopened once it was moved.
+    """
+    if filename:
+        target = WatchedFileHandler(filename, encoding='utf-8')
+    else:
+        target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter())
+    return NonBlockingQueueHandler(queue.Queue(maxsize=queue_size), logging.getLevelName(block_level), block_timeout,
+                                   target=target)
+
+
+@sync_and_async_middleware
+def RequestLogMiddleware(get_response):
+    """
+    Give every request an id (the X-Request-ID header or a new one) that is added to all records it
+    logs, and log one access record with its status, duration and profiled timings.
+    """
+    def start(request):
+        request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        return dict(request_id=request_id[:64]), time.perf_counter()
+
+    def finish(request, response, log_context, started):
+        response['X-Request-ID'] = log_context['request_id']
+        profile = profiling.current()
+        extra = dict(method=request.method, path=request.path, status=response.status_code,
+                     duration_ms=round((time.perf_counter() - started) * 1000, 2))
+        if profile is not None:
+            extra['timings_ms'] = {phase: round(seconds * 1000, 2) for phase, seconds in profile.durations.items()}
+            extra['queries'] = profile.queries
+        logger.info('%s %s %s', request.method, request.path, response.status_code, extra=extra)
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            log_context, started = start(request)
+            with activate(log_context):
+                response = await get_response(request)
+                finish(request, response, log_context, started)
+            return response
+    else:
+        def middleware(request):
+            log_context, started = start(request)
+            with activate(log_context):
+                response = get_response(request)
+                finish(request, response, log_context, started)
+            return response
+    return middleware
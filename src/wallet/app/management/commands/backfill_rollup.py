@@ -0,0 +1,21 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.rollup import DailyRollupService
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily statement summaries from the statements, of all days or a range of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=date.fromisoformat, default=None, help='first day, YYYY-MM-DD')
+        parser.add_argument('--until', type=date.fromisoformat, default=None, help='last day, YYYY-MM-DD')
+        parser.add_argument('--chunk-size', type=int, default=100000, help='statement ids aggregated per query')
+
+    def handle(self, *args, **options):
+        if options['since'] and options['until'] and options['since'] > options['until']:
+            raise CommandError('--since must not be after --until')
+        result = DailyRollupService.backfill(since=options['since'], until=options['until'],
+                                             chunk_size=options['chunk_size'])
+        self.stdout.write(f"groups: {result['groups']}, cursor: {result['cursor']}")
@@ -0,0 +1,63 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from app.benchmark import Benchmark, HttpClient, InProcessClient, parse_mix
+from app.models import Account
+from app.stubbank import StubBankServer
+
+
+class Command(BaseCommand):
+    help = 'Load test the wallet apis with a mix of requests against a local stub bank and report the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=None,
+                            help='base url of a running server, e.g. http://127.0.0.1:8888 (default: in-process)')
+        parser.add_argument('--mix', default='create=1,deposit=4,transfer=4,statements=1',
+                            help='weights of the create, deposit, transfer and statements operations')
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--wallets', type=int, default=20, help='pre-funded wallets the requests work on')
+        parser.add_argument('--bank-delay', type=float, default=0.05, help='seconds the stub bank takes to answer')
+        parser.add_argument('--bank-port', type=int, default=None,
+                            help='port of the stub bank; with --url the server must use it as its bank api, '
+                                 'e.g. WALLET_BANK_API_URL=http://127.0.0.1:<port>/')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--keep', action='store_true', help='keep the benchmark wallets (in-process only)')
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['wallets'] < 2 or options['concurrency'] < 1 or options['requests'] < 1:
+            raise CommandError('need at least 2 wallets, 1 thread and 1 request')
+
+        bank = None
+        if options['url'] is None or options['bank_port'] is not None:
+            bank = StubBankServer(delay=options['bank_delay'], port=options['bank_port'] or 0).start()
+        try:
+            if options['url'] is None:
+                report = self.run_in_process(mix, bank, options)
+            else:
+                report = self.run(HttpClient(options['url'], options['concurrency']), mix, options)
+        finally:
+            if bank is not None:
+                bank.stop()
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def run(self, client, mix, options):
+        benchmark = Benchmark(client, mix, concurrency=options['concurrency'], requests=options['requests'],
+                              wallets=options['wallets'], seed=options['seed'])
+        try:
+            return benchmark.run()
+        finally:
+            if isinstance(client, InProcessClient) and not options['keep']:
+                Account.objects.filter(id__in=benchmark.created_ids).delete()
+
+    def run_in_process(self, mix, bank, options):
+        bank_api = dict(settings.BANK_API, URL=bank.url)
+        with override_settings(BANK_API=bank_api, ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+            return self.run(InProcessClient(), mix, options)
@@ -0,0 +1,97 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from app.benchmark import percentiles
+from app.models import Account, Deposit
+from app.services import DeadlockRetry, DepositStatus, OptimisticRetry, WalletService
+
+
+class Command(BaseCommand):
+    help = ('Compare the pessimistic (row locks) and optimistic (version columns) transfer and deposit engines '
+            'under low and high contention')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--operations', type=int, default=1000, help='operations per engine and contention')
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--deposit-share', type=float, default=0.2, help='share of the operations that '
+                                                                             'settle a deposit, the rest transfer')
+        parser.add_argument('--low-contention-wallets', type=int, default=500)
+        parser.add_argument('--high-contention-wallets', type=int, default=2)
+
+    def handle(self, *args, **options):
+        report = {}
+        for contention in ('low', 'high'):
+            wallets = options[f'{contention}_contention_wallets']
+            for engine in ('pessimistic', 'optimistic'):
+                with override_settings(WALLET_CONCURRENCY=dict(ENGINE=engine),
+                                       WALLET_TRANSFER_PRECHECK=dict(ENABLED=False)):
+                    report[f'{contention}_contention_{engine}'] = self.run(
+                        wallets, options['operations'], options['threads'], options['deposit_share'])
+        self.stdout.write(json.dumps(report, indent=2))
+
+    @staticmethod
+    def lock_wait_ms():
+        """InnoDB's total row lock wait, None on other databases"""
+        if connection.vendor != 'mysql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_row_lock_time'")
+            return int(cursor.fetchone()[1])
+
+    def run(self, wallet_count, operations, threads, deposit_share):
+        accounts = [Account(name=f'benchmark-concurrency-{i}', balance=Decimal('1000000'))
+                    for i in range(wallet_count)]
+        # only the wallets of this run are used and deleted, whatever else has the same name
+        with transaction.atomic():
+            wallet_ids = WalletService.bulk_insert(Account, accounts)
+        try:
+            deposits = [WalletService.create_deposit_intent(random.choice(wallet_ids), Decimal('1')).id
+                        for _ in range(round(operations * deposit_share))]
+            Deposit.objects.filter(id__in=deposits).update(status=DepositStatus.Confirmed)
+            work = [('deposit', deposit_id) for deposit_id in deposits]
+            work += [('transfer', tuple(random.sample(wallet_ids, 2))) for _ in range(operations - len(deposits))]
+            random.shuffle(work)
+
+            latencies, errors = [], []
+            lock = threading.Lock()
+
+            def operation(item):
+                kind, argument = item
+                start = time.perf_counter()
+                try:
+                    if kind == 'deposit':
+                        WalletService.settle_confirmed(argument)
+                    else:
+                        WalletService.transfer(*argument, Decimal('1'))
+                except Exception as e:
+                    with lock:
+                        errors.append(type(e).__name__)
+                finally:
+                    connection.close()
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+            counters = (DeadlockRetry.retries, OptimisticRetry.conflicts, OptimisticRetry.fallbacks)
+            before = [sum(counter.value(operation=name) for name in ('transfer', 'deposit')) for counter in counters]
+            lock_wait = self.lock_wait_ms()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(operation, work))
+            elapsed = time.perf_counter() - start
+            after = [sum(counter.value(operation=name) for name in ('transfer', 'deposit')) for counter in counters]
+            lock_wait_after = self.lock_wait_ms()
+            return dict(wallets=wallet_count, operations=operations, threads=threads, seconds=round(elapsed, 2),
+                        operations_per_second=round(operations / elapsed, 1), latency_ms=percentiles(latencies),
+                        errors=len(errors), lock_retries=after[0] - before[0], conflicts=after[1] - before[1],
+                        fallbacks=after[2] - before[2],
+                        lock_wait_ms=None if lock_wait is None else lock_wait_after - lock_wait)
+        finally:
+            Account.objects.filter(id__in=wallet_ids).delete()
@@ -0,0 +1,64 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections
+from django.test.utils import override_settings
+
+from app.benchmark import percentiles
+from app.dbpool import PooledDatabaseWrapperMixin, connections_opened, pool_timeouts
+from app.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Compare pooled connections with a connection per request: concurrent requests each running a query'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=50, help='threads sending requests')
+        parser.add_argument('--requests', type=int, default=2000, help='requests per mode')
+        parser.add_argument('--pool-size', type=int, default=20)
+
+    def handle(self, *args, **options):
+        if not isinstance(connections[DEFAULT_DB_ALIAS], PooledDatabaseWrapperMixin):
+            raise CommandError("the default database does not use a pooled engine, e.g. 'app.backends.mysql'")
+        wallet_id = Account.objects.values_list('id', flat=True).first() or 0
+        connections[DEFAULT_DB_ALIAS].close()
+
+        report = {}
+        for mode, enabled in (('per_request', False), ('pooled', True)):
+            with override_settings(WALLET_DB_POOL=dict(ENABLED=enabled, MAX_SIZE=options['pool_size'])):
+                report[mode] = self.run(wallet_id, options['concurrency'], options['requests'])
+        self.stdout.write(json.dumps(report, indent=2))
+
+    @staticmethod
+    def run(wallet_id, concurrency, requests):
+        alias = DEFAULT_DB_ALIAS
+        opened, timeouts = connections_opened.value(database=alias), pool_timeouts.value(database=alias)
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def request():
+            # the lifecycle of a request: connect on the first query, close (or release) when it finishes
+            start = time.perf_counter()
+            try:
+                close_old_connections()
+                Account.objects.filter(id=wallet_id).exists()
+            except Exception as e:
+                with lock:
+                    errors.append(type(e).__name__)
+            finally:
+                close_old_connections()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(request) for _ in range(requests)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+        return dict(requests=requests, errors=len(errors), seconds=round(elapsed, 2),
+                    requests_per_second=round(requests / elapsed, 1), latency_ms=percentiles(latencies),
+                    connections_opened=connections_opened.value(database=alias) - opened,
+                    pool_timeouts=pool_timeouts.value(database=alias) - timeouts)
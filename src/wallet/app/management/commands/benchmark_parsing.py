@@ -0,0 +1,52 @@
+import json
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse
+
+from app.forms import DepositForm, TransferForm
+from app.schemas import DepositSchema, TransferSchema, WalletJSONEncoder
+
+BODIES = {
+    'deposit': (b'{"wallet_id": 8, "amount": 12.34}', DepositForm, DepositSchema),
+    'transfer': (b'{"from_wallet_id": 2, "to_wallet_id": 1, "amount": 10}', TransferForm, TransferSchema),
+}
+RESULT = {'Result': 1, 'Message': None, 'ResultObject': {'error': 0, 'new_balance': Decimal('1234.56')}}
+
+
+def form_request(body, form_class):
+    form = form_class(json.loads(body.decode('utf-8')))
+    form.is_valid()
+    return JsonResponse(data=dict(RESULT), encoder=DjangoJSONEncoder)
+
+
+def schema_request(body, schema):
+    schema.load(body)
+    return JsonResponse(data=dict(RESULT), encoder=WalletJSONEncoder)
+
+
+class Command(BaseCommand):
+    help = 'Compare the CPU time of request parsing, validation and response encoding: django forms vs schemas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        report = {}
+        for name, (body, form_class, schema) in BODIES.items():
+            forms_us = self.measure(form_request, body, form_class, iterations)
+            schema_us = self.measure(schema_request, body, schema, iterations)
+            report[name] = dict(forms_us_per_request=forms_us, schema_us_per_request=schema_us,
+                                speedup=round(forms_us / schema_us, 2) if schema_us else None)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    @staticmethod
+    def measure(func, body, validator, iterations):
+        func(body, validator)
+        start = time.process_time()
+        for _ in range(iterations):
+            func(body, validator)
+        return round((time.process_time() - start) / iterations * 1e6, 2)
@@ -0,0 +1,46 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from app.models import Account, Deposit
+from app.services import DepositStatus, WalletService
+
+
+class Command(BaseCommand):
+    help = 'Compare deposit settle throughput on one hot wallet with a single balance row and with sharded balances'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--deposits', type=int, default=500)
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--shards', type=int, default=16)
+
+    def handle(self, *args, **options):
+        report = {}
+        for mode, shards in (('single_row', 0), ('sharded', options['shards'])):
+            report[mode] = self.run(shards, options['deposits'], options['threads'])
+        report['speedup'] = round(report['sharded']['deposits_per_second'] /
+                                  report['single_row']['deposits_per_second'], 2)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def run(self, shards, deposits, threads):
+        account = Account.objects.create(name=f'benchmark-sharding-{shards}')
+        try:
+            if shards:
+                WalletService.shard_wallet(account.id, shards)
+            intents = [WalletService.create_deposit_intent(account.id, Decimal('1')) for _ in range(deposits)]
+            Deposit.objects.filter(account=account).update(status=DepositStatus.Confirmed)
+
+            def settle(intent):
+                WalletService.settle_deposit(intent.id, shard=intent.shard)
+
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(settle, intents))
+            elapsed = time.monotonic() - start
+            return dict(shards=shards, deposits=deposits, threads=threads, seconds=round(elapsed, 3),
+                        deposits_per_second=round(deposits / elapsed, 1))
+        finally:
+            account.delete()
@@ -0,0 +1,50 @@
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.schemas import String
+from app.services import WalletService
+
+
+class Command(BaseCommand):
+    help = 'Create a wallet per line of a file of names, in bulk_create batches, and write the new wallet ids'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', help="file with one wallet name per line, '-' for stdin")
+        parser.add_argument('--output', default=None, help='file the new wallet ids are written to, one per line '
+                                                           'in the order of the names')
+        parser.add_argument('--batch-size', type=int, default=None, help='wallets inserted per transaction, '
+                                                                         'WALLET_CREATE_BATCH_SIZE by default')
+
+    def handle(self, *args, **options):
+        names_file = sys.stdin if options['names'] == '-' else open(options['names'], encoding='utf-8')
+        output = open(options['output'], 'w', encoding='utf-8') if options['output'] else None
+        created = batches = 0
+        start = time.perf_counter()
+        try:
+            for wallet_ids in WalletService.create_wallet_batches(self.read_names(names_file), options['batch_size']):
+                created += len(wallet_ids)
+                batches += 1
+                if output is not None:
+                    output.write(''.join(f'{wallet_id}\n' for wallet_id in wallet_ids))
+        except ValueError as e:
+            raise CommandError(f'{e}, {created} wallets were created before it')
+        finally:
+            if names_file is not sys.stdin:
+                names_file.close()
+            if output is not None:
+                output.close()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(json.dumps(dict(wallets=created, batches=batches, seconds=round(elapsed, 2),
+                                          wallets_per_second=round(created / elapsed) if elapsed else None)))
+
+    @staticmethod
+    def read_names(lines):
+        validate = String(max_length=200)
+        for number, line in enumerate(lines, 1):
+            try:
+                yield validate(line.rstrip('\r\n'))
+            except ValueError as e:
+                raise ValueError(f'line {number}: {e}')
@@ -0,0 +1,75 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app.dbpool import ConnectionPool
+from app.jobs import DepositJobService, DepositWorker, deposit_job_settings
+
+
+class Command(BaseCommand):
+    help = 'Call the bank for accepted deposits and settle them, with a pool of worker threads (and processes)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None, help='threads per process calling the bank')
+        parser.add_argument('--processes', type=int, default=None, help='worker processes')
+        parser.add_argument('--max-jobs', type=int, default=None, help='exit after claiming this many jobs')
+        parser.add_argument('--drain', action='store_true', help='exit once the queue is empty')
+        parser.add_argument('--stats', action='store_true', help='print the queue depth and age and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.stdout.write(json.dumps(DepositJobService.queue_stats()))
+            return
+        config = deposit_job_settings()
+        concurrency = options['concurrency'] or config['CONCURRENCY']
+        processes = options['processes'] or config['PROCESSES']
+        args = (concurrency, config['POLL_INTERVAL'], options['max_jobs'], options['drain'])
+        if processes == 1:
+            claimed = work(*args)
+        else:
+            claimed = self.fork(processes, args)
+        self.stdout.write(json.dumps(dict(claimed=claimed, **DepositJobService.queue_stats())))
+
+    @staticmethod
+    def fork(processes, args):
+        # children must not share the parent's database connections, pooled ones included; each child
+        # logs through a listener and queue of its own, see app.log.NonBlockingQueueHandler
+        connections.close_all()
+        ConnectionPool.reset()
+        context = multiprocessing.get_context('fork')
+        results = context.SimpleQueue()
+        children = [context.Process(target=work, args=args + (results,), daemon=False) for _ in range(processes)]
+        for child in children:
+            child.start()
+
+        def stop(signum, frame):
+            for child in children:
+                if child.is_alive():
+                    os.kill(child.pid, signal.SIGTERM)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, stop)
+        for child in children:
+            child.join()
+        claimed = 0
+        while not results.empty():
+            claimed += results.get()
+        return claimed
+
+
+def work(concurrency, poll_interval, max_jobs, drain, results=None):
+    worker = DepositWorker(concurrency, poll_interval)
+    # finish the jobs in progress on SIGTERM / SIGINT, claim no new ones
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: worker.stopping.set())
+    claimed = worker.run(max_jobs=max_jobs, drain=drain)
+    if results is not None:
+        results.put(claimed)
+        connections.close_all()
+        # a child exits without running atexit, write out the records still queued
+        logging.shutdown()
+    return claimed
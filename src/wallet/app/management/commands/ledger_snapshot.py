@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.ledger import LedgerService, ledger_settings
+
+
+class Command(BaseCommand):
+    help = 'Write balance snapshots for wallets with enough new statements (ledger mode)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='wallets handled per query batch')
+        parser.add_argument('--loop', type=float, default=None, help='keep running, every this many seconds')
+
+    def handle(self, *args, **options):
+        if not ledger_settings()['ENABLED']:
+            raise CommandError("ledger mode is disabled, set WALLET_LEDGER['ENABLED']")
+        while True:
+            result = LedgerService.take_snapshots(batch_size=options['batch_size'])
+            self.stdout.write(f"wallets: {result['accounts']}, snapshots: {result['snapshots']}, "
+                              f"cursor: {result['cursor']}")
+            if options['loop'] is None:
+                return
+            time.sleep(options['loop'])
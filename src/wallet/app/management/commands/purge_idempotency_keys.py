@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from app.idempotency import IdempotencyService
+
+
+class Command(BaseCommand):
+    help = 'Delete expired Idempotency-Key records and their stored responses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='rows deleted per query')
+
+    def handle(self, *args, **options):
+        purged = IdempotencyService.purge_expired(batch_size=options['batch_size'])
+        self.stdout.write(f"purged: {purged}")
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app.services import WalletService
+
+
+class Command(BaseCommand):
+    help = ('Settle confirmed deposits and put stale pending deposits left behind by crashed workers '
+            'under review')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=None,
+                            help='only recover deposits not updated for this many seconds')
+
+    def handle(self, *args, **options):
+        result = WalletService.recover_deposits(older_than=options['older_than'])
+        self.stdout.write(f"settled: {result['settled']}, under review: {result['review']}")
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.models import Deposit
+from app.services import DepositStatus, WalletService
+
+
+class Command(BaseCommand):
+    help = 'List deposits under review, or resolve them once the bank told whether it deducted them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--settle', type=int, nargs='+', default=[], metavar='ID',
+                            help='deposits the bank deducted: credit the wallet')
+        parser.add_argument('--fail', type=int, nargs='+', default=[], metavar='ID',
+                            help='deposits the bank never deducted')
+
+    def handle(self, *args, **options):
+        if not options['settle'] and not options['fail']:
+            for deposit in Deposit.objects.filter(status=DepositStatus.Review).order_by('id'):
+                self.stdout.write(f"{deposit.id} wallet: {deposit.account_id}, amount: {deposit.amount}, "
+                                  f"since: {deposit.modified_time.isoformat()}")
+            return
+        for deposit_id, deducted in [(i, True) for i in options['settle']] + [(i, False) for i in options['fail']]:
+            try:
+                result = WalletService.resolve_deposit(deposit_id, deducted)
+            except WalletService.DepositError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f"{deposit_id}: {result['status']}")
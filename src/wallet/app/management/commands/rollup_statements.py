@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.rollup import DailyRollupService
+
+
+class Command(BaseCommand):
+    help = 'Add the statements appended since the last run to the daily statement summaries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-statements', type=int, default=100000, help='statement ids handled per run')
+        parser.add_argument('--loop', type=float, default=None, help='keep running, every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            result = DailyRollupService.roll_up(max_statements=options['max_statements'])
+            self.stdout.write(f"groups: {result['groups']}, cursor: {result['cursor']}")
+            if options['loop'] is None:
+                return
+            time.sleep(options['loop'])
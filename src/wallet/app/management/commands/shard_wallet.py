@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.models import Account
+from app.services import WalletService
+
+
+class Command(BaseCommand):
+    help = 'Split a hot wallet balance into sub-balance shards (0 folds the shards back into the wallet)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('wallet_id', type=int)
+        parser.add_argument('shards', type=int)
+
+    def handle(self, *args, **options):
+        if options['shards'] < 0:
+            raise CommandError('shards must not be negative')
+        try:
+            result = WalletService.shard_wallet(options['wallet_id'], options['shards'])
+        except Account.DoesNotExist:
+            raise CommandError(f"wallet {options['wallet_id']} does not exist")
+        self.stdout.write(f"wallet {result['wallet_id']}: {result['shards']} shards, balance {result['balance']}")
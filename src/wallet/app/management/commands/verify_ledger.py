@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.ledger import LedgerService
+
+
+class Command(BaseCommand):
+    help = ('Verify the balance snapshots written since the last verification against their statements, '
+            'and the balances of their wallets against the ledger')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        verified, mismatched, drifted = 0, [], []
+        while True:
+            result = LedgerService.verify(batch_size=options['batch_size'])
+            verified += result['verified']
+            mismatched += result['mismatched']
+            drifted += result['drifted']
+            if result['verified'] + len(result['mismatched']) < options['batch_size']:
+                break
+        self.stdout.write(f"verified: {verified}, mismatched: {len(mismatched)}, drifted: {len(drifted)}")
+        if mismatched:
+            raise CommandError(f"snapshots that do not match their statements: {', '.join(map(str, mismatched))}")
+        if drifted:
+            raise CommandError(f"wallets whose balance differs from their statements: {', '.join(map(str, drifted))}")
@@ -1,9 +1,26 @@
 from django.db import models
 
 
+def ledger_enabled():
+    # app.ledger imports the models
+    from .ledger import ledger_settings
+    return ledger_settings()['ENABLED']
+
+
+def cascade_unless_ledger(collector, field, sub_objs, using):
+    """on_delete of statements: a wallet with statements cannot be deleted in ledger mode"""
+    if ledger_enabled():
+        models.PROTECT(collector, field, sub_objs, using)
+    else:
+        models.CASCADE(collector, field, sub_objs, using)
+
+
 class Account(models.Model):
     name = models.CharField(max_length=200, verbose_name="帳戶名稱")
     balance = models.DecimalField(default=0, max_digits=18, decimal_places=2, verbose_name="帳戶餘額")
+    shards = models.PositiveSmallIntegerField(default=0, verbose_name="餘額分片數")
+    # bumped by every balance write, optimistic writes are conditional on it
+    version = models.PositiveIntegerField(default=0, verbose_name="版本號")
     modified_time = models.DateTimeField(auto_now=True, verbose_name="帳戶更新時間")
     create_time = models.DateTimeField(auto_now_add=True, verbose_name="帳戶建立時間")
 
@@ -12,16 +29,48 @@ class Account(models.Model):
 
     class Meta:
         db_table = 'account_tab'
+        indexes = [
+            # incremental refresh of the account search index
+            models.Index(fields=['modified_time'], name='account_modified_time_idx'),
+        ]
+
+
+class StatementQuerySet(models.QuerySet):
+    """bulk updates and deletes of statements, bulk_update included, are refused in ledger mode too"""
+    def update(self, **kwargs):
+        if ledger_enabled():
+            raise Statement.ImmutableError("[ImmutableError] statements are append-only in ledger mode")
+        return super().update(**kwargs)
+
+    def delete(self):
+        if ledger_enabled():
+            raise Statement.ImmutableError("[ImmutableError] statements are append-only in ledger mode")
+        return super().delete()
 
 
 class Statement(models.Model):
-    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    account = models.ForeignKey(Account, on_delete=cascade_unless_ledger)
     wallet_id = models.IntegerField(default=0, verbose_name="帳戶編號")
     amount = models.DecimalField(max_digits=18, decimal_places=2, verbose_name="交易金額")
     balance_after_transaction = models.DecimalField(max_digits=18, decimal_places=2, verbose_name="交易後餘額")
     type = models.PositiveSmallIntegerField(verbose_name="帳戶編號")
     create_time = models.DateTimeField(auto_now_add=True, verbose_name="交易時間")
 
+    objects = StatementQuerySet.as_manager()
+
+    class ImmutableError(Exception):
+        """帳本模式下交易紀錄只能新增"""
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and ledger_enabled():
+            raise Statement.ImmutableError(f"[ImmutableError] statement {self.pk} is append-only in ledger mode")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        if ledger_enabled():
+            raise Statement.ImmutableError(f"[ImmutableError] statement {self.pk} is append-only in ledger mode")
+        return super().delete(*args, **kwargs)
+
     def __str__(self):
         statement = f"transaction amount: {self.amount}, balance: {self.balance_after_transaction}, type: {self.type}, " \
                     f"transaction time: {self.create_time}"
@@ -29,3 +78,127 @@ class Statement(models.Model):
 
     class Meta:
         db_table = 'statement_tab'
+        indexes = [
+            # keyset pagination of a wallet's statements, newest first
+            models.Index(fields=['account', 'create_time', 'id'], name='statement_account_time_idx'),
+        ]
+
+
+class BalanceShard(models.Model):
+    """sub-balance of a hot wallet, the wallet balance is account.balance plus the sum of its shards"""
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    index = models.PositiveSmallIntegerField(verbose_name="分片編號")
+    balance = models.DecimalField(default=0, max_digits=18, decimal_places=2, verbose_name="分片餘額")
+    modified_time = models.DateTimeField(auto_now=True, verbose_name="分片更新時間")
+
+    def __str__(self):
+        return f"wallet id: {self.account_id}, shard: {self.index}, balance: {self.balance}"
+
+    class Meta:
+        db_table = 'balance_shard_tab'
+        unique_together = [('account', 'index')]
+
+
+class Deposit(models.Model):
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    amount = models.DecimalField(max_digits=18, decimal_places=2, verbose_name="存款金額")
+    status = models.PositiveSmallIntegerField(default=1, db_index=True, verbose_name="存款狀態")
+    shard = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name="存入分片")
+    statement = models.OneToOneField(Statement, null=True, blank=True, on_delete=models.SET_NULL)
+    modified_time = models.DateTimeField(auto_now=True, db_index=True, verbose_name="狀態更新時間")
+    create_time = models.DateTimeField(auto_now_add=True, verbose_name="存款建立時間")
+
+    def __str__(self):
+        return f"deposit id: {self.id}, wallet id: {self.account_id}, amount: {self.amount}, status: {self.status}"
+
+    class Meta:
+        db_table = 'deposit_tab'
+
+
+class DepositJob(models.Model):
+    """bank call and settlement of an accepted deposit, run by a `deposit_worker`"""
+    deposit = models.OneToOneField(Deposit, on_delete=models.CASCADE, related_name='job')
+    status = models.PositiveSmallIntegerField(default=1, verbose_name="工作狀態")
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="執行次數")
+    worker = models.CharField(max_length=64, blank=True, default='', verbose_name="執行者")
+    lease_time = models.DateTimeField(null=True, blank=True, verbose_name="租約到期時間")
+    error = models.CharField(max_length=200, blank=True, default='', verbose_name="錯誤訊息")
+    modified_time = models.DateTimeField(auto_now=True, verbose_name="狀態更新時間")
+    create_time = models.DateTimeField(auto_now_add=True, verbose_name="工作建立時間")
+
+    def __str__(self):
+        return f"deposit job id: {self.id}, deposit id: {self.deposit_id}, status: {self.status}"
+
+    class Meta:
+        db_table = 'deposit_job_tab'
+        indexes = [
+            # workers claim the oldest queued jobs
+            models.Index(fields=['status', 'id'], name='deposit_job_status_idx'),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    scope = models.CharField(max_length=32, verbose_name="API 範圍")
+    key = models.CharField(max_length=128, verbose_name="Idempotency-Key")
+    fingerprint = models.CharField(max_length=64, verbose_name="請求指紋")
+    status = models.PositiveSmallIntegerField(default=1, verbose_name="處理狀態")
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name="回應狀態碼")
+    response = models.TextField(blank=True, default='', verbose_name="回應內容")
+    expire_time = models.DateTimeField(db_index=True, verbose_name="到期時間")
+    create_time = models.DateTimeField(auto_now_add=True, verbose_name="建立時間")
+
+    def __str__(self):
+        return f"scope: {self.scope}, key: {self.key}, status: {self.status}"
+
+    class Meta:
+        db_table = 'idempotency_key_tab'
+        unique_together = [('scope', 'key')]
+
+
+class BalanceSnapshot(models.Model):
+    """wallet balance after all of its statements up to `last_statement_id`"""
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    previous = models.OneToOneField('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='next')
+    last_statement_id = models.IntegerField(verbose_name="最後交易紀錄編號")
+    balance = models.DecimalField(max_digits=18, decimal_places=2, verbose_name="快照餘額")
+    entries = models.PositiveIntegerField(verbose_name="距上次快照交易筆數")
+    status = models.PositiveSmallIntegerField(default=1, db_index=True, verbose_name="驗證狀態")
+    create_time = models.DateTimeField(auto_now_add=True, verbose_name="快照時間")
+    verify_time = models.DateTimeField(null=True, blank=True, verbose_name="驗證時間")
+
+    def __str__(self):
+        return f"wallet id: {self.account_id}, statement: {self.last_statement_id}, balance: {self.balance}"
+
+    class Meta:
+        db_table = 'balance_snapshot_tab'
+        unique_together = [('account', 'last_statement_id')]
+
+
+class LedgerCursor(models.Model):
+    """id of the last statement a ledger job (snapshots, daily rollup) has looked at"""
+    name = models.CharField(max_length=32, unique=True, verbose_name="工作名稱")
+    statement_id = models.IntegerField(default=0, verbose_name="交易紀錄編號")
+    modified_time = models.DateTimeField(auto_now=True, verbose_name="更新時間")
+
+    def __str__(self):
+        return f"{self.name}: {self.statement_id}"
+
+    class Meta:
+        db_table = 'ledger_cursor_tab'
+
+
+class DailyStatementSummary(models.Model):
+    """number and sum of a wallet's statements of one type on one day (UTC)"""
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    day = models.DateField(verbose_name="日期")
+    type = models.PositiveSmallIntegerField(verbose_name="交易類型")
+    count = models.PositiveIntegerField(default=0, verbose_name="交易筆數")
+    total = models.DecimalField(default=0, max_digits=18, decimal_places=2, verbose_name="交易金額合計")
+
+    def __str__(self):
+        return f"wallet id: {self.account_id}, day: {self.day}, type: {self.type}, count: {self.count}, total: {self.total}"
+
+    class Meta:
+        db_table = 'daily_statement_summary_tab'
+        # also the index of a wallet's report over a range of days
+        unique_together = [('account', 'day', 'type')]
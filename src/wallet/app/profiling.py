@@ -0,0 +1,195 @@
+import asyncio
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.local import Local
+from django.conf import settings
+from django.db import connection
+from django.utils.decorators import sync_and_async_middleware
+
+from . import metrics
+
+logger = logging.getLogger('default')
+
+DEFAULT_PROFILING = {
+    # add a Server-Timing header with the phase durations to every response
+    'SERVER_TIMING': True,
+    # fraction of (sync) requests run under cProfile, 0 to disable
+    'CPROFILE_SAMPLE_RATE': 0,
+    # a profiled request slower than this many seconds is dumped to CPROFILE_DIR
+    'CPROFILE_SLOW_SECONDS': 1,
+    # directory of the .prof dumps, None for BASE_DIR/profiles
+    'CPROFILE_DIR': None,
+}
+
+QUERY_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def profiling_settings():
+    config = dict(DEFAULT_PROFILING)
+    config.update(getattr(settings, 'WALLET_PROFILING', {}))
+    return config
+
+
+phase_seconds = metrics.histogram('wallet_phase_seconds', 'Time spent in timed service phases', ['phase'])
+request_seconds = metrics.histogram('wallet_request_seconds', 'Request duration', ['view'])
+request_db_seconds = metrics.histogram('wallet_request_db_seconds', 'Time spent in SQL queries per request', ['view'])
+request_queries = metrics.histogram('wallet_request_queries', 'SQL queries per request', ['view'], QUERY_BUCKETS)
+requests_in_flight = metrics.gauge('wallet_requests_in_flight', 'Requests being handled')
+
+_local = Local()
+_profiler_lock = threading.Lock()
+
+
+class RequestProfile:
+    """seconds spent per phase and SQL query count of one request"""
+    def __init__(self):
+        self.durations = {}
+        self.queries = 0
+        # the ORM threads of an async request add to the same profile
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.durations[phase] = self.durations.get(phase, 0) + seconds
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.queries += 1
+                self.durations['db'] = self.durations.get('db', 0) + elapsed
+
+    def server_timing(self, total):
+        items = []
+        for phase, seconds in sorted(self.durations.items()):
+            item = f'{phase};dur={seconds * 1000:.2f}'
+            if phase == 'db':
+                item += f';desc="{self.queries} queries"'
+            items.append(item)
+        items.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(items)
+
+
+def current():
+    """profile of the request being handled by this thread or task, None outside of a request"""
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def activate(profile):
+    """make `profile` current and count the SQL queries run on this thread's connection into it"""
+    previous = current()
+    _local.profile = profile
+    try:
+        if profile is None:
+            yield profile
+        else:
+            with connection.execute_wrapper(profile.execute_wrapper):
+                yield profile
+    finally:
+        _local.profile = previous
+
+
+@contextmanager
+def timed(phase):
+    """
+    Service-level timing API: add the duration of the block to `phase` of the current request.
+
+        with profiling.timed('bank'):
+            BankApiClient.instance().get()
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        profile = current()
+        if profile is not None:
+            profile.add(phase, elapsed)
+        phase_seconds.observe(elapsed, phase=phase)
+
+
+def sampled_profiler(config):
+    """a cProfile profiler for a sampled request, at most one request is profiled at a time"""
+    rate = config['CPROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate and _profiler_lock.acquire(blocking=False):
+        return cProfile.Profile()
+    return None
+
+
+def finish(request, response, profile, total, config, profiler=None):
+    match = getattr(request, 'resolver_match', None)
+    view = match.view_name if match else 'unmatched'
+    request_seconds.observe(total, view=view)
+    request_db_seconds.observe(profile.durations.get('db', 0), view=view)
+    request_queries.observe(profile.queries, view=view)
+    if config['SERVER_TIMING']:
+        response['Server-Timing'] = profile.server_timing(total)
+    if profiler is not None:
+        try:
+            if total >= config['CPROFILE_SLOW_SECONDS']:
+                directory = config['CPROFILE_DIR'] or os.path.join(settings.BASE_DIR, 'profiles')
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{view.replace(':', '_')}-"
+                                               f"{int(total * 1000)}ms.prof")
+                profiler.dump_stats(path)
+                logger.info('Slow request %s %s took %.3fs, profile saved to %s', request.method, request.path,
+                            total, path)
+        finally:
+            _profiler_lock.release()
+
+
+@sync_and_async_middleware
+def ProfilingMiddleware(get_response):
+    """
+    Time every request: SQL query count and time, plus the phases services report through `timed`
+    (bank call, atomic blocks, serialization). Results go to the Server-Timing header and the
+    Prometheus metrics; sampled sync requests can be run under cProfile.
+    """
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            config = profiling_settings()
+            profile = RequestProfile()
+            start = time.perf_counter()
+            requests_in_flight.inc()
+            try:
+                with activate(profile):
+                    response = await get_response(request)
+            finally:
+                requests_in_flight.dec()
+            finish(request, response, profile, time.perf_counter() - start, config)
+            return response
+    else:
+        def middleware(request):
+            config = profiling_settings()
+            profile = RequestProfile()
+            profiler = sampled_profiler(config)
+            start = time.perf_counter()
+            requests_in_flight.inc()
+            try:
+                with activate(profile):
+                    if profiler is not None:
+                        profiler.enable()
+                    try:
+                        response = get_response(request)
+                    finally:
+                        if profiler is not None:
+                            profiler.disable()
+            except BaseException:
+                if profiler is not None:
+                    _profiler_lock.release()
+                raise
+            finally:
+                requests_in_flight.dec()
+            finish(request, response, profile, time.perf_counter() - start, config, profiler)
+            return response
+    return middleware
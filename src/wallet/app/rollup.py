@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from datetime import datetime, time
+
+from django.db import transaction
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .ledger import LedgerService, ledger_settings
+from .models import DailyStatementSummary, LedgerCursor, Statement
+from .services import TransactionType
+
+
+class DailyRollupService:
+    """
+    Per-wallet, per-day (UTC) count and sum of statements by transaction type, kept in
+    `daily_statement_summary_tab` and rolled up incrementally from the statements appended since the last run,
+    so a report reads one row per day and type instead of every statement.
+    """
+    CURSOR = 'daily_rollup'
+    BATCH_SIZE = 500
+
+    @staticmethod
+    def aggregate(statements):
+        return list(statements.annotate(day=TruncDate('create_time')).order_by()
+                    .values('account_id', 'day', 'type').annotate(count=Count('id'), total=Sum('amount')))
+
+    @classmethod
+    def merge(cls, groups):
+        """add aggregated statement groups to the summary rows, creating the missing ones"""
+        for start in range(0, len(groups), cls.BATCH_SIZE):
+            batch = groups[start:start + cls.BATCH_SIZE]
+            existing = {(row.account_id, row.day, row.type): row for row in DailyStatementSummary.objects.filter(
+                account_id__in={group['account_id'] for group in batch}, day__in={group['day'] for group in batch})}
+            updated, created = [], []
+            for group in batch:
+                row = existing.get((group['account_id'], group['day'], group['type']))
+                if row is None:
+                    created.append(DailyStatementSummary(account_id=group['account_id'], day=group['day'],
+                                                         type=group['type'], count=group['count'],
+                                                         total=group['total']))
+                else:
+                    row.count += group['count']
+                    row.total += group['total']
+                    updated.append(row)
+            DailyStatementSummary.objects.bulk_update(updated, ['count', 'total'])
+            DailyStatementSummary.objects.bulk_create(created)
+
+    @classmethod
+    def lock_cursor(cls):
+        # the cursor row lock serializes roll ups and backfills, the only writers of the summary rows
+        cursor, _ = LedgerCursor.objects.select_for_update().get_or_create(name=cls.CURSOR)
+        return cursor
+
+    @classmethod
+    def roll_up(cls, max_statements=100000):
+        """add the statements appended since the last run (up to `max_statements` ids) to the summaries"""
+        with transaction.atomic():
+            cursor = cls.lock_cursor()
+            horizon = min(LedgerService.horizon(ledger_settings()['SETTLE_LAG']), cursor.statement_id + max_statements)
+            if horizon <= cursor.statement_id:
+                return dict(groups=0, cursor=cursor.statement_id)
+            groups = cls.aggregate(Statement.objects.filter(id__gt=cursor.statement_id, id__lte=horizon))
+            cls.merge(groups)
+            cursor.statement_id = horizon
+            cursor.save(update_fields=['statement_id', 'modified_time'])
+        return dict(groups=len(groups), cursor=horizon)
+
+    @classmethod
+    def backfill(cls, since=None, until=None, chunk_size=100000):
+        """
+        Rebuild the summaries of the days from `since` to `until` (all days by default) from the
+        statements. A full backfill also moves the cursor, so later roll ups continue after it.
+        """
+        with transaction.atomic():
+            cursor = cls.lock_cursor()
+            if since is None and until is None:
+                cursor.statement_id = LedgerService.horizon(ledger_settings()['SETTLE_LAG'])
+                cursor.save(update_fields=['statement_id', 'modified_time'])
+
+            statements = Statement.objects.filter(id__lte=cursor.statement_id)
+            summaries = DailyStatementSummary.objects.all()
+            if since is not None:
+                statements = statements.filter(create_time__gte=timezone.make_aware(datetime.combine(since, time.min)))
+                summaries = summaries.filter(day__gte=since)
+            if until is not None:
+                statements = statements.filter(create_time__lte=timezone.make_aware(datetime.combine(until, time.max)))
+                summaries = summaries.filter(day__lte=until)
+            summaries.delete()
+
+            bounds = statements.aggregate(first=Min('id'), last=Max('id'))
+            groups = 0
+            if bounds['first'] is not None:
+                for low in range(bounds['first'] - 1, bounds['last'], chunk_size):
+                    chunk = cls.aggregate(statements.filter(id__gt=low, id__lte=low + chunk_size))
+                    cls.merge(chunk)
+                    groups += len(chunk)
+        return dict(groups=groups, cursor=cursor.statement_id)
+
+    @classmethod
+    def report(cls, account_id, since, until):
+        """daily deposit and transfer count and sum of a wallet, one entry per day with statements"""
+        rows = (DailyStatementSummary.objects.filter(account_id=account_id, day__gte=since, day__lte=until)
+                .order_by('day', 'type').values_list('day', 'type', 'count', 'total'))
+        days = OrderedDict()
+        for day, type, count, total in rows:
+            entry = days.setdefault(day, OrderedDict(
+                [('day', day)] + [(t.name.lower(), dict(count=0, total=0)) for t in TransactionType]))
+            entry[TransactionType(type).name.lower()] = dict(count=count, total=total)
+        # statements created after this time may not be in the report yet
+        cursor = LedgerCursor.objects.filter(name=cls.CURSOR).values_list('statement_id', flat=True).first()
+        rolled_up_to = Statement.objects.filter(id=cursor).values_list('create_time', flat=True).first()
+        return dict(error=0, days=list(days.values()), rolled_up_to=rolled_up_to)
@@ -0,0 +1,230 @@
+import functools
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.local import Local
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import metrics
+from .cache import LRUCache
+from .models import Statement
+
+logger = logging.getLogger('default')
+
+DEFAULT_REPLICAS = {
+    # aliases in settings.DATABASES of the read replicas of the default database
+    'DATABASES': [],
+    # models whose reads in a read path (`replica_reads`) may be served by a replica
+    'MODELS': ['app.Account', 'app.Statement', 'app.BalanceShard', 'app.DailyStatementSummary'],
+    # read-your-writes: reads of a wallet stay on the primary this many seconds after it was written
+    'STICKY_SECONDS': 5,
+    # a replica further behind the primary than this many seconds is not read from
+    'MAX_LAG': 2,
+    # seconds a replica's measured lag is reused before it is measured again
+    'LAG_CHECK_INTERVAL': 1,
+    # alias of a django cache shared by all processes for the sticky wallets, None to only track them locally
+    'SHARED_BACKEND': None,
+    # max number of sticky wallets tracked locally
+    'MAX_STICKY': 100000,
+}
+
+
+def replica_settings():
+    config = dict(DEFAULT_REPLICAS)
+    config.update(getattr(settings, 'WALLET_REPLICAS', {}))
+    return config
+
+
+replica_lag = metrics.gauge('wallet_replica_lag_seconds', 'Last measured lag of a read replica', ['database'])
+primary_fallbacks = metrics.counter('wallet_replica_fallbacks_total', 'Replica read paths served by the primary',
+                                    ['reason'])
+
+_local = Local()
+
+
+def current():
+    """database the reads of the current read path go to, None outside of one"""
+    return getattr(_local, 'database', None)
+
+
+@contextmanager
+def activate(database):
+    previous = current()
+    _local.database = database
+    try:
+        yield database
+    finally:
+        _local.database = previous
+
+
+class Replicas:
+    """
+    Chooses the database of a read path: a replica that is not lagging, unless one of the wallets it
+    reads was written within STICKY_SECONDS, so a client always reads its own deposits and transfers.
+    """
+    _sticky = None
+    _lags = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def sticky(cls):
+        if cls._sticky is None:
+            with cls._lock:
+                if cls._sticky is None:
+                    config = replica_settings()
+                    cls._sticky = LRUCache(config['MAX_STICKY'], config['STICKY_SECONDS'])
+        return cls._sticky
+
+    @classmethod
+    def shared(cls):
+        alias = replica_settings()['SHARED_BACKEND']
+        return caches[alias] if alias else None
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._sticky = None
+            cls._lags = {}
+
+    @staticmethod
+    def key(wallet_id):
+        return f'wallet:sticky:{wallet_id}'
+
+    @classmethod
+    def stick(cls, wallet_ids):
+        config = replica_settings()
+        if not config['DATABASES']:
+            return
+        for wallet_id in wallet_ids:
+            cls.sticky().set(wallet_id, True)
+        shared = cls.shared()
+        if shared is not None:
+            shared.set_many({cls.key(wallet_id): True for wallet_id in wallet_ids}, timeout=config['STICKY_SECONDS'])
+
+    @classmethod
+    def stick_on_commit(cls, wallet_ids):
+        """keep the reads of the written wallets on the primary once the current transaction commits"""
+        wallet_ids = list(wallet_ids)
+        transaction.on_commit(lambda: cls.stick(wallet_ids))
+
+    @classmethod
+    def is_sticky(cls, wallet_ids):
+        if any(cls.sticky().get(wallet_id) for wallet_id in wallet_ids):
+            return True
+        shared = cls.shared()
+        return shared is not None and bool(shared.get_many([cls.key(wallet_id) for wallet_id in wallet_ids]))
+
+    @classmethod
+    def measure_lag(cls, database):
+        """
+        Seconds since the primary wrote the oldest statement the replica does not have yet, 0 when
+        it has them all. Statements are the wallet's write stream, so this works for any backend.
+        """
+        newest = Statement.objects.using(database).order_by('-id').values_list('id', flat=True).first() or 0
+        missing = (Statement.objects.using(DEFAULT_DB_ALIAS).filter(id__gt=newest).order_by('id')
+                   .values_list('create_time', flat=True).first())
+        if missing is None:
+            return 0
+        return max((timezone.now() - missing).total_seconds(), 0)
+
+    @classmethod
+    def lag(cls, database):
+        """lag of a replica, measured at most once per LAG_CHECK_INTERVAL; None if it cannot be reached"""
+        config = replica_settings()
+        checked = cls._lags.get(database)
+        if checked is not None and time.monotonic() - checked[0] < config['LAG_CHECK_INTERVAL']:
+            return checked[1]
+        try:
+            lag = cls.measure_lag(database)
+        except DatabaseError as e:
+            logger.error('Replica %s is unavailable: %s', database, e)
+            lag = None
+        cls._lags[database] = (time.monotonic(), lag)
+        replica_lag.set(-1 if lag is None else lag, database=database)
+        return lag
+
+    @classmethod
+    def choose(cls, wallet_ids=()):
+        """the database a read path reading `wallet_ids` should use"""
+        config = replica_settings()
+        if not config['DATABASES']:
+            return DEFAULT_DB_ALIAS
+        if wallet_ids and cls.is_sticky(wallet_ids):
+            primary_fallbacks.inc(reason='sticky')
+            return DEFAULT_DB_ALIAS
+        lags = {database: cls.lag(database) for database in config['DATABASES']}
+        healthy = [database for database, lag in lags.items() if lag is not None and lag <= config['MAX_LAG']]
+        if not healthy:
+            primary_fallbacks.inc(reason='lag' if any(lag is not None for lag in lags.values()) else 'unavailable')
+            return DEFAULT_DB_ALIAS
+        return random.choice(healthy)
+
+
+@contextmanager
+def replica_reads(*wallet_ids):
+    """
+    Serve the statement and account reads of the block from a replica, see `Replicas.choose`.
+
+        with replica_reads(account_id):
+            StatementService.query(account_id)
+    """
+    with activate(Replicas.choose(wallet_ids)) as database:
+        yield database
+
+
+def reads_from_replica(view):
+    """view decorator: `replica_reads` of the wallet in the `account_id` url argument, if any"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        wallet_ids = [kwargs['account_id']] if kwargs.get('account_id') is not None else []
+        with replica_reads(*wallet_ids):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def stream(iterable, database):
+    """iterate `iterable` with its reads on `database`, for responses streamed after the view returned"""
+    iterator = iter(iterable)
+    while True:
+        with activate(database):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class ReplicaRouter:
+    """
+    DATABASE_ROUTERS entry: inside a read path the reads of the MODELS go to the database it chose.
+    Everything else, all writes, select_for_update and reads inside a transaction on the primary,
+    stays on the default database.
+    """
+    def db_for_read(self, model, **hints):
+        database = current()
+        if database is None or database == DEFAULT_DB_ALIAS:
+            return None
+        if model._meta.label not in replica_settings()['MODELS'] or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return database
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+
+@receiver(setting_changed)
+def reset_replicas(sender, setting, **kwargs):
+    if setting == 'WALLET_REPLICAS':
+        Replicas.reset()
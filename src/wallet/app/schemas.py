@@ -0,0 +1,153 @@
+import json
+import re
+from decimal import Decimal, InvalidOperation
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+INTEGER_RE = re.compile(r'\s*[+-]?\d+\s*\Z')
+
+
+class Integer:
+    def __init__(self, min_value=None):
+        self.min_value = min_value
+
+    def __call__(self, value):
+        if isinstance(value, bool):
+            raise ValueError('enter a whole number')
+        if isinstance(value, int):
+            number = value
+        elif isinstance(value, str) and INTEGER_RE.match(value):
+            number = int(value)
+        elif isinstance(value, Decimal) and value.is_finite() and value == value.to_integral_value():
+            number = int(value)
+        else:
+            raise ValueError('enter a whole number')
+        if self.min_value is not None and number < self.min_value:
+            raise ValueError(f'ensure this value is greater than or equal to {self.min_value}')
+        return number
+
+
+class Amount:
+    """positive Decimal of at most `max_digits` digits, `decimal_places` of them after the point"""
+    def __init__(self, max_digits=18, decimal_places=2):
+        self.max_digits = max_digits
+        self.decimal_places = decimal_places
+        self.max_whole_digits = max_digits - decimal_places
+
+    def __call__(self, value):
+        if isinstance(value, Decimal):
+            amount = value
+        elif isinstance(value, (int, str)) and not isinstance(value, bool):
+            try:
+                amount = Decimal(str(value).strip())
+            except InvalidOperation:
+                raise ValueError('enter a number')
+        else:
+            raise ValueError('enter a number')
+        if not amount.is_finite():
+            raise ValueError('enter a number')
+
+        # the digit counting of django's DecimalValidator
+        _, digit_tuple, exponent = amount.as_tuple()
+        if exponent >= 0:
+            digits, decimals = len(digit_tuple) + exponent, 0
+        else:
+            decimals = -exponent
+            digits = max(len(digit_tuple), decimals)
+        if digits > self.max_digits or decimals > self.decimal_places or digits - decimals > self.max_whole_digits:
+            raise ValueError(f'ensure there are at most {self.max_digits} digits, {self.decimal_places} decimal places')
+        if amount <= 0:
+            raise ValueError('invalid amount')
+        return amount
+
+
+class String:
+    def __init__(self, max_length):
+        self.max_length = max_length
+
+    def __call__(self, value):
+        if not isinstance(value, (str, int)) or isinstance(value, bool):
+            raise ValueError('enter a text')
+        value = str(value).strip()
+        if not value:
+            raise ValueError('this field is required')
+        if len(value) > self.max_length:
+            raise ValueError(f'ensure this value has at most {self.max_length} characters')
+        return value
+
+
+class List:
+    """non-empty list whose items are all checked by the `item` validator"""
+    def __init__(self, item):
+        self.item = item
+
+    def __call__(self, value):
+        if not isinstance(value, list) or not value:
+            raise ValueError('enter a non-empty list')
+        items = []
+        for index, item in enumerate(value):
+            try:
+                items.append(self.item(item))
+            except ValueError as e:
+                raise ValueError(f'item {index}: {e}')
+        return items
+
+
+class Schema:
+    """
+    Lightweight request schema of the JSON wallet apis: the body bytes are decoded by `json.loads`
+    (numbers with a fraction become Decimal) and every field is checked by its validator.
+
+        DepositSchema.load(request.body)  ->  {'wallet_id': 1, 'amount': Decimal('12.34')}
+    """
+    class InvalidBodyError(Exception):
+        """請求內容不是 JSON 物件"""
+    class ValidationError(Exception):
+        """請求欄位驗證失敗"""
+        def __init__(self, errors):
+            super().__init__(errors)
+            self.errors = errors
+
+    def __init__(self, **fields):
+        self.fields = tuple(fields.items())
+
+    def load(self, body):
+        try:
+            data = json.loads(body, parse_float=Decimal)
+        except ValueError as e:
+            raise Schema.InvalidBodyError(e)
+        return self.validate(data)
+
+    def validate(self, data):
+        if not isinstance(data, dict):
+            raise Schema.InvalidBodyError('body must be a JSON object')
+        cleaned, errors = {}, {}
+        for name, field in self.fields:
+            value = data.get(name)
+            if value is None or value == '':
+                errors[name] = 'this field is required'
+                continue
+            try:
+                cleaned[name] = field(value)
+            except ValueError as e:
+                errors[name] = str(e)
+        if errors:
+            raise Schema.ValidationError(errors)
+        return cleaned
+
+
+CreateWalletSchema = Schema(name=String(max_length=200))
+BulkCreateWalletSchema = Schema(names=List(String(max_length=200)))
+DepositSchema = Schema(wallet_id=Integer(), amount=Amount())
+TransferSchema = Schema(from_wallet_id=Integer(), to_wallet_id=Integer(), amount=Amount())
+
+
+class WalletJSONEncoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder with compact separators that checks for Decimal, the common case, first"""
+    item_separator = ','
+    key_separator = ':'
+
+    def default(self, o):
+        if type(o) is Decimal:
+            return str(o)
+        return super().default(o)
@@ -0,0 +1,325 @@
+import base64
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+from .models import Account
+
+logger = logging.getLogger('default')
+
+DEFAULT_ACCOUNT_INDEX = {
+    # seconds a search reuses the index before reading the wallets created since its last refresh
+    'REFRESH_INTERVAL': 5,
+    # a refresh re-reads the wallets created this many seconds before the newest one it saw, for
+    # transactions that committed after a later one
+    'REFRESH_OVERLAP': 60,
+    # seconds after which the index is rebuilt from scratch, which drops the deleted wallets and applies renames
+    'REBUILD_INTERVAL': 3600,
+    # every wallet added by a refresh shifts the sorted arrays, so a refresh finding more new wallets
+    # than this fraction of the index (and at least REBUILD_MIN_ROWS), e.g. after a bulk import, rebuilds it
+    'REBUILD_FRACTION': 0.05,
+    'REBUILD_MIN_ROWS': 1000,
+    # wallets read per query while building or refreshing
+    'CHUNK_SIZE': 10000,
+    # default and max number of wallets in one page of search results
+    'PAGE_SIZE': 20,
+    'PAGE_SIZE_MAX': 100,
+}
+
+
+def account_index_settings():
+    config = dict(DEFAULT_ACCOUNT_INDEX)
+    config.update(getattr(settings, 'WALLET_ACCOUNT_INDEX', {}))
+    return config
+
+
+index_size = metrics.gauge('wallet_account_index_size', 'Wallets in the in-process account index')
+refresh_seconds = metrics.histogram('wallet_account_index_refresh_seconds', 'Duration of an account index refresh',
+                                    ['kind'])
+
+
+class AccountIndex:
+    """
+    In-process prefix index over the wallet names and ids, so picking a wallet never loads the
+    account table. Names are kept as case-folded keys in one sorted list with the wallet ids in a
+    parallel array; ids are kept in a sorted array with their keys alongside. A prefix is a bisect
+    of either, and the index is refreshed from the wallets created since the last refresh. A server
+    process keeps it refreshed from a background thread (`start_refresher`), so searches do not wait
+    for the account table.
+    """
+    class InvalidCursorError(Exception):
+        """分頁游標錯誤"""
+
+    _instance = None
+    _lock = threading.Lock()
+    _refresher_pid = None
+
+    def __init__(self):
+        self.keys, self.key_ids = [], array('q')
+        self.ids, self.id_keys = array('q'), []
+        # wallets above `since_id` are read by the next refresh, `newest` is the latest create_time seen
+        self.since_id = self.newest = None
+        self.refreshed = self.built = None
+        # held while the arrays are read or changed, and by the one thread reading the modified wallets
+        self._lock = threading.RLock()
+        self._refreshing = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = AccountIndex()
+        return cls._instance
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._instance = None
+
+    @staticmethod
+    def key(name):
+        return name.casefold()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def start_refresher(cls):
+        """build the index of this process and refresh it every REFRESH_INTERVAL seconds in a background thread"""
+        with cls._lock:
+            if cls._refresher_pid == os.getpid():
+                return
+            cls._refresher_pid = os.getpid()
+        threading.Thread(target=cls._refresh_forever, args=(account_index_settings()['REFRESH_INTERVAL'],),
+                         name='account-index-refresher', daemon=True).start()
+
+    @classmethod
+    def _refresh_forever(cls, interval):
+        from django.db import connection
+        while True:
+            try:
+                cls.instance().refresh(force=True)
+            except Exception as e:
+                logger.error("Error: <%s>", e)
+            finally:
+                connection.close()
+            time.sleep(interval)
+
+    def fresh(self, config):
+        return self.refreshed is not None and time.monotonic() - self.refreshed < config['REFRESH_INTERVAL']
+
+    def refresh(self, force=False):
+        """rebuild the index when it is due, otherwise apply the wallets created since the last refresh"""
+        config = account_index_settings()
+        if not force and self.fresh(config):
+            return
+        # once the index is built, searches go on with it while another thread refreshes it
+        if not self._refreshing.acquire(blocking=force or self.built is None):
+            return
+        try:
+            if not force and self.fresh(config):
+                return
+            now = time.monotonic()
+            start = time.perf_counter()
+            kind = 'update'
+            if self.built is None or now - self.built >= config['REBUILD_INTERVAL'] or not self.update(config):
+                kind = 'build'
+                self.build(config['CHUNK_SIZE'])
+                self.built = now
+            self.refreshed = now
+            index_size.set(len(self.ids))
+            refresh_seconds.observe(time.perf_counter() - start, kind=kind)
+        finally:
+            self._refreshing.release()
+
+    def update(self, config):
+        """
+        Apply the wallets created since the last refresh, False when there are so many that a build is cheaper.
+        Only names are indexed, so wallets are found by id: balance writes, which bump `modified_time` on
+        every active wallet, cost a refresh nothing. Renames wait for the next rebuild.
+        """
+        wallets = Account.objects.order_by('id')
+        if self.since_id is not None:
+            wallets = wallets.filter(id__gt=self.since_id)
+        limit = max(config['REBUILD_MIN_ROWS'], int(len(self) * config['REBUILD_FRACTION']))
+        rows = list(wallets.values_list('id', 'name', 'create_time')[:limit + 1])
+        if len(rows) > limit:
+            return False
+        with self._lock:
+            for wallet_id, name, _ in rows:
+                self.put(wallet_id, name)
+            created = ((wallet_id, create_time) for wallet_id, _, create_time in rows)
+            self.since_id, self.newest = self.advance(created, self.since_id, self.newest, config['REFRESH_OVERLAP'])
+        return True
+
+    @staticmethod
+    def advance(rows, since_id, newest, overlap):
+        """
+        (since_id, newest) after reading the (id, create_time) `rows`: `since_id` moves past the wallets
+        read, except those created within `overlap` seconds of the newest one.
+        """
+        overlap = timedelta(seconds=overlap)
+        recent = []
+        for wallet_id, create_time in rows:
+            newest = create_time if newest is None else max(newest, create_time)
+            heapq.heappush(recent, (create_time, wallet_id))
+            while recent and recent[0][0] < newest - overlap:
+                since_id = max(since_id or 0, heapq.heappop(recent)[1])
+        return since_id or 0, newest
+
+    def build(self, chunk_size):
+        """read all wallets into new arrays and swap them in, searches use the old ones meanwhile"""
+        entries = []
+        ids, id_keys = array('q'), []
+
+        def read():
+            for wallet_id, name, create_time in (Account.objects.order_by('id')
+                                                 .values_list('id', 'name', 'create_time')
+                                                 .iterator(chunk_size=chunk_size)):
+                key = self.key(name)
+                ids.append(wallet_id)
+                id_keys.append(key)
+                entries.append((key, wallet_id))
+                yield wallet_id, create_time
+        since_id, newest = self.advance(read(), None, None, account_index_settings()['REFRESH_OVERLAP'])
+        entries.sort()
+        keys = [key for key, _ in entries]
+        key_ids = array('q', (wallet_id for _, wallet_id in entries))
+        with self._lock:
+            self.keys, self.key_ids = keys, key_ids
+            self.ids, self.id_keys = ids, id_keys
+            self.since_id, self.newest = since_id, newest
+
+    def key_position(self, key, wallet_id, right=False):
+        """position of (key, wallet_id) in the name order, after it with `right`"""
+        low, high = bisect_left(self.keys, key), bisect_right(self.keys, key)
+        return (bisect_right if right else bisect_left)(self.key_ids, wallet_id, low, high)
+
+    def put(self, wallet_id, name):
+        key = self.key(name)
+        position = bisect_left(self.ids, wallet_id)
+        if position < len(self.ids) and self.ids[position] == wallet_id:
+            if self.id_keys[position] == key:
+                return
+            self.remove_key(self.id_keys[position], wallet_id)
+            self.id_keys[position] = key
+        else:
+            self.ids.insert(position, wallet_id)
+            self.id_keys.insert(position, key)
+        position = self.key_position(key, wallet_id)
+        self.keys.insert(position, key)
+        self.key_ids.insert(position, wallet_id)
+
+    def remove_key(self, key, wallet_id):
+        position = self.key_position(key, wallet_id)
+        if position < len(self.keys) and self.key_ids[position] == wallet_id and self.keys[position] == key:
+            del self.keys[position]
+            del self.key_ids[position]
+
+    def remove(self, wallet_ids):
+        with self._lock:
+            for wallet_id in wallet_ids:
+                position = bisect_left(self.ids, wallet_id)
+                if position < len(self.ids) and self.ids[position] == wallet_id:
+                    self.remove_key(self.id_keys[position], wallet_id)
+                    del self.ids[position]
+                    del self.id_keys[position]
+            index_size.set(len(self.ids))
+
+    def match_names(self, prefix, after, count):
+        """ids of up to `count` wallets whose name starts with `prefix`, in (name, id) order after `after`"""
+        key = self.key(prefix)
+        position = bisect_left(self.keys, key)
+        if after is not None:
+            position = max(position, self.key_position(*after, right=True))
+        matches = []
+        while position < len(self.keys) and len(matches) < count and self.keys[position].startswith(key):
+            matches.append((self.keys[position], self.key_ids[position]))
+            position += 1
+        return matches
+
+    def match_ids(self, prefix, after, count):
+        """up to `count` ids whose decimal digits start with `prefix`, ascending after `after`"""
+        if not self.ids:
+            return []
+        matches, low, high = [], int(prefix), int(prefix) + 1
+        while low <= self.ids[-1] and len(matches) < count:
+            position = bisect_left(self.ids, max(low, (after or 0) + 1))
+            while position < len(self.ids) and self.ids[position] < high and len(matches) < count:
+                matches.append((self.id_keys[position], self.ids[position]))
+                position += 1
+            if prefix == '0':
+                break
+            low, high = low * 10, high * 10
+        return matches
+
+    @staticmethod
+    def encode_cursor(field, key, wallet_id):
+        position = json.dumps([field, key, wallet_id])
+        return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+    @classmethod
+    def decode_cursor(cls, field, cursor):
+        try:
+            cursor_field, key, wallet_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            if cursor_field != field or not isinstance(key, str) or not isinstance(wallet_id, int):
+                raise ValueError(cursor)
+            return key, wallet_id
+        except (ValueError, TypeError, UnicodeError) as e:
+            raise AccountIndex.InvalidCursorError(f"[InvalidCursorError] {e}")
+
+    @classmethod
+    def search(cls, q='', field=None, limit=None, cursor=None):
+        """
+        One page of the wallets whose name (case-insensitive) or id starts with `q`, by name then id,
+        or by id when searching ids. `field` is 'name' or 'id'; by default a query of digits searches
+        ids. The page's id, name and balance are read from the database with one query.
+        """
+        config = account_index_settings()
+        limit = min(limit or config['PAGE_SIZE'], config['PAGE_SIZE_MAX'])
+        q = q.strip()
+        field = field or ('id' if q.isdigit() else 'name')
+        if field == 'id' and not q.isdigit():
+            return dict(error=0, wallets=[], next_cursor=None)
+        after = cls.decode_cursor(field, cursor) if cursor else None
+
+        if cls._refresher_pid not in (None, os.getpid()):
+            # forked from a process that started its refresher, e.g. by gunicorn --preload
+            cls.start_refresher()
+        index = cls.instance()
+        if cls._refresher_pid is None or index.built is None:
+            index.refresh()
+        with index._lock:
+            if field == 'id':
+                matches = index.match_ids(q.lstrip('0') or '0', after[1] if after else None, limit + 1)
+            else:
+                matches = index.match_names(q, after, limit + 1)
+        next_cursor = cls.encode_cursor(field, *matches[limit - 1]) if len(matches) > limit else None
+
+        page = [wallet_id for _, wallet_id in matches[:limit]]
+        rows = {row[0]: row for row in Account.objects.filter(id__in=page).values_list('id', 'name', 'balance')}
+        missing = [wallet_id for wallet_id in page if wallet_id not in rows]
+        if missing:
+            # deleted since the last rebuild
+            index.remove(missing)
+        wallets = [dict(id=wallet_id, name=rows[wallet_id][1], balance=rows[wallet_id][2])
+                   for wallet_id in page if wallet_id in rows]
+        return dict(error=0, wallets=wallets, next_cursor=next_cursor)
+
+
+@receiver(setting_changed)
+def reset_account_index(sender, setting, **kwargs):
+    if setting == 'WALLET_ACCOUNT_INDEX':
+        AccountIndex.reset()
@@ -1,20 +1,105 @@
+import asyncio
+import base64
+import functools
+import itertools
+import json
+import httpx
 import requests
 import logging
+import queue
+import random
+import threading
+import time
 
-from django.db import transaction
-from django.db.models import F
-from .models import Account
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import OperationalError, close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.dispatch import receiver
+from . import log, metrics, profiling
+from .bank import AsyncBankApiClient, BankApiClient, CircuitBreaker
+from .cache import BalanceCache, LRUCache
+from .models import Account, BalanceShard, Deposit, DepositJob, Statement
+from .routers import Replicas
 from enum import IntEnum
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 logger = logging.getLogger('default')
 
+DEFAULT_GROUP_COMMIT = {
+    # settle confirmed deposits of wallets that are not sharded in group commits instead of one transaction each
+    'ENABLED': False,
+    # max number of deposits settled per transaction
+    'MAX_BATCH': 100,
+    # seconds a deposit waits for more deposits to join its batch
+    'MAX_DELAY': 0.005,
+    # seconds a caller waits for its batch to commit; the deposit stays confirmed and is settled later
+    'TIMEOUT': 10,
+}
+
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+DEFAULT_TRANSFER_PRECHECK = {
+    # reject transfers to the same wallet, to unknown wallets and without funds before taking row locks
+    'ENABLED': True,
+    # seconds a wallet id that does not exist is remembered, so repeated transfers to it skip the database
+    'MISSING_TTL': 5,
+    # max number of such wallet ids remembered
+    'MISSING_MAX_SIZE': 100000,
+}
+
+
+DEFAULT_CONCURRENCY = {
+    # 'pessimistic': transfers and deposits lock the account rows with SELECT ... FOR UPDATE
+    # 'optimistic': they read the rows without locks and write them with UPDATE ... WHERE version = <version read>
+    'ENGINE': 'pessimistic',
+    # optimistic attempts of an operation before it falls back to locking
+    'MAX_ATTEMPTS': 3,
+}
+
+
+def group_commit_settings():
+    config = dict(DEFAULT_GROUP_COMMIT)
+    config.update(getattr(settings, 'WALLET_GROUP_COMMIT', {}))
+    return config
+
+
+def transfer_precheck_settings():
+    config = dict(DEFAULT_TRANSFER_PRECHECK)
+    config.update(getattr(settings, 'WALLET_TRANSFER_PRECHECK', {}))
+    return config
+
+
+def concurrency_settings():
+    config = dict(DEFAULT_CONCURRENCY)
+    config.update(getattr(settings, 'WALLET_CONCURRENCY', {}))
+    return config
+
 
 class TransactionType(IntEnum):
     Deposit = 1
     Transfer = 2
 
 
+class DepositStatus(IntEnum):
+    Pending = 1     # intent recorded, bank not confirmed yet
+    Confirmed = 2   # bank deduction succeeded, balance not credited yet
+    Settled = 3     # balance credited and statement written
+    Failed = 4      # bank deduction failed
+    Review = 5      # the worker died during the bank call, whether the bank deducted is checked by hand
+
+
+class JobStatus(IntEnum):
+    Queued = 1      # accepted, waiting for a worker
+    Running = 2     # claimed by a worker until its lease expires
+    Done = 3        # deposit settled
+    Failed = 4      # deposit failed
+
+
 class CallBankApiService:
     class CallBankServiceError(Exception):
         """call bank api failed"""
@@ -24,18 +109,206 @@ class CallBankApiService:
     @classmethod
     def call_bank_api(cls):
         try:
-            response = requests.get("http://www.mocky.io/v2/5acadd1b2e00005600bbaa36?mocky-delay=3000ms")
-            logger.info('Call bank API response msg: %s', response)
-            response.raise_for_status()
-            response_dic = response.json()
+            with profiling.timed('bank'):
+                response_dic = BankApiClient.instance().get()
+            logger.info('Call bank API response msg: %s', response_dic)
+            error_code = response_dic['error']
+            if error_code != 0:
+                raise CallBankApiService.BankAccountError("[BankAccountError] Bank return value error")
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError,
+                CircuitBreaker.CircuitOpenError, CallBankApiService.BankAccountError) as e:
+            logger.error("Error: <%s>", e)
+            raise CallBankApiService.CallBankServiceError("[CallBankServiceError] Call bank service failed")
+
+    @classmethod
+    async def acall_bank_api(cls):
+        try:
+            with profiling.timed('bank'):
+                response_dic = await AsyncBankApiClient.instance().get()
+            logger.info('Call bank API response msg: %s', response_dic)
             error_code = response_dic['error']
             if error_code != 0:
                 raise CallBankApiService.BankAccountError("[BankAccountError] Bank return value error")
-        except (requests.exceptions.RequestException, CallBankApiService.BankAccountError) as e:
+        except (httpx.HTTPError, ValueError, KeyError, TypeError,
+                CircuitBreaker.CircuitOpenError, CallBankApiService.BankAccountError) as e:
             logger.error("Error: <%s>", e)
             raise CallBankApiService.CallBankServiceError("[CallBankServiceError] Call bank service failed")
 
 
+class OrmExecutor:
+    """
+    Bounded thread pool that async views use for ORM work, so the event loop never blocks on the
+    database and the number of concurrent DB connections stays at `WALLET_ORM_THREADS`.
+    """
+    _executor = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def executor(cls):
+        if cls._executor is None:
+            with cls._lock:
+                if cls._executor is None:
+                    cls._executor = ThreadPoolExecutor(max_workers=getattr(settings, 'WALLET_ORM_THREADS', 20),
+                                                       thread_name_prefix='orm')
+        return cls._executor
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            if cls._executor is not None:
+                cls._executor.shutdown(wait=True)
+            cls._executor = None
+
+    @staticmethod
+    def _call(profile, log_context, func, *args, **kwargs):
+        close_old_connections()
+        try:
+            with profiling.activate(profile), log.activate(log_context):
+                return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    @classmethod
+    async def run(cls, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        # executor threads do not inherit the request's context, hand its profile and log context over explicitly
+        call = functools.partial(cls._call, profiling.current(), log.context(), func, *args, **kwargs)
+        return await loop.run_in_executor(cls.executor(), call)
+
+
+class DeadlockRetry:
+    """
+    Re-run a transaction that the database aborted because of a deadlock or a lock wait timeout.
+    Only an outermost transaction can be retried; inside an outer atomic block the error is re-raised.
+    """
+    class RetryExhaustedError(Exception):
+        """交易鎖定衝突重試失敗"""
+
+    # ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK
+    MYSQL_LOCK_ERRORS = (1205, 1213)
+
+    retries = metrics.counter('wallet_lock_retries_total',
+                              'Transactions retried after a deadlock or lock wait timeout', ['operation'])
+    exhausted = metrics.counter('wallet_lock_retries_exhausted_total',
+                                'Transactions that still failed after all lock retries', ['operation'])
+
+    @classmethod
+    def is_lock_error(cls, e):
+        return (bool(e.args) and e.args[0] in cls.MYSQL_LOCK_ERRORS) or 'database is locked' in str(e)
+
+    @classmethod
+    def run(cls, operation, func, *args, **kwargs):
+        max_retries = getattr(settings, 'WALLET_LOCK_RETRIES', 3)
+        backoff = getattr(settings, 'WALLET_LOCK_RETRY_BACKOFF', 0.02)
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not cls.is_lock_error(e) or connection.in_atomic_block:
+                    raise
+                if attempt >= max_retries:
+                    cls.exhausted.inc(operation=operation)
+                    raise DeadlockRetry.RetryExhaustedError(f"[LockRetryExhausted] {operation}: {e}") from e
+                cls.retries.inc(operation=operation)
+                attempt += 1
+                logger.warning('%s hit a lock error <%s>, retry %s', operation, e, attempt)
+                time.sleep(random.uniform(0, backoff * (2 ** attempt)))
+
+
+class OptimisticRetry:
+    """
+    Run the optimistic version of an operation, again whenever one of its conditional writes finds that
+    the row changed since it was read, and the locking version once MAX_ATTEMPTS attempts conflicted.
+    Lock errors of each attempt are retried by DeadlockRetry.
+    """
+    class VersionConflictError(Exception):
+        """帳戶版本衝突"""
+
+    conflicts = metrics.counter('wallet_optimistic_conflicts_total',
+                                'Optimistic attempts that found a row changed since it was read', ['operation'])
+    fallbacks = metrics.counter('wallet_optimistic_fallbacks_total',
+                                'Optimistic operations that fell back to locking', ['operation'])
+
+    @classmethod
+    def enabled(cls):
+        return concurrency_settings()['ENGINE'] == 'optimistic'
+
+    @classmethod
+    def run(cls, operation, optimistic, fallback, *args, **kwargs):
+        max_attempts = concurrency_settings()['MAX_ATTEMPTS']
+        for _ in range(max_attempts):
+            try:
+                return DeadlockRetry.run(operation, optimistic, *args, **kwargs)
+            except OptimisticRetry.VersionConflictError as e:
+                cls.conflicts.inc(operation=operation)
+                logger.info('%s: %s', operation, e)
+        cls.fallbacks.inc(operation=operation)
+        logger.warning('%s conflicted %s times, falling back to locking', operation, max_attempts)
+        return DeadlockRetry.run(operation, fallback, *args, **kwargs)
+
+
+class TransferPrecheck:
+    """
+    Lock-free checks of a transfer before its transaction: wallets that do not exist (remembered for
+    MISSING_TTL seconds) and a source balance below the amount are rejected without a row lock, so invalid
+    requests cannot queue up behind the locks of busy wallets. The balance is read without a lock: a
+    transfer it rejects had no funds at that moment, one it lets through is checked again under the lock.
+    """
+    _missing = None
+    _lock = threading.Lock()
+
+    rejections = metrics.counter('wallet_transfer_rejections_total', 'Transfers rejected before taking locks',
+                                 ['reason'])
+
+    @classmethod
+    def missing(cls):
+        if cls._missing is None:
+            with cls._lock:
+                if cls._missing is None:
+                    config = transfer_precheck_settings()
+                    cls._missing = LRUCache(config['MISSING_MAX_SIZE'], config['MISSING_TTL'])
+        return cls._missing
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._missing = None
+
+    @classmethod
+    def forget_missing(cls, wallet_ids):
+        """wallets were just created, stop rejecting their ids"""
+        missing = cls.missing()
+        if len(missing):
+            for wallet_id in wallet_ids:
+                missing.delete(wallet_id)
+
+    @classmethod
+    def check(cls, from_wallet_id, to_wallet_id, amount):
+        if not transfer_precheck_settings()['ENABLED']:
+            return
+        missing = cls.missing()
+        if missing.get(from_wallet_id) or missing.get(to_wallet_id):
+            cls.rejections.inc(reason='missing_wallet')
+            raise Account.DoesNotExist("[AccountNotExist] Transfer wallet does not exist.")
+
+        rows = {wallet_id: (balance, shards) for wallet_id, balance, shards in Account.objects.filter(
+            id__in=[from_wallet_id, to_wallet_id]).values_list('id', 'balance', 'shards')}
+        unknown = [wallet_id for wallet_id in (from_wallet_id, to_wallet_id) if wallet_id not in rows]
+        if unknown:
+            for wallet_id in unknown:
+                missing.set(wallet_id, True)
+            cls.rejections.inc(reason='missing_wallet')
+            raise Account.DoesNotExist("[AccountNotExist] Transfer wallet does not exist.")
+        balance, shards = rows[from_wallet_id]
+        if shards:
+            # a hot wallet's aggregate moves with every deposit, only the locked path checks it exactly
+            return
+        if balance < amount:
+            cls.rejections.inc(reason='insufficient_balance')
+            raise WalletService.MoneyValueError("[MoneyInvalidError] Insufficient balance.")
+
+
 class WalletService:
     class InsufficientMoneyError(Exception):
         """餘額不足"""
@@ -50,61 +323,734 @@ class WalletService:
     def create_wallet(cls, name):
         account = Account(name=name)
         account.save()
+        TransferPrecheck.forget_missing([account.id])
+        # a replica may not have the new wallet yet
+        Replicas.stick([account.id])
         result_object = dict(error=0, wallet_id=account.id)
         return result_object
 
+    @classmethod
+    def create_wallets(cls, names, batch_size=None):
+        """create a wallet per name in `bulk_create` batches, the new wallet ids in the order of the names"""
+        wallet_ids = [wallet_id for batch in cls.create_wallet_batches(names, batch_size) for wallet_id in batch]
+        result_object = dict(error=0, wallet_ids=wallet_ids)
+        return result_object
+
+    @classmethod
+    def create_wallet_batches(cls, names, batch_size=None):
+        """
+        Create a wallet per name, `batch_size` names per transaction and multi-row INSERT, and yield the
+        ids of each batch in input order. `names` may be any iterable, e.g. the lines of a file; it is
+        read one batch at a time, so memory does not grow with the number of wallets.
+        """
+        batch_size = batch_size or settings.WALLET_CREATE_BATCH_SIZE
+        names = iter(names)
+        while True:
+            batch = [Account(name=name) for name in itertools.islice(names, batch_size)]
+            if not batch:
+                return
+            with profiling.timed('atomic'), transaction.atomic():
+                wallet_ids = cls.bulk_insert(Account, batch, batch_size=batch_size)
+            TransferPrecheck.forget_missing(wallet_ids)
+            Replicas.stick(wallet_ids)
+            yield wallet_ids
+
+    @classmethod
+    def bulk_insert(cls, model, rows, batch_size=None):
+        """`bulk_create` the rows of `model` in the current transaction, their ids in the order of the rows"""
+        if connection.features.can_return_rows_from_bulk_insert or connection.vendor in ('mysql', 'sqlite'):
+            model.objects.bulk_create(rows, batch_size=batch_size)
+            return cls.inserted_ids(rows)
+        # the ids of a multi-row INSERT cannot be told apart, insert one row at a time
+        for row in rows:
+            row.save(force_insert=True)
+        return [row.pk for row in rows]
+
+    @classmethod
+    def inserted_ids(cls, rows):
+        """
+        Ids of the rows just inserted by one `bulk_create` in the current transaction. `bulk_create` sets
+        them itself on backends that return rows from the INSERT. Other backends give the rows of a multi-row
+        INSERT consecutive auto increment values (InnoDB for "simple inserts" in every innodb_autoinc_lock_mode;
+        SQLite, whose open write transaction excludes other writers), so they follow from the first (MySQL) or
+        last (SQLite) id generated.
+        """
+        if connection.features.can_return_rows_from_bulk_insert:
+            return [row.pk for row in rows]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'mysql':
+                # ids are `auto_increment_increment` apart, e.g. on a multi-primary cluster
+                cursor.execute('SELECT LAST_INSERT_ID(), @@auto_increment_increment')
+                first, step = cursor.fetchone()
+            else:
+                cursor.execute('SELECT last_insert_rowid()')
+                first, step = cursor.fetchone()[0] - len(rows) + 1, 1
+        for offset, row in enumerate(rows):
+            row.pk = first + offset * step
+        return [row.pk for row in rows]
+
     @classmethod
     def deposit(cls, wallet_id, amount):
+        """
+        Deposit in three phases so that no DB transaction is held open during the bank round trip:
+            1. record a pending deposit intent (autocommit)
+            2. call the bank api with no transaction open, then mark the intent as confirmed
+            3. settle the balance and the statement in a short transaction
+        """
+        log.bind(wallet_ids=[wallet_id])
         try:
-            with transaction.atomic():
-                if amount <= 0:
-                    raise WalletService.MoneyValueError("[MoneyInvalidError] Deposit money error.")
+            if amount <= 0:
+                raise WalletService.MoneyValueError("[MoneyInvalidError] Deposit money error.")
 
+            deposit = cls.create_deposit_intent(wallet_id, amount)
+            try:
                 # call bank api to make deduction
                 CallBankApiService.call_bank_api()
+            except CallBankApiService.CallBankServiceError:
+                cls.mark_deposit(deposit.id, DepositStatus.Pending, DepositStatus.Failed)
+                raise
+            cls.mark_deposit(deposit.id, DepositStatus.Pending, DepositStatus.Confirmed)
 
-                Account.objects.filter(id=wallet_id).update(balance=F('balance') + amount, modified_time=timezone.now())
-                account = Account.objects.get(id=wallet_id)
-                account.statement_set.create(wallet_id=wallet_id, amount=amount,
-                                             balance_after_transaction=account.balance,
-                                             type=TransactionType.Deposit)
-                result_object = dict(error=0, new_balance=account.balance)
-                return result_object
+            return cls.settle_confirmed(deposit.id, shard=deposit.shard)
 
         except (Account.DoesNotExist, CallBankApiService.CallBankServiceError,
-                WalletService.MoneyValueError) as e:
+                WalletService.MoneyValueError, DeadlockRetry.RetryExhaustedError) as e:
             logger.error("Error: <%s>", e)
             raise WalletService.DepositError(e)
 
     @classmethod
-    def transfer(cls, from_wallet_id, to_wallet_id, amount):
+    async def adeposit(cls, wallet_id, amount):
+        """async `deposit`: awaits the bank on the async client and runs the DB phases on the ORM pool"""
+        log.bind(wallet_ids=[wallet_id])
         try:
-            with transaction.atomic():
-                if amount <= 0:
-                    raise WalletService.MoneyValueError("[MoneyInvalidError] Transfer money error.")
-
-                accounts = list(Account.objects.select_for_update().filter(id__in=[from_wallet_id, to_wallet_id]))
-                # check wallet_id to identify from_wallet and to_wallet
-                if accounts[0].id == from_wallet_id:
-                    from_wallet, to_wallet = accounts[0], accounts[1]
+            if amount <= 0:
+                raise WalletService.MoneyValueError("[MoneyInvalidError] Deposit money error.")
+
+            deposit = await OrmExecutor.run(cls.create_deposit_intent, wallet_id, amount)
+            try:
+                await CallBankApiService.acall_bank_api()
+            except CallBankApiService.CallBankServiceError:
+                await OrmExecutor.run(cls.mark_deposit, deposit.id, DepositStatus.Pending, DepositStatus.Failed)
+                raise
+            await OrmExecutor.run(cls.mark_deposit, deposit.id, DepositStatus.Pending, DepositStatus.Confirmed)
+
+            if deposit.shard is None and DepositBatcher.enabled():
+                return await DepositBatcher.asettle(deposit.id)
+            return await OrmExecutor.run(cls.settle_confirmed, deposit.id, shard=deposit.shard)
+
+        except (Account.DoesNotExist, CallBankApiService.CallBankServiceError,
+                WalletService.MoneyValueError, DeadlockRetry.RetryExhaustedError) as e:
+            logger.error("Error: <%s>", e)
+            raise WalletService.DepositError(e)
+
+    @classmethod
+    def settle_confirmed(cls, deposit_id, shard=None):
+        """settle a confirmed deposit with the configured engine: group commit, optimistic or row locks"""
+        if shard is None and DepositBatcher.enabled():
+            return DepositBatcher.settle(deposit_id)
+        if shard is None and OptimisticRetry.enabled():
+            return OptimisticRetry.run('deposit', cls.settle_deposit_optimistic, cls.settle_deposit, deposit_id)
+        # settling is idempotent, so a transaction aborted by a lock error is safe to run again
+        return DeadlockRetry.run('deposit', cls.settle_deposit, deposit_id, shard=shard)
+
+    @classmethod
+    def mark_deposit(cls, deposit_id, from_status, to_status):
+        return Deposit.objects.filter(id=deposit_id, status=from_status).update(status=to_status,
+                                                                                modified_time=timezone.now())
+
+    @classmethod
+    def create_deposit_intent(cls, wallet_id, amount):
+        shards = Account.objects.filter(id=wallet_id).values_list('shards', flat=True).first()
+        if shards is None:
+            raise Account.DoesNotExist(f"[AccountNotExist] Wallet {wallet_id} does not exist.")
+        # deposits to a sharded wallet land on a random sub-balance instead of the account row
+        shard = random.randrange(shards) if shards else None
+        return Deposit.objects.create(account_id=wallet_id, amount=amount, shard=shard, status=DepositStatus.Pending)
+
+    @classmethod
+    def settle_deposit(cls, deposit_id, shard=None):
+        """
+        Credit a confirmed deposit. Settling is idempotent: a deposit that is already settled
+        returns the balance recorded by its statement and is never credited twice.
+        `shard` is the sub-balance chosen for the deposit intent, None for a wallet that is not sharded.
+        """
+        with profiling.timed('atomic'), transaction.atomic():
+            returning = cls.supports_update_returning()
+            deposits = Deposit.objects.select_for_update()
+            if shard is None and not returning:
+                # lock and read the account row in the same round trip as the deposit row
+                deposits = deposits.select_related('account')
+            deposit = deposits.get(id=deposit_id)
+            if deposit.status == DepositStatus.Settled:
+                return dict(error=0, new_balance=deposit.statement.balance_after_transaction)
+            if deposit.status != DepositStatus.Confirmed:
+                raise WalletService.DepositError(f"[DepositStatusError] Deposit {deposit_id} is not confirmed.")
+
+            wallet_id, amount = deposit.account_id, deposit.amount
+            if shard is not None and BalanceShard.objects.filter(account_id=wallet_id, index=shard).update(
+                    balance=F('balance') + amount, modified_time=timezone.now()):
+                # only this shard row is locked, so the statement records the aggregate as read here instead
+                # of a running balance: consecutive statements of a sharded wallet may even go down. The
+                # cached aggregate is left to expire within the cache staleness bound
+                balance = BalanceCache.read_balance(wallet_id)
+            else:
+                if returning:
+                    balance = cls.add_balance_returning(wallet_id, amount)
                 else:
-                    from_wallet, to_wallet = accounts[1], accounts[0]
+                    account = deposit.account if shard is None else Account.objects.select_for_update().get(
+                        id=wallet_id)
+                    balance = account.balance + amount
+                    Account.objects.filter(id=wallet_id).update(balance=balance, version=F('version') + 1,
+                                                                modified_time=timezone.now())
+                BalanceCache.set_on_commit({wallet_id: balance})
+            statement = Statement.objects.create(account_id=wallet_id, wallet_id=wallet_id, amount=amount,
+                                                 balance_after_transaction=balance, type=TransactionType.Deposit)
+            Replicas.stick_on_commit([wallet_id])
+            deposit.status = DepositStatus.Settled
+            deposit.statement = statement
+            deposit.save(update_fields=['status', 'statement', 'modified_time'])
+            result_object = dict(error=0, new_balance=balance)
+            return result_object
+
+    @classmethod
+    def settle_deposit_optimistic(cls, deposit_id):
+        """
+        `settle_deposit` of a wallet that is not sharded without row locks: the deposit is claimed by a
+        conditional status update and the balance written only if the account version is still the one read.
+        """
+        deposit = Deposit.objects.select_related('statement').get(id=deposit_id)
+        if deposit.status == DepositStatus.Settled:
+            return dict(error=0, new_balance=deposit.statement.balance_after_transaction)
+        if deposit.status != DepositStatus.Confirmed:
+            raise WalletService.DepositError(f"[DepositStatusError] Deposit {deposit_id} is not confirmed.")
+        wallet_id, amount = deposit.account_id, deposit.amount
+        row = Account.objects.filter(id=wallet_id).values_list('balance', 'version').first()
+        if row is None:
+            raise Account.DoesNotExist(f"[AccountNotExist] Wallet {wallet_id} does not exist.")
+        balance, version = row[0] + amount, row[1]
+
+        with profiling.timed('atomic'), transaction.atomic():
+            now = timezone.now()
+            if not Deposit.objects.filter(id=deposit_id, status=DepositStatus.Confirmed).update(
+                    status=DepositStatus.Settled, modified_time=now):
+                # settled by a concurrent caller since it was read, the next attempt returns its balance
+                raise OptimisticRetry.VersionConflictError(f"[VersionConflictError] Deposit {deposit_id} changed.")
+            if not Account.objects.filter(id=wallet_id, version=version).update(
+                    balance=balance, version=version + 1, modified_time=now):
+                raise OptimisticRetry.VersionConflictError(f"[VersionConflictError] Wallet {wallet_id} changed.")
+            statement = Statement.objects.create(account_id=wallet_id, wallet_id=wallet_id, amount=amount,
+                                                 balance_after_transaction=balance, type=TransactionType.Deposit)
+            Deposit.objects.filter(id=deposit_id).update(statement=statement)
+            BalanceCache.set_on_commit({wallet_id: balance})
+            Replicas.stick_on_commit([wallet_id])
+        result_object = dict(error=0, new_balance=balance)
+        return result_object
+
+    @classmethod
+    def fold_shards(cls, accounts):
+        """
+        Move the sub-balances of the sharded accounts in {id: account} into their locked account rows, so
+        debits see the whole balance. Shard rows are locked after the account rows, in (account, index) order.
+        Return the ids of the accounts whose balance changed.
+        """
+        sharded = sorted(account.id for account in accounts.values() if account.shards)
+        if not sharded:
+            return set()
+        shards = [shard for shard in BalanceShard.objects.select_for_update().filter(account_id__in=sharded)
+                  .order_by('account_id', 'index') if shard.balance]
+        for shard in shards:
+            accounts[shard.account_id].balance += shard.balance
+        if shards:
+            BalanceShard.objects.filter(id__in=[shard.id for shard in shards]).update(balance=0,
+                                                                                     modified_time=timezone.now())
+        return {shard.account_id for shard in shards}
+
+    @classmethod
+    def shard_wallet(cls, wallet_id, shards):
+        """split a hot wallet's balance into `shards` sub-balance rows, 0 folds it back into one row"""
+        with profiling.timed('atomic'), transaction.atomic():
+            account = Account.objects.select_for_update().get(id=wallet_id)
+            cls.fold_shards({account.id: account})
+            BalanceShard.objects.filter(account_id=wallet_id).delete()
+            BalanceShard.objects.bulk_create([BalanceShard(account_id=wallet_id, index=index)
+                                              for index in range(shards)])
+            account.shards = shards
+            account.version += 1
+            account.save(update_fields=['balance', 'shards', 'version', 'modified_time'])
+            BalanceCache.set_on_commit({wallet_id: account.balance})
+            Replicas.stick_on_commit([wallet_id])
+            return dict(error=0, wallet_id=wallet_id, shards=shards, balance=account.balance)
+
+    @classmethod
+    def supports_update_returning(cls):
+        if connection.vendor == 'postgresql':
+            return True
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 35)
+        # MySQL has no UPDATE ... RETURNING
+        return False
+
+    @classmethod
+    def add_balance_returning(cls, wallet_id, amount):
+        """apply balance += amount and fetch the new balance with a single UPDATE ... RETURNING"""
+        quote_name = connection.ops.quote_name
+        field = Account._meta.get_field('balance')
+        sql = (f"UPDATE {quote_name(Account._meta.db_table)} "
+               f"SET {quote_name('balance')} = {quote_name('balance')} + %s, {quote_name('version')} = "
+               f"{quote_name('version')} + 1, {quote_name('modified_time')} = %s "
+               f"WHERE {quote_name('id')} = %s RETURNING {quote_name('balance')}")
+        params = [connection.ops.adapt_decimalfield_value(amount, field.max_digits, field.decimal_places),
+                  connection.ops.adapt_datetimefield_value(timezone.now()), wallet_id]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if row is None:
+            raise Account.DoesNotExist(f"[AccountNotExist] Wallet {wallet_id} does not exist.")
+        return field.to_python(row[0]).quantize(Decimal(1).scaleb(-field.decimal_places))
+
+    @classmethod
+    def recover_deposits(cls, older_than=None):
+        """
+        Recover deposit intents left behind by a crashed worker:
+            confirmed intents are settled (the bank already deducted the money),
+            pending intents older than `older_than` seconds are put under review: the bank may have
+            deducted without the worker recording it, see `resolve_deposit`.
+        """
+        if older_than is None:
+            older_than = getattr(settings, 'WALLET_DEPOSIT_RECOVERY_AGE', 60)
+        deadline = timezone.now() - timedelta(seconds=older_than)
+        stale = Deposit.objects.filter(modified_time__lt=deadline)
+
+        settled = 0
+        for deposit_id, shard in stale.filter(status=DepositStatus.Confirmed).values_list('id', 'shard'):
+            try:
+                cls.settle_deposit(deposit_id, shard=shard)
+                settled += 1
+            except (Account.DoesNotExist, WalletService.DepositError) as e:
+                logger.error("Error: <%s>", e)
+        # accepted deposits wait for their bank call in the job queue, `deposit_worker` takes care of them
+        unknown = list(stale.filter(status=DepositStatus.Pending)
+                       .exclude(id__in=DepositJob.objects.filter(status__in=[JobStatus.Queued, JobStatus.Running])
+                                .values('deposit_id'))
+                       .values_list('id', flat=True))
+        review = Deposit.objects.filter(id__in=unknown, status=DepositStatus.Pending).update(
+            status=DepositStatus.Review, modified_time=timezone.now())
+        if review:
+            logger.error('Deposits %s are under review, check with the bank whether it deducted them',
+                         ', '.join(map(str, unknown)))
+        logger.info('Recovered deposits, settled: %s, under review: %s', settled, review)
+        return dict(settled=settled, review=review)
+
+    @classmethod
+    def resolve_deposit(cls, deposit_id, deducted):
+        """settle a deposit under review once the bank confirmed it `deducted` the money, otherwise fail it"""
+        if not cls.mark_deposit(deposit_id, DepositStatus.Review,
+                                DepositStatus.Confirmed if deducted else DepositStatus.Failed):
+            raise WalletService.DepositError(f"[DepositStatusError] Deposit {deposit_id} is not under review.")
+        if not deducted:
+            return dict(error=0, deposit_id=deposit_id, status=DepositStatus.Failed.name.lower())
+        shard = Deposit.objects.filter(id=deposit_id).values_list('shard', flat=True).first()
+        result_object = dict(cls.settle_confirmed(deposit_id, shard=shard), deposit_id=deposit_id)
+        # a deposit left unsettled by its group commit keeps the confirmed status
+        result_object.setdefault('status', DepositStatus.Settled.name.lower())
+        return result_object
+
+    @classmethod
+    def transfer(cls, from_wallet_id, to_wallet_id, amount):
+        log.bind(wallet_ids=[from_wallet_id, to_wallet_id])
+        try:
+            if amount <= 0:
+                raise WalletService.MoneyValueError("[MoneyInvalidError] Transfer money error.")
+            if from_wallet_id == to_wallet_id:
+                TransferPrecheck.rejections.inc(reason='same_wallet')
+                raise WalletService.MoneyValueError("[MoneyInvalidError] Transfer to the same wallet.")
+            with profiling.timed('precheck'):
+                TransferPrecheck.check(from_wallet_id, to_wallet_id, amount)
+            if OptimisticRetry.enabled():
+                return OptimisticRetry.run('transfer', cls._transfer_optimistic, cls._transfer,
+                                           from_wallet_id, to_wallet_id, amount)
+            return DeadlockRetry.run('transfer', cls._transfer, from_wallet_id, to_wallet_id, amount)
+        except (WalletService.MoneyValueError, Account.DoesNotExist, DeadlockRetry.RetryExhaustedError) as e:
+            logger.error("Error: <%s>", e)
+            raise WalletService.TransferError(e)
+
+    @classmethod
+    def _transfer(cls, from_wallet_id, to_wallet_id, amount):
+        with profiling.timed('atomic'), transaction.atomic():
+            # always lock in ascending id order, so concurrent A->B and B->A transfers cannot deadlock
+            locked = Account.objects.select_for_update().filter(id__in=[from_wallet_id, to_wallet_id]).order_by('id')
+            accounts = {account.id: account for account in locked}
+            if from_wallet_id not in accounts or to_wallet_id not in accounts:
+                raise Account.DoesNotExist("[AccountNotExist] Transfer wallet does not exist.")
+            cls.fold_shards(accounts)
+            from_wallet, to_wallet = accounts[from_wallet_id], accounts[to_wallet_id]
+
+            from_wallet.balance -= amount
+            if from_wallet.balance < 0:
+                raise WalletService.MoneyValueError("[MoneyInvalidError] Insufficient balance.")
+            to_wallet.balance += amount
+            from_wallet.version += 1
+            to_wallet.version += 1
+            from_wallet.save(update_fields=['balance', 'version', 'modified_time'])
+            to_wallet.save(update_fields=['balance', 'version', 'modified_time'])
+
+            from_wallet.statement_set.create(wallet_id=from_wallet_id, amount=-amount,
+                                             balance_after_transaction=from_wallet.balance,
+                                             type=TransactionType.Transfer)
+            to_wallet.statement_set.create(wallet_id=to_wallet_id, amount=amount,
+                                           balance_after_transaction=to_wallet.balance,
+                                           type=TransactionType.Transfer)
+            BalanceCache.set_on_commit({from_wallet_id: from_wallet.balance, to_wallet_id: to_wallet.balance})
+            Replicas.stick_on_commit([from_wallet_id, to_wallet_id])
+            result_object = dict(error=0, new_balance=from_wallet.balance)
+            return result_object
+
+    @classmethod
+    def _transfer_optimistic(cls, from_wallet_id, to_wallet_id, amount):
+        """
+        `_transfer` without row locks: both accounts are read unlocked and written with
+        UPDATE ... WHERE id = %s AND version = <version read>, the debit also AND balance >= amount.
+        A write that matches no row means the account changed since it was read, and the attempt is rolled back.
+        """
+        rows = {wallet_id: (balance, version, shards) for wallet_id, balance, version, shards in Account.objects
+                .filter(id__in=[from_wallet_id, to_wallet_id]).values_list('id', 'balance', 'version', 'shards')}
+        if from_wallet_id not in rows or to_wallet_id not in rows:
+            raise Account.DoesNotExist("[AccountNotExist] Transfer wallet does not exist.")
+        if rows[from_wallet_id][2] or rows[to_wallet_id][2]:
+            # sharded balances are folded under the shard row locks
+            return cls._transfer(from_wallet_id, to_wallet_id, amount)
+        if rows[from_wallet_id][0] < amount:
+            raise WalletService.MoneyValueError("[MoneyInvalidError] Insufficient balance.")
+        balances = {from_wallet_id: rows[from_wallet_id][0] - amount, to_wallet_id: rows[to_wallet_id][0] + amount}
+
+        with profiling.timed('atomic'), transaction.atomic():
+            now = timezone.now()
+            # write in ascending id order like the locking engine, so concurrent A->B and B->A cannot deadlock
+            for wallet_id in sorted(balances):
+                accounts = Account.objects.filter(id=wallet_id, version=rows[wallet_id][1])
+                if wallet_id == from_wallet_id:
+                    accounts = accounts.filter(balance__gte=amount)
+                if not accounts.update(balance=balances[wallet_id], version=rows[wallet_id][1] + 1, modified_time=now):
+                    raise OptimisticRetry.VersionConflictError(
+                        f"[VersionConflictError] Wallet {wallet_id} changed since it was read.")
+            Statement.objects.bulk_create([
+                Statement(account_id=from_wallet_id, wallet_id=from_wallet_id, amount=-amount,
+                          balance_after_transaction=balances[from_wallet_id], type=TransactionType.Transfer),
+                Statement(account_id=to_wallet_id, wallet_id=to_wallet_id, amount=amount,
+                          balance_after_transaction=balances[to_wallet_id], type=TransactionType.Transfer)])
+            BalanceCache.set_on_commit(balances)
+            Replicas.stick_on_commit(balances)
+        result_object = dict(error=0, new_balance=balances[from_wallet_id])
+        return result_object
+
+    @classmethod
+    def transfer_many(cls, transfers, atomic=True):
+        """
+        Settle a batch of (from_wallet_id, to_wallet_id, amount) transfers in one transaction: all affected
+        accounts are locked by one ordered select_for_update, balances are applied in memory and written
+        back with one bulk_update, and the statements are written with one bulk_create.
+            atomic=True: all or nothing, the first invalid transfer fails the whole batch
+            atomic=False: invalid transfers are skipped and reported in their item result
+        """
+        try:
+            return DeadlockRetry.run('transfer_many', cls._transfer_many, transfers, atomic)
+        except (WalletService.MoneyValueError, Account.DoesNotExist, DeadlockRetry.RetryExhaustedError) as e:
+            logger.error("Error: <%s>", e)
+            raise WalletService.TransferError(e)
+
+    @classmethod
+    def _transfer_many(cls, transfers, atomic):
+        with profiling.timed('atomic'), transaction.atomic():
+            wallet_ids = {wallet_id for from_wallet_id, to_wallet_id, _ in transfers
+                          for wallet_id in (from_wallet_id, to_wallet_id)}
+            locked = Account.objects.select_for_update().filter(id__in=wallet_ids).order_by('id')
+            accounts = {account.id: account for account in locked}
+
+            now = timezone.now()
+            results, statements, changed = [], [], {}
+            for wallet_id in cls.fold_shards(accounts):
+                accounts[wallet_id].modified_time = now
+                changed[wallet_id] = accounts[wallet_id]
+            for index, (from_wallet_id, to_wallet_id, amount) in enumerate(transfers):
+                try:
+                    if amount <= 0:
+                        raise WalletService.MoneyValueError("[MoneyInvalidError] Transfer money error.")
+                    if from_wallet_id == to_wallet_id:
+                        raise WalletService.MoneyValueError("[MoneyInvalidError] Transfer to the same wallet.")
+                    if from_wallet_id not in accounts or to_wallet_id not in accounts:
+                        raise Account.DoesNotExist("[AccountNotExist] Transfer wallet does not exist.")
+                    from_wallet, to_wallet = accounts[from_wallet_id], accounts[to_wallet_id]
+                    if from_wallet.balance < amount:
+                        raise WalletService.MoneyValueError("[MoneyInvalidError] Insufficient balance.")
+                except (WalletService.MoneyValueError, Account.DoesNotExist) as e:
+                    if atomic:
+                        raise type(e)(f"transfer {index}: {e}")
+                    results.append(dict(index=index, error=1, message=str(e)))
+                    continue
 
                 from_wallet.balance -= amount
-                if from_wallet.balance < 0:
-                    raise WalletService.MoneyValueError("[MoneyInvalidError] Insufficient balance.")
                 to_wallet.balance += amount
-                from_wallet.save(update_fields=['balance', 'modified_time'])
-                to_wallet.save(update_fields=['balance', 'modified_time'])
-
-                from_wallet.statement_set.create(wallet_id=from_wallet_id, amount=-amount,
-                                                 balance_after_transaction=from_wallet.balance,
-                                                 type=TransactionType.Transfer)
-                to_wallet.statement_set.create(wallet_id=to_wallet_id, amount=amount,
-                                               balance_after_transaction=to_wallet.balance,
-                                               type=TransactionType.Transfer)
-                result_object = dict(error=0, new_balance=from_wallet.balance)
-                return result_object
-        except (WalletService.MoneyValueError, Account.DoesNotExist) as e:
+                for wallet in (from_wallet, to_wallet):
+                    wallet.modified_time = now
+                    changed[wallet.id] = wallet
+                statements.append(Statement(account=from_wallet, wallet_id=from_wallet_id, amount=-amount,
+                                            balance_after_transaction=from_wallet.balance,
+                                            type=TransactionType.Transfer))
+                statements.append(Statement(account=to_wallet, wallet_id=to_wallet_id, amount=amount,
+                                            balance_after_transaction=to_wallet.balance,
+                                            type=TransactionType.Transfer))
+                results.append(dict(index=index, error=0, new_balance=from_wallet.balance))
+
+            if changed:
+                for wallet in changed.values():
+                    wallet.version += 1
+                Account.objects.bulk_update(changed.values(), ['balance', 'version', 'modified_time'])
+                Statement.objects.bulk_create(statements)
+                BalanceCache.set_on_commit({wallet_id: wallet.balance for wallet_id, wallet in changed.items()})
+                Replicas.stick_on_commit(changed)
+            result_object = dict(error=0, results=results)
+            return result_object
+
+
+class DepositBatcher:
+    """
+    Group commit of deposits (opt-in, WALLET_GROUP_COMMIT): deposits that passed the bank step are queued,
+    and a flusher thread settles up to MAX_BATCH of them at a time, waiting at most MAX_DELAY seconds for a
+    batch to fill. Each batch is one transaction that updates every affected account once and writes the
+    statements with one bulk_create; every caller gets the balance after its own deposit once it commits.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    batch_sizes = metrics.histogram('wallet_deposit_batch_size', 'Deposits settled per group commit', (),
+                                    BATCH_BUCKETS)
+    flush_seconds = metrics.histogram('wallet_deposit_batch_seconds', 'Duration of a group commit')
+
+    def __init__(self, max_batch, max_delay):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='deposit-batcher', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def enabled(cls):
+        return group_commit_settings()['ENABLED']
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    config = group_commit_settings()
+                    cls._instance = DepositBatcher(config['MAX_BATCH'], config['MAX_DELAY'])
+        return cls._instance
+
+    @classmethod
+    def reset(cls):
+        """settle the queued deposits and stop the flusher thread"""
+        with cls._lock:
+            batcher, cls._instance = cls._instance, None
+        if batcher is not None:
+            batcher.queue.put(None)
+            batcher.thread.join()
+
+    @classmethod
+    def settle(cls, deposit_id):
+        future = cls.instance().submit(deposit_id)
+        with profiling.timed('group_commit'):
+            try:
+                return future.result(timeout=group_commit_settings()['TIMEOUT'])
+            except FutureTimeoutError:
+                return cls.unsettled(deposit_id)
+
+    @classmethod
+    async def asettle(cls, deposit_id):
+        future = cls.instance().submit(deposit_id)
+        with profiling.timed('group_commit'):
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), group_commit_settings()['TIMEOUT'])
+            except asyncio.TimeoutError:
+                return cls.unsettled(deposit_id)
+
+    @staticmethod
+    def unsettled(deposit_id):
+        """
+        Result of a deposit the bank deducted whose batch did not commit in time or failed: the deposit stays
+        confirmed and is still credited, by its batch or by `recover_deposits`, so it is not reported failed.
+        """
+        logger.warning('Deposit %s is confirmed but not settled yet', deposit_id)
+        return dict(error=0, deposit_id=deposit_id, status=DepositStatus.Confirmed.name.lower())
+
+    def submit(self, deposit_id):
+        future = Future()
+        self.queue.put((deposit_id, future))
+        return future
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.flush(batch)
+
+    def flush(self, batch):
+        start = time.perf_counter()
+        try:
+            results = DeadlockRetry.run('deposit_batch', self.settle_batch, [deposit_id for deposit_id, _ in batch])
+        except Exception as e:
+            # the deposits stay confirmed, `recover_deposits` settles them
             logger.error("Error: <%s>", e)
-            raise WalletService.TransferError(e)
+            connection.close()
+            for deposit_id, future in batch:
+                future.set_result(self.unsettled(deposit_id))
+            return
+        self.batch_sizes.observe(len(batch))
+        self.flush_seconds.observe(time.perf_counter() - start)
+        for deposit_id, future in batch:
+            result = results[deposit_id]
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    @staticmethod
+    def settle_batch(deposit_ids):
+        """settle the confirmed deposits in one transaction, {deposit_id: result object or DepositError}"""
+        with transaction.atomic():
+            locked = Deposit.objects.select_for_update().filter(id__in=deposit_ids)
+            deposits = {deposit.id: deposit for deposit in locked.order_by('id')}
+            results, pending = {}, []
+            for deposit_id in dict.fromkeys(deposit_ids):
+                deposit = deposits.get(deposit_id)
+                if deposit is not None and deposit.status == DepositStatus.Settled:
+                    results[deposit_id] = dict(error=0, new_balance=deposit.statement.balance_after_transaction)
+                elif deposit is None or deposit.status != DepositStatus.Confirmed:
+                    results[deposit_id] = WalletService.DepositError(
+                        f"[DepositStatusError] Deposit {deposit_id} is not confirmed.")
+                else:
+                    pending.append(deposit)
+            if not pending:
+                return results
+
+            # always lock in ascending id order, like transfers
+            locked = Account.objects.select_for_update().filter(id__in={deposit.account_id for deposit in pending})
+            accounts = {account.id: account for account in locked.order_by('id')}
+            now = timezone.now()
+            statements = []
+            for deposit in pending:
+                account = accounts[deposit.account_id]
+                account.balance += deposit.amount
+                account.modified_time = now
+                statements.append(Statement(account_id=account.id, wallet_id=account.id, amount=deposit.amount,
+                                            balance_after_transaction=account.balance, type=TransactionType.Deposit))
+                results[deposit.id] = dict(error=0, new_balance=account.balance)
+            for account in accounts.values():
+                account.version += 1
+            Account.objects.bulk_update(accounts.values(), ['balance', 'version', 'modified_time'])
+            WalletService.bulk_insert(Statement, statements)
+            for deposit, statement in zip(pending, statements):
+                deposit.status = DepositStatus.Settled
+                deposit.statement = statement
+                deposit.modified_time = now
+            Deposit.objects.bulk_update(pending, ['status', 'statement', 'modified_time'])
+            BalanceCache.set_on_commit({wallet_id: account.balance for wallet_id, account in accounts.items()})
+            Replicas.stick_on_commit(accounts)
+            return results
+
+
+class StatementService:
+    class InvalidCursorError(Exception):
+        """分頁游標錯誤"""
+
+    FIELDS = ('id', 'amount', 'balance_after_transaction', 'type', 'create_time')
+
+    @classmethod
+    def encode_cursor(cls, statement):
+        position = json.dumps([statement['create_time'].isoformat(), statement['id']])
+        return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        try:
+            create_time, statement_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            create_time = parse_datetime(create_time)
+            if create_time is None or not isinstance(statement_id, int):
+                raise ValueError(cursor)
+            return create_time, statement_id
+        except (ValueError, TypeError, UnicodeError) as e:
+            raise StatementService.InvalidCursorError(f"[InvalidCursorError] {e}")
+
+    @classmethod
+    def filter_statements(cls, account_id, type=None, min_amount=None, max_amount=None, since=None, until=None):
+        statements = Statement.objects.filter(account_id=account_id)
+        if type is not None:
+            statements = statements.filter(type=type)
+        if min_amount is not None:
+            statements = statements.filter(amount__gte=min_amount)
+        if max_amount is not None:
+            statements = statements.filter(amount__lte=max_amount)
+        if since is not None:
+            statements = statements.filter(create_time__gte=since)
+        if until is not None:
+            statements = statements.filter(create_time__lt=until)
+        return statements
+
+    @classmethod
+    def query(cls, account_id, limit=None, cursor=None, **filters):
+        """
+        One page of a wallet's statements, newest first. Pages are addressed by a keyset cursor on
+        (create_time, id) served by the (account, create_time, id) index, so the cost of a page does not
+        grow with the length of the wallet's history the way OFFSET does.
+        """
+        limit = min(limit or settings.WALLET_STATEMENT_PAGE_SIZE, settings.WALLET_STATEMENT_PAGE_SIZE_MAX)
+        statements = cls.filter_statements(account_id, **filters)
+        if cursor:
+            create_time, statement_id = cls.decode_cursor(cursor)
+            statements = statements.filter(Q(create_time__lt=create_time) |
+                                           Q(create_time=create_time, id__lt=statement_id))
+        page = list(statements.order_by('-create_time', '-id').values(*cls.FIELDS)[:limit + 1])
+        next_cursor = cls.encode_cursor(page[limit - 1]) if len(page) > limit else None
+        result_object = dict(error=0, statements=page[:limit], next_cursor=next_cursor)
+        return result_object
+
+    @classmethod
+    def export(cls, account_id, since=None, until=None, chunk_size=None):
+        """
+        Yield all statements of a wallet, oldest first, reading `chunk_size` rows per query.
+        Each chunk is a keyset range query on the (account, create_time, id) index, so memory stays
+        constant on MySQL too, whose driver buffers a whole result set instead of using a server-side cursor.
+        """
+        chunk_size = chunk_size or settings.WALLET_EXPORT_CHUNK_SIZE
+        statements = cls.filter_statements(account_id, since=since, until=until).order_by('create_time', 'id')
+        chunk = list(statements.values(*cls.FIELDS)[:chunk_size])
+        while chunk:
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+            last = chunk[-1]
+            chunk = list(statements.filter(Q(create_time__gt=last['create_time']) |
+                                           Q(create_time=last['create_time'], id__gt=last['id']))
+                         .values(*cls.FIELDS)[:chunk_size])
+
+
+@receiver(setting_changed)
+def reset_executors(sender, setting, **kwargs):
+    if setting == 'WALLET_ORM_THREADS':
+        OrmExecutor.reset()
+    elif setting == 'WALLET_GROUP_COMMIT':
+        DepositBatcher.reset()
+    elif setting == 'WALLET_TRANSFER_PRECHECK':
+        TransferPrecheck.reset()
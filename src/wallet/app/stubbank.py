@@ -0,0 +1,101 @@
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class StubBankServer(ThreadingMixIn, HTTPServer):
+    """
+    Local keep-alive stand-in for the bank api, used by tests and benchmarks.
+
+        with StubBankServer(delay=0.05) as bank:
+            requests.get(bank.url)
+
+    `delay` simulates bank latency, `fail_next` answers the next n calls with `fail_status`,
+    and `error` is returned as the bank error code.
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0, error=0, fail_status=503, host='127.0.0.1', port=0):
+        super().__init__((host, port), StubBankHandler)
+        self.delay = delay
+        self.error = error
+        self.fail_status = fail_status
+        self.fail_next = 0
+        self.requests = 0
+        # Idempotency-Key headers of the calls, in order
+        self.keys = []
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle_error(self, request, client_address):
+        # clients that time out hang up before the delayed response is written
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def next_response(self, key=None):
+        with self._lock:
+            self.requests += 1
+            self.keys.append(key)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                return self.fail_status, {'error': 1}
+        return 200, {'error': self.error}
+
+
+class StubBankHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server._lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        status, body = self.server.next_response(self.headers.get('Idempotency-Key'))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        with self.server._lock:
+            self.server.in_flight -= 1
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
@@ -1,10 +1,54 @@
-from django.test import TestCase
-from django.urls import reverse
+import asyncio
+import csv
+import gzip
+import json
+import logging
+import os
+import queue
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
 
-from app.models import Account
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.db.models import F, ProtectedError
+from django.test import (AsyncClient, AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
+
+from app import log
+from app.bank import AsyncBankApiClient, BankApiClient
+from app.cache import BalanceCache
+from app.dbpool import ConnectionPool
+from app.idempotency import IdempotencyService, KeyStatus
+from app.jobs import DepositJobService, DepositWorker
+from app.log import JsonFormatter, NonBlockingQueueHandler
+from app.schemas import DepositSchema, Schema, WalletJSONEncoder
+from app.search import AccountIndex
+from app.ledger import LedgerService
+from app.rollup import DailyRollupService
+from app.routers import ReplicaRouter, Replicas, activate as activate_database
+from app.models import (Account, BalanceShard, BalanceSnapshot, DailyStatementSummary, Deposit, DepositJob,
+                        IdempotencyKey, Statement)
+from app.stubbank import StubBankServer
+from app.views import AsyncCreateWalletView, AsyncDepositView, AsyncTransferView
+from app.services import WalletService, CallBankApiService, DeadlockRetry, DepositBatcher, DepositStatus, TransactionType
+from app.services import JobStatus, OptimisticRetry, TransferPrecheck
 from enum import IntEnum
 
 
+class AsyncUrls:
+    urlpatterns = [path('api/user/new/', AsyncCreateWalletView.as_view())]
+
+
 class TransactionType(IntEnum):
     Deposit = 1
     Transfer = 2
@@ -50,6 +94,9 @@ def transfer(from_wallet_id, to_wallet_id, amount):
 
 
 class CreateWalletViewTests(TestCase):
+    def setUp(self):
+        AccountIndex.reset()
+
     def test_no_wallet(self):
         """
         If no account exist, an appropriate message is displayed.
@@ -57,24 +104,158 @@ class CreateWalletViewTests(TestCase):
         response = self.client.get(reverse('query_statement'))
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, "No accounts are available.")
-        self.assertQuerysetEqual(response.context['account_list'], [])
+        self.assertEqual(response.context['account_list'], [])
 
     def test_create_wallet(self):
         new_wallet = create_new_wallet(name="test")
         response = self.client.get(reverse('query_statement'))
-        self.assertQuerysetEqual(
-            response.context['account_list'],
-            [f'<Account: id: {new_wallet.id}, name: {new_wallet.name}>']
-        )
+        self.assertEqual([(account['id'], account['name']) for account in response.context['account_list']],
+                         [(new_wallet.id, new_wallet.name)])
 
     def test_create_two_wallets(self):
         new_wallet = [create_new_wallet(name="test1"), create_new_wallet(name="test2")]
         response = self.client.get(reverse('query_statement'))
-        self.assertQuerysetEqual(
-            response.context['account_list'],
-            [f'<Account: id: {new_wallet[0].id}, name: {new_wallet[0].name}>',
-             f'<Account: id: {new_wallet[1].id}, name: {new_wallet[1].name}>'], ordered=False
-        )
+        self.assertEqual([(account['id'], account['name']) for account in response.context['account_list']],
+                         [(new_wallet[0].id, new_wallet[0].name), (new_wallet[1].id, new_wallet[1].name)])
+
+
+class AccountSearchTests(TestCase):
+    def setUp(self):
+        AccountIndex.reset()
+
+    def search(self, **params):
+        response = self.client.get(reverse('search_wallets'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['ResultObject']
+
+    def test_name_prefix_pages(self):
+        wallets = [create_new_wallet(name=name) for name in ('bob', 'Bobby', 'alice', 'bob', 'carol')]
+        result = self.search(q='BO', limit=2)
+        self.assertEqual([wallet['id'] for wallet in result['wallets']], [wallets[0].id, wallets[3].id])
+        self.assertEqual(set(result['wallets'][0]), {'id', 'name', 'balance'})
+        result = self.search(q='BO', limit=2, cursor=result['next_cursor'])
+        self.assertEqual([wallet['name'] for wallet in result['wallets']], ['Bobby'])
+        self.assertIsNone(result['next_cursor'])
+
+        response = self.client.get(reverse('search_wallets'), {'q': 'bo', 'cursor': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_id_prefix(self):
+        index = AccountIndex()
+        for wallet_id in (1, 2, 12, 21, 120, 1200, 300):
+            index.put(wallet_id, f'wallet {wallet_id}')
+        self.assertEqual([wallet_id for _, wallet_id in index.match_ids('12', None, 10)], [12, 120, 1200])
+        self.assertEqual([wallet_id for _, wallet_id in index.match_ids('12', 12, 10)], [120, 1200])
+        self.assertEqual([wallet_id for _, wallet_id in index.match_ids('1', None, 3)], [1, 12, 120])
+
+        wallet = create_new_wallet(name='dave')
+        self.assertEqual(self.search(q=str(wallet.id))['wallets'][0]['id'], wallet.id)
+        self.assertEqual(self.search(q=str(wallet.id), field='name')['wallets'], [])
+
+    @override_settings(WALLET_ACCOUNT_INDEX={'REFRESH_INTERVAL': 0, 'REFRESH_OVERLAP': 60})
+    def test_incremental_refresh(self):
+        wallet = create_new_wallet(name='erin')
+        self.assertEqual(len(self.search(q='erin')['wallets']), 1)
+        index = AccountIndex.instance()
+        Account.objects.filter(id=wallet.id).update(create_time=timezone.now() - timedelta(minutes=5))
+        added = create_new_wallet(name='erica')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual([wallet['id'] for wallet in self.search(q='eri')['wallets']], [added.id, wallet.id])
+        # the refresh reads the new wallets only, the page reads id, name and balance
+        self.assertIn('"id" >', queries.captured_queries[0]['sql'])
+        self.assertNotIn('modified_time', queries.captured_queries[0]['sql'])
+        self.assertEqual(index.since_id, wallet.id)
+
+        # balance writes bump modified_time, but do not make the refresh read a wallet again
+        with mock.patch.object(index, 'put') as put:
+            Account.objects.filter(id=wallet.id).update(balance=Decimal('1'), modified_time=timezone.now())
+            self.search(q='eri')
+        self.assertEqual([call.args[0] for call in put.call_args_list], [added.id])
+        # renames are applied by the next rebuild
+        Account.objects.filter(id=wallet.id).update(name='frank')
+        index.build(100)
+        self.assertEqual(self.search(q='frank')['wallets'][0]['id'], wallet.id)
+
+        Account.objects.filter(id=added.id).delete()
+        self.assertEqual(self.search(q='eri')['wallets'], [])
+        self.assertEqual(len(AccountIndex.instance()), 1)
+
+    @override_settings(WALLET_ACCOUNT_INDEX={'REFRESH_OVERLAP': 0, 'REBUILD_FRACTION': 0.5, 'REBUILD_MIN_ROWS': 1})
+    def test_bulk_changes_rebuild_the_index(self):
+        WalletService.create_wallets(['a1', 'a2', 'a3', 'a4'])
+        index = AccountIndex.instance()
+        index.refresh(force=True)
+        WalletService.create_wallet('a5')
+        with mock.patch.object(index, 'build', wraps=index.build) as build:
+            index.refresh(force=True)
+            build.assert_not_called()
+            WalletService.create_wallets(['b1', 'b2', 'b3'])
+            index.refresh(force=True)
+            build.assert_called_once_with(mock.ANY)
+        self.assertEqual(len(index), 8)
+
+    def test_search_does_not_wait_for_a_refresh(self):
+        create_new_wallet(name='gina')
+        self.search(q='gi')
+        index = AccountIndex.instance()
+        index.refreshed = None
+        # another thread is refreshing the index
+        with index._refreshing:
+            self.assertEqual(len(self.search(q='gi')['wallets']), 1)
+
+
+class BulkCreateWalletTests(TestCase):
+    def test_ids_in_input_order(self):
+        create_new_wallet(name="existing")
+        names = [f'partner-{i}' for i in range(7)]
+        wallet_ids = WalletService.create_wallets(iter(names), batch_size=3)['wallet_ids']
+        self.assertEqual(len(set(wallet_ids)), 7)
+        self.assertEqual([Account.objects.get(id=wallet_id).name for wallet_id in wallet_ids], names)
+
+    def test_ids_on_other_backends(self):
+        names = ['Bob', 'Alice', 'Carol']
+        # a backend that returns the rows of a bulk insert
+        with mock.patch.object(connection.features, 'can_return_rows_from_bulk_insert', True), \
+                mock.patch.object(Account.objects, 'bulk_create', side_effect=lambda rows, **kwargs: [
+                    row.save(force_insert=True) for row in rows]):
+            wallet_ids = WalletService.create_wallets(names)['wallet_ids']
+        self.assertEqual([Account.objects.get(id=wallet_id).name for wallet_id in wallet_ids], names)
+        # a backend whose bulk insert ids are unknown
+        with mock.patch.object(connection, 'vendor', 'oracle'):
+            wallet_ids = WalletService.create_wallets(names)['wallet_ids']
+        self.assertEqual([Account.objects.get(id=wallet_id).name for wallet_id in wallet_ids], names)
+
+    def test_api(self):
+        url = reverse('create_wallets')
+        response = self.client.post(url, {'names': ['Bob', 'Alice']}, content_type='application/json')
+        wallet_ids = response.json()['ResultObject']['wallet_ids']
+        self.assertEqual(list(Account.objects.filter(id__in=wallet_ids).order_by('id').values_list('name', flat=True)),
+                         ['Bob', 'Alice'])
+
+        for body in ({'names': []}, {'names': ['ok', '']}, {'names': 'Bob'}):
+            response = self.client.post(url, body, content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+        with override_settings(WALLET_CREATE_BULK_MAX=1):
+            response = self.client.post(url, {'names': ['Bob', 'Alice']}, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            names, output = os.path.join(directory, 'names.txt'), os.path.join(directory, 'ids.txt')
+            with open(names, 'w') as f:
+                f.write('Bob\nAlice\nCarol\n')
+            out = StringIO()
+            call_command('create_wallets', names, output=output, batch_size=2, stdout=out)
+            self.assertEqual(json.loads(out.getvalue())['wallets'], 3)
+            with open(output) as f:
+                wallet_ids = [int(line) for line in f]
+            self.assertEqual([Account.objects.get(id=wallet_id).name for wallet_id in wallet_ids],
+                             ['Bob', 'Alice', 'Carol'])
+
+            with open(names, 'w') as f:
+                f.write('Dave\n\nErin\n')
+            with self.assertRaisesMessage(CommandError, 'line 2'):
+                call_command('create_wallets', names, stdout=StringIO())
 
 
 class QueryStatementViewTests(TestCase):
@@ -132,3 +313,1273 @@ class QueryStatementViewTests(TestCase):
             [f'<Statement: transaction amount: {transfer_account[1].amount}, '
              f'balance: {transfer_account[1].balance_after_transaction}, type: {transfer_account[1].type}, '
              f'transaction time: {transfer_account[1].create_time}>'])
+
+
+class DepositServiceTests(TestCase):
+    @mock.patch.object(CallBankApiService, 'call_bank_api')
+    def test_deposit_settles_intent(self, call_bank_api):
+        wallet = create_new_wallet(name="test")
+        result = WalletService.deposit(wallet.id, Decimal('12.34'))
+        self.assertEqual(result['new_balance'], Decimal('12.34'))
+        deposit = Deposit.objects.get(account=wallet)
+        self.assertEqual(deposit.status, DepositStatus.Settled)
+        self.assertEqual(deposit.statement.balance_after_transaction, Decimal('12.34'))
+        call_bank_api.assert_called_once_with()
+
+    @mock.patch.object(CallBankApiService, 'call_bank_api')
+    def test_deposit_query_count(self, call_bank_api):
+        wallet = create_new_wallet(name="test")
+        # wallet check, insert intent, confirm intent, then in the settle transaction: lock deposit
+        # and account, update balance, insert statement, mark settled (and the test case's savepoint pair)
+        for returning in (True, False):
+            with mock.patch.object(WalletService, 'supports_update_returning', return_value=returning):
+                with self.assertNumQueries(9):
+                    WalletService.deposit(wallet.id, Decimal('1.25'))
+        wallet.refresh_from_db()
+        self.assertEqual(wallet.balance, Decimal('2.50'))
+        self.assertEqual([statement.balance_after_transaction for statement in wallet.statement_set.order_by('id')],
+                         [Decimal('1.25'), Decimal('2.50')])
+
+    def test_update_returning(self):
+        if not WalletService.supports_update_returning():
+            self.skipTest('database has no UPDATE ... RETURNING')
+        wallet = create_new_wallet(name="test")
+        with self.assertNumQueries(1):
+            self.assertEqual(WalletService.add_balance_returning(wallet.id, Decimal('3.10')), Decimal('3.10'))
+        with self.assertRaises(Account.DoesNotExist):
+            WalletService.add_balance_returning(999999, Decimal('1'))
+
+    @mock.patch.object(CallBankApiService, 'call_bank_api',
+                       side_effect=CallBankApiService.CallBankServiceError('bank down'))
+    def test_bank_failure_marks_intent_failed(self, call_bank_api):
+        wallet = create_new_wallet(name="test")
+        with self.assertRaises(WalletService.DepositError):
+            WalletService.deposit(wallet.id, Decimal('10'))
+        self.assertEqual(Deposit.objects.get(account=wallet).status, DepositStatus.Failed)
+        wallet.refresh_from_db()
+        self.assertEqual(wallet.balance, 0)
+        self.assertFalse(wallet.statement_set.exists())
+
+    @mock.patch.object(CallBankApiService, 'call_bank_api')
+    def test_unknown_wallet_skips_bank(self, call_bank_api):
+        with self.assertRaises(WalletService.DepositError):
+            WalletService.deposit(999999, Decimal('10'))
+        call_bank_api.assert_not_called()
+        self.assertFalse(Deposit.objects.exists())
+
+    def test_settle_is_idempotent(self):
+        wallet = create_new_wallet(name="test")
+        deposit = Deposit.objects.create(account=wallet, amount=Decimal('5'), status=DepositStatus.Confirmed)
+        WalletService.settle_deposit(deposit.id)
+        result = WalletService.settle_deposit(deposit.id)
+        self.assertEqual(result['new_balance'], Decimal('5'))
+        wallet.refresh_from_db()
+        self.assertEqual(wallet.balance, Decimal('5'))
+        self.assertEqual(wallet.statement_set.count(), 1)
+
+    def test_recover_deposits(self):
+        wallet = create_new_wallet(name="test")
+        confirmed = Deposit.objects.create(account=wallet, amount=Decimal('5'), status=DepositStatus.Confirmed)
+        pending = Deposit.objects.create(account=wallet, amount=Decimal('7'), status=DepositStatus.Pending)
+        fresh = Deposit.objects.create(account=wallet, amount=Decimal('9'), status=DepositStatus.Pending)
+        Deposit.objects.filter(id__in=[confirmed.id, pending.id]).update(
+            modified_time=timezone.now() - timedelta(minutes=10))
+
+        result = WalletService.recover_deposits(older_than=60)
+        self.assertEqual(result, dict(settled=1, review=1))
+        self.assertEqual(Deposit.objects.get(id=confirmed.id).status, DepositStatus.Settled)
+        self.assertEqual(Deposit.objects.get(id=pending.id).status, DepositStatus.Review)
+        self.assertEqual(Deposit.objects.get(id=fresh.id).status, DepositStatus.Pending)
+        wallet.refresh_from_db()
+        self.assertEqual(wallet.balance, Decimal('5'))
+
+        # the bank reports whether it deducted a deposit under review
+        out = StringIO()
+        call_command('review_deposits', stdout=out)
+        self.assertTrue(out.getvalue().startswith(f"{pending.id} wallet: {wallet.id}, amount: 7"))
+        call_command('review_deposits', settle=[pending.id], stdout=StringIO())
+        self.assertEqual(Deposit.objects.get(id=pending.id).status, DepositStatus.Settled)
+        wallet.refresh_from_db()
+        self.assertEqual(wallet.balance, Decimal('12'))
+        with self.assertRaises(CommandError):
+            call_command('review_deposits', fail=[pending.id], stdout=StringIO())
+
+
+class DepositTransactionTests(TransactionTestCase):
+    def test_bank_called_outside_transaction(self):
+        wallet = create_new_wallet(name="test")
+
+        def call_bank_api():
+            self.assertFalse(connection.in_atomic_block)
+
+        with mock.patch.object(CallBankApiService, 'call_bank_api', side_effect=call_bank_api) as bank:
+            WalletService.deposit(wallet.id, Decimal('1'))
+        bank.assert_called_once_with()
+
+
+class BankApiClientTests(SimpleTestCase):
+    def setUp(self):
+        self.bank = StubBankServer().start()
+        self.addCleanup(self.bank.stop)
+
+    def bank_settings(self, **kwargs):
+        config = dict(URL=self.bank.url, CONNECT_TIMEOUT=1, READ_TIMEOUT=1, BACKOFF_FACTOR=0.01, BACKOFF_MAX=0.05)
+        config.update(kwargs)
+        return override_settings(BANK_API=config)
+
+    def test_connections_are_reused(self):
+        with self.bank_settings():
+            for _ in range(20):
+                CallBankApiService.call_bank_api()
+        self.assertEqual(self.bank.requests, 20)
+        self.assertEqual(self.bank.connections, 1)
+
+    def test_concurrent_calls_share_the_pool(self):
+        self.bank.delay = 0.05
+        with self.bank_settings(POOL_SIZE=10):
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                list(executor.map(lambda _: CallBankApiService.call_bank_api(), range(50)))
+            elapsed = time.monotonic() - start
+        # 50 calls of 50ms over 10 pooled connections, instead of 2.5s one after another
+        self.assertLess(elapsed, 1.5)
+        self.assertLessEqual(self.bank.connections, 10)
+
+    def test_read_timeout(self):
+        self.bank.delay = 1
+        with self.bank_settings(READ_TIMEOUT=0.1, MAX_RETRIES=0):
+            start = time.monotonic()
+            with self.assertRaises(CallBankApiService.CallBankServiceError):
+                CallBankApiService.call_bank_api()
+            self.assertLess(time.monotonic() - start, 0.9)
+
+    def test_retries_server_errors_of_an_idempotent_bank(self):
+        self.bank.fail_next = 2
+        with self.bank_settings(MAX_RETRIES=2, IDEMPOTENT=True):
+            CallBankApiService.call_bank_api()
+        self.assertEqual(self.bank.requests, 3)
+        # the bank deduplicates the attempts of one call on their key
+        self.assertEqual(len(set(self.bank.keys)), 1)
+        self.assertIsNotNone(self.bank.keys[0])
+
+    def test_calls_that_may_have_reached_the_bank_are_not_retried(self):
+        self.bank.fail_next = 1
+        with self.bank_settings(MAX_RETRIES=2, READ_TIMEOUT=0.1):
+            with self.assertRaises(CallBankApiService.CallBankServiceError):
+                CallBankApiService.call_bank_api()
+            self.bank.delay = 0.5
+            with self.assertRaises(CallBankApiService.CallBankServiceError):
+                CallBankApiService.call_bank_api()
+        self.assertEqual(self.bank.requests, 2)
+
+    def test_refused_connections_are_retried(self):
+        closed = StubBankServer().start()
+        url = closed.url
+        closed.stop()
+        with override_settings(BANK_API=dict(URL=url, MAX_RETRIES=2, BACKOFF_FACTOR=0.01, READ_TIMEOUT=0.2)), \
+                self.assertLogs('default', 'WARNING') as logs:
+            with self.assertRaises(CallBankApiService.CallBankServiceError):
+                CallBankApiService.call_bank_api()
+        self.assertEqual(len([line for line in logs.output if 'Bank API attempt' in line]), 2)
+
+    def test_async_clients_are_closed_on_reset(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def client():
+            return AsyncBankApiClient.instance()
+        with self.bank_settings():
+            bank = loop.run_until_complete(client())
+        self.assertTrue(bank.client.is_closed)
+
+    def test_bank_error_code_is_not_retried(self):
+        self.bank.error = 1
+        with self.bank_settings(MAX_RETRIES=2):
+            with self.assertRaises(CallBankApiService.CallBankServiceError):
+                CallBankApiService.call_bank_api()
+        self.assertEqual(self.bank.requests, 1)
+
+    def test_circuit_breaker_fails_fast(self):
+        self.bank.fail_next = 100
+        with self.bank_settings(MAX_RETRIES=0, CIRCUIT_FAILURE_THRESHOLD=3, CIRCUIT_RESET_TIMEOUT=0.2):
+            for _ in range(5):
+                with self.assertRaises(CallBankApiService.CallBankServiceError):
+                    CallBankApiService.call_bank_api()
+            self.assertEqual(self.bank.requests, 3)
+
+            # after the reset timeout a single trial call closes the circuit again
+            self.bank.fail_next = 0
+            time.sleep(0.25)
+            CallBankApiService.call_bank_api()
+            self.assertEqual(BankApiClient.instance().circuit_breaker.state, 'closed')
+
+
+class AsyncViewTests(TransactionTestCase):
+    def setUp(self):
+        self.bank = StubBankServer(delay=0.2).start()
+        self.addCleanup(self.bank.stop)
+        self.factory = AsyncRequestFactory()
+
+    async def post(self, view, path, data):
+        request = self.factory.post(path, data=json.dumps(data), content_type='application/json')
+        return await view.as_view()(request)
+
+    def test_create_wallet_and_transfer(self):
+        self.assertTrue(asyncio.iscoroutinefunction(AsyncCreateWalletView.as_view()))
+
+        @async_to_sync
+        async def run():
+            first = await self.post(AsyncCreateWalletView, '/api/user/new/', {'name': 'Alice'})
+            second = await self.post(AsyncCreateWalletView, '/api/user/new/', {'name': 'Bob'})
+            return [json.loads(response.content)['ResultObject']['wallet_id'] for response in (first, second)]
+
+        from_wallet_id, to_wallet_id = run()
+        Account.objects.filter(id=from_wallet_id).update(balance=Decimal('10'))
+        response = async_to_sync(self.post)(AsyncTransferView, '/api/wallet/transfer/',
+                                            {'from_wallet_id': from_wallet_id, 'to_wallet_id': to_wallet_id,
+                                             'amount': 4})
+        self.assertEqual(json.loads(response.content)['ResultObject']['new_balance'], '6.00')
+        self.assertEqual(Account.objects.get(id=to_wallet_id).balance, Decimal('4'))
+
+    def test_deposits_wait_for_bank_concurrently(self):
+        wallet = create_new_wallet(name="test")
+        self.bank.delay = 0.5
+
+        @async_to_sync
+        async def run():
+            return await asyncio.gather(*[
+                self.post(AsyncDepositView, '/api/wallet/deposit/', {'wallet_id': wallet.id, 'amount': 1})
+                for _ in range(10)])
+
+        # a single ORM thread keeps SQLite from contending on its database-wide write lock
+        with override_settings(BANK_API=dict(URL=self.bank.url, MAX_RETRIES=0), WALLET_ORM_THREADS=1):
+            responses = run()
+
+        # the bank calls overlap instead of holding one thread each
+        self.assertGreaterEqual(self.bank.max_in_flight, 5)
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+        wallet.refresh_from_db()
+        self.assertEqual(wallet.balance, Decimal('10'))
+        self.assertEqual(wallet.statement_set.count(), 10)
+
+    def test_deposit_retries_lock_errors_like_sync_deposits(self):
+        wallet = create_new_wallet(name="test")
+        deadlock = OperationalError(1213, 'Deadlock found when trying to get lock; try restarting transaction')
+        settle_deposit = WalletService.settle_deposit
+
+        def deadlocked_once(*args, **kwargs):
+            if settle.call_count == 1:
+                raise deadlock
+            return settle_deposit(*args, **kwargs)
+        with override_settings(BANK_API=dict(URL=self.bank.url), WALLET_LOCK_RETRY_BACKOFF=0), \
+                mock.patch.object(WalletService, 'settle_deposit', side_effect=deadlocked_once) as settle:
+            result = async_to_sync(WalletService.adeposit)(wallet.id, Decimal('3'))
+        self.assertEqual(result['new_balance'], Decimal('3'))
+        self.assertEqual(settle.call_count, 2)
+
+    def test_invalid_deposit_request(self):
+        response = async_to_sync(self.post)(AsyncDepositView, '/api/wallet/deposit/', {'wallet_id': 1, 'amount': -1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_served_through_asgi_handler(self):
+        client = AsyncClient()
+        with override_settings(ROOT_URLCONF=AsyncUrls):
+            created = async_to_sync(client.post)('/api/user/new/', data={'name': 'Alice'},
+                                                 content_type='application/json')
+            not_allowed = async_to_sync(client.put)('/api/user/new/')
+        self.assertEqual(created.status_code, 200)
+        self.assertTrue(Account.objects.filter(id=created.json()['ResultObject']['wallet_id']).exists())
+        self.assertEqual(not_allowed.status_code, 405)
+        # queries run on the ORM threads are counted into the request's profile
+        self.assertRegex(created['Server-Timing'], r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+
+
+class TransferLockTests(TestCase):
+    def test_locks_accounts_in_id_order(self):
+        first, second = create_new_wallet(name="first"), create_new_wallet(name="second")
+        deposit(second, 10)
+        with CaptureQueriesContext(connection) as context, \
+                override_settings(WALLET_TRANSFER_PRECHECK={'ENABLED': False}):
+            WalletService.transfer(second.id, first.id, Decimal('3'))
+        lock_query = next(query['sql'] for query in context.captured_queries if query['sql'].startswith('SELECT'))
+        self.assertIn(f"ORDER BY {connection.ops.quote_name('account_tab')}.{connection.ops.quote_name('id')} ASC",
+                      lock_query)
+
+    def test_missing_wallet_is_rejected(self):
+        wallet = create_new_wallet(name="test")
+        with self.assertRaises(WalletService.TransferError):
+            WalletService.transfer(wallet.id, 999999, Decimal('1'))
+
+    def test_invalid_transfers_are_rejected_before_the_transaction(self):
+        TransferPrecheck.reset()
+        poor, rich = create_new_wallet(name="poor"), create_new_wallet(name="rich")
+        deposit(rich, 10)
+        for from_wallet_id, to_wallet_id, amount in ((rich.id, rich.id, 1), (poor.id, rich.id, 1),
+                                                     (rich.id, 999999, 1)):
+            with mock.patch.object(WalletService, '_transfer') as locked_transfer:
+                with self.assertRaises(WalletService.TransferError):
+                    WalletService.transfer(from_wallet_id, to_wallet_id, Decimal(amount))
+                locked_transfer.assert_not_called()
+        self.assertEqual(Statement.objects.filter(type=TransactionType.Transfer).count(), 0)
+
+        # a wallet id that does not exist is remembered until a wallet gets it
+        with self.assertNumQueries(0), self.assertRaises(WalletService.TransferError):
+            WalletService.transfer(rich.id, 999999, Decimal('1'))
+        next_id = rich.id + 1
+        with self.assertRaises(WalletService.TransferError):
+            WalletService.transfer(rich.id, next_id, Decimal('1'))
+        self.assertEqual(WalletService.create_wallet("late")['wallet_id'], next_id)
+        self.assertEqual(WalletService.transfer(rich.id, next_id, Decimal('1'))['new_balance'], Decimal('9'))
+
+    def test_retry_gives_up_after_bounded_attempts(self):
+        error = OperationalError(1213, 'Deadlock found when trying to get lock; try restarting transaction')
+        operation = mock.Mock(side_effect=error)
+        before = DeadlockRetry.retries.value(operation='test')
+        with mock.patch.object(connection, 'in_atomic_block', False), \
+                override_settings(WALLET_LOCK_RETRIES=2, WALLET_LOCK_RETRY_BACKOFF=0):
+            with self.assertRaises(DeadlockRetry.RetryExhaustedError):
+                DeadlockRetry.run('test', operation)
+        self.assertEqual(operation.call_count, 3)
+        self.assertEqual(DeadlockRetry.retries.value(operation='test') - before, 2)
+        metrics_page = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('wallet_lock_retries_total{operation="test"}', metrics_page)
+
+    def test_other_errors_are_not_retried(self):
+        operation = mock.Mock(side_effect=OperationalError(1054, 'Unknown column'))
+        with mock.patch.object(connection, 'in_atomic_block', False):
+            with self.assertRaises(OperationalError):
+                DeadlockRetry.run('test', operation)
+        self.assertEqual(operation.call_count, 1)
+
+
+class TransferStressTests(TransactionTestCase):
+    def test_criss_cross_transfers_between_hot_wallets(self):
+        wallets = [create_new_wallet(name=f"hot{i}") for i in range(3)]
+        Account.objects.update(balance=Decimal('1000'))
+        pairs = [(a.id, b.id) for a in wallets for b in wallets if a.id != b.id]
+
+        def worker(offset):
+            for i in range(10):
+                from_wallet_id, to_wallet_id = pairs[(offset + i) % len(pairs)]
+                WalletService.transfer(from_wallet_id, to_wallet_id, Decimal('1'))
+            connection.close()
+
+        with override_settings(WALLET_LOCK_RETRIES=50, WALLET_LOCK_RETRY_BACKOFF=0.005):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(worker, range(4)))
+
+        self.assertEqual(sum(Account.objects.values_list('balance', flat=True)), Decimal('3000'))
+        self.assertEqual(Statement.objects.count(), 80)
+
+
+@override_settings(WALLET_CONCURRENCY=dict(ENGINE='optimistic', MAX_ATTEMPTS=2),
+                   WALLET_LOCK_RETRIES=50, WALLET_LOCK_RETRY_BACKOFF=0.005)
+@mock.patch.object(CallBankApiService, 'call_bank_api')
+class OptimisticConcurrencyTests(TransactionTestCase):
+    def test_transfers_and_deposits_bump_versions(self, call_bank_api):
+        first, second = create_new_wallet(name="first"), create_new_wallet(name="second")
+        with mock.patch.object(WalletService, '_transfer') as locked_transfer:
+            self.assertEqual(WalletService.deposit(first.id, Decimal('10'))['new_balance'], Decimal('10'))
+            self.assertEqual(WalletService.transfer(first.id, second.id, Decimal('4'))['new_balance'], Decimal('6'))
+            locked_transfer.assert_not_called()
+        self.assertEqual(list(Account.objects.order_by('id').values_list('balance', 'version')),
+                         [(Decimal('6'), 2), (Decimal('4'), 1)])
+
+        # a deposit settled again returns its recorded balance
+        deposit_id = Deposit.objects.get().id
+        self.assertEqual(WalletService.settle_deposit_optimistic(deposit_id)['new_balance'], Decimal('10'))
+        # the locking engine bumps the version too, so optimistic writes see its changes
+        with override_settings(WALLET_CONCURRENCY=dict(ENGINE='pessimistic')):
+            WalletService.transfer(second.id, first.id, Decimal('1'))
+        self.assertEqual(list(Account.objects.order_by('id').values_list('version', flat=True)), [3, 2])
+
+    def test_conflicts_fall_back_to_locking(self, call_bank_api):
+        first, second = create_new_wallet(name="first"), create_new_wallet(name="second")
+        Account.objects.filter(id=first.id).update(balance=Decimal('10'))
+        conflicts = OptimisticRetry.conflicts.value(operation='transfer')
+        conflict = OptimisticRetry.VersionConflictError('changed')
+        with mock.patch.object(WalletService, '_transfer_optimistic', side_effect=conflict) as optimistic:
+            self.assertEqual(WalletService.transfer(first.id, second.id, Decimal('3'))['new_balance'], Decimal('7'))
+        self.assertEqual(optimistic.call_count, 2)
+        self.assertEqual(OptimisticRetry.conflicts.value(operation='transfer') - conflicts, 2)
+
+    def test_concurrent_transfers_keep_balances(self, call_bank_api):
+        wallets = [create_new_wallet(name=f"hot{i}").id for i in range(2)]
+        Account.objects.update(balance=Decimal('100'))
+
+        def worker(offset):
+            for i in range(10):
+                from_wallet_id, to_wallet_id = wallets[(offset + i) % 2], wallets[(offset + i + 1) % 2]
+                WalletService.transfer(from_wallet_id, to_wallet_id, Decimal(1 + offset))
+            connection.close()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(worker, range(4)))
+
+        self.assertEqual(sum(Account.objects.values_list('balance', flat=True)), Decimal('200'))
+        for account in Account.objects.all():
+            last = account.statement_set.order_by('-id').first()
+            self.assertEqual(last.balance_after_transaction, account.balance)
+            self.assertEqual(account.version, 40)
+
+
+class BatchTransferTests(TestCase):
+    def setUp(self):
+        self.wallets = [create_new_wallet(name=f"test{i}") for i in range(3)]
+        Account.objects.update(balance=Decimal('100'))
+
+    def test_batch_is_settled_in_one_transaction(self):
+        a, b, c = (wallet.id for wallet in self.wallets)
+        transfers = [(a, b, Decimal('10')), (b, c, Decimal('20')), (c, a, Decimal('5')), (a, c, Decimal('1'))]
+        # savepoint, one locking select, one bulk update, one bulk insert, release savepoint
+        with self.assertNumQueries(5):
+            result = WalletService.transfer_many(transfers)
+        self.assertEqual([item['new_balance'] for item in result['results']],
+                         [Decimal('90'), Decimal('90'), Decimal('115'), Decimal('94')])
+        balances = dict(Account.objects.values_list('id', 'balance'))
+        self.assertEqual(balances, {a: Decimal('94'), b: Decimal('90'), c: Decimal('116')})
+        self.assertEqual(Statement.objects.count(), 8)
+        self.assertEqual(Statement.objects.filter(wallet_id=c).order_by('id').last().balance_after_transaction,
+                         Decimal('116'))
+
+    def test_atomic_batch_rolls_back_on_failure(self):
+        a, b, _ = (wallet.id for wallet in self.wallets)
+        with self.assertRaises(WalletService.TransferError):
+            WalletService.transfer_many([(a, b, Decimal('10')), (b, a, Decimal('500'))])
+        self.assertEqual(set(Account.objects.values_list('balance', flat=True)), {Decimal('100')})
+        self.assertFalse(Statement.objects.exists())
+
+    def test_partial_batch_reports_each_item(self):
+        a, b, _ = (wallet.id for wallet in self.wallets)
+        result = WalletService.transfer_many([(a, b, Decimal('10')), (b, a, Decimal('500')), (a, a, Decimal('1')),
+                                              (a, 999999, Decimal('1'))], atomic=False)
+        self.assertEqual([item['error'] for item in result['results']], [0, 1, 1, 1])
+        self.assertEqual(Account.objects.get(id=a).balance, Decimal('90'))
+        self.assertEqual(Statement.objects.count(), 2)
+
+    def test_batch_transfer_view(self):
+        a, b, _ = (wallet.id for wallet in self.wallets)
+        body = {'atomic': False, 'transfers': [{'from_wallet_id': a, 'to_wallet_id': b, 'amount': '12.5'},
+                                               {'from_wallet_id': b, 'to_wallet_id': a, 'amount': 1000}]}
+        response = self.client.post(reverse('transfer_batch'), data=body, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['ResultObject']['results']
+        self.assertEqual(results[0], {'index': 0, 'error': 0, 'new_balance': '87.50'})
+        self.assertEqual(results[1]['error'], 1)
+
+        body = {'transfers': [{'from_wallet_id': a, 'to_wallet_id': b, 'amount': -1}]}
+        response = self.client.post(reverse('transfer_batch'), data=body, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class StatementListViewTests(TestCase):
+    def setUp(self):
+        self.wallet = create_new_wallet(name="test")
+        for amount in range(1, 8):
+            self.wallet.statement_set.create(wallet_id=self.wallet.id, amount=amount, balance_after_transaction=amount,
+                                             type=TransactionType.Deposit if amount % 2 else TransactionType.Transfer)
+
+    def get(self, **params):
+        return self.client.get(reverse('statements', args=(self.wallet.id,)), params)
+
+    def test_cursor_pagination_walks_history_once(self):
+        amounts, cursor = [], None
+        while True:
+            params = dict(limit=3, cursor=cursor) if cursor else dict(limit=3)
+            result = self.get(**params).json()['ResultObject']
+            amounts.extend(statement['amount'] for statement in result['statements'])
+            cursor = result['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(amounts, ['7.00', '6.00', '5.00', '4.00', '3.00', '2.00', '1.00'])
+
+    def test_filters(self):
+        result = self.get(type=TransactionType.Deposit, min_amount=2, max_amount=6).json()['ResultObject']
+        self.assertEqual([statement['amount'] for statement in result['statements']], ['5.00', '3.00'])
+        self.assertIsNone(result['next_cursor'])
+
+        result = self.get(since=(timezone.now() + timedelta(minutes=1)).isoformat()).json()['ResultObject']
+        self.assertEqual(result['statements'], [])
+
+    def test_page_query_uses_keyset(self):
+        cursor = self.get(limit=2).json()['ResultObject']['next_cursor']
+        with CaptureQueriesContext(connection) as context:
+            self.get(limit=2, cursor=cursor)
+        page_query = context.captured_queries[-1]['sql']
+        self.assertIn('LIMIT 3', page_query)
+        self.assertNotIn('OFFSET', page_query)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.get(cursor='not-a-cursor').status_code, 400)
+        self.assertEqual(self.get(limit=0).status_code, 400)
+        response = self.client.get(reverse('statements', args=(999999,)))
+        self.assertEqual(response.status_code, 400)
+
+
+class StatementExportViewTests(TestCase):
+    def setUp(self):
+        self.wallet = create_new_wallet(name="test")
+        for amount in range(1, 6):
+            self.wallet.statement_set.create(wallet_id=self.wallet.id, amount=amount, balance_after_transaction=amount,
+                                             type=TransactionType.Deposit)
+
+    def export(self, **params):
+        response = self.client.get(reverse('statements_export', args=(self.wallet.id,)), params)
+        self.assertTrue(response.streaming)
+        return response
+
+    @override_settings(WALLET_EXPORT_CHUNK_SIZE=2)
+    def test_csv_export_reads_in_chunks(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.export()
+            rows = list(csv.reader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual(rows[0], ['id', 'amount', 'balance_after_transaction', 'type', 'create_time'])
+        self.assertEqual([row[1] for row in rows[1:]], ['1.00', '2.00', '3.00', '4.00', '5.00'])
+        # existence check and 3 chunks of at most 2 rows
+        self.assertEqual(len(context.captured_queries), 4)
+
+    def test_ndjson_export_with_gzip(self):
+        response = self.client.get(reverse('statements_export', args=(self.wallet.id,)), {'format': 'ndjson'},
+                                   HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['amount'] for line in lines], ['1.00', '2.00', '3.00', '4.00', '5.00'])
+
+    def test_time_range(self):
+        response = self.export(until=(timezone.now() - timedelta(minutes=1)).isoformat())
+        self.assertEqual(len(b''.join(response.streaming_content).decode('utf-8').splitlines()), 1)
+
+
+@override_settings(WALLET_BALANCE_CACHE={'TTL': 60})
+class BalanceCacheTests(TestCase):
+    def test_balance_is_read_through(self):
+        wallet = create_new_wallet(name="test")
+        misses = BalanceCache.misses.value()
+        with self.assertNumQueries(1):
+            self.assertEqual(BalanceCache.get_balance(wallet.id), 0)
+            self.assertEqual(BalanceCache.get_balance(wallet.id), 0)
+        self.assertEqual(BalanceCache.misses.value() - misses, 1)
+
+    def test_transfer_writes_through_on_commit(self):
+        first, second = create_new_wallet(name="first"), create_new_wallet(name="second")
+        deposit(first, 10)
+        BalanceCache.get_balance(first.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            WalletService.transfer(first.id, second.id, Decimal('4'))
+        with self.assertNumQueries(0):
+            self.assertEqual(BalanceCache.get_balance(first.id), Decimal('6'))
+            self.assertEqual(BalanceCache.get_balance(second.id), Decimal('4'))
+
+    def test_rolled_back_transfer_leaves_cache_alone(self):
+        first, second = create_new_wallet(name="first"), create_new_wallet(name="second")
+        BalanceCache.get_balance(first.id)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(WalletService.TransferError):
+                WalletService.transfer(first.id, second.id, Decimal('4'))
+        self.assertEqual(callbacks, [])
+        self.assertEqual(BalanceCache.get_balance(first.id), 0)
+
+    @override_settings(WALLET_BALANCE_CACHE={'TTL': 60, 'SHARED_BACKEND': 'default'})
+    def test_shared_backend(self):
+        wallet = create_new_wallet(name="test")
+        BalanceCache.get_balance(wallet.id)
+        BalanceCache.reset()
+        with self.assertNumQueries(0):
+            self.assertEqual(BalanceCache.get_balance(wallet.id), 0)
+
+    def test_balance_view(self):
+        wallet = create_new_wallet(name="test")
+        response = self.client.get(reverse('balance', args=(wallet.id,)))
+        self.assertEqual(response.json()['ResultObject'], {'error': 0, 'wallet_id': wallet.id, 'balance': '0.00'})
+        self.assertEqual(self.client.get(reverse('balance', args=(999999,))).status_code, 400)
+
+
+class ShardedBalanceTests(TestCase):
+    def setUp(self):
+        self.hot = create_new_wallet(name="hot")
+        self.other = create_new_wallet(name="other")
+        Account.objects.filter(id=self.hot.id).update(balance=Decimal('10'))
+        WalletService.shard_wallet(self.hot.id, 4)
+
+    @mock.patch.object(CallBankApiService, 'call_bank_api')
+    def test_deposits_land_on_shards(self, call_bank_api):
+        for _ in range(8):
+            result = WalletService.deposit(self.hot.id, Decimal('1'))
+        self.assertEqual(result['new_balance'], Decimal('18'))
+        self.assertEqual(Account.objects.get(id=self.hot.id).balance, Decimal('10'))
+        self.assertEqual(sum(BalanceShard.objects.filter(account=self.hot).values_list('balance', flat=True)),
+                         Decimal('8'))
+        # the row and the shards in one statement, so a concurrent fold cannot be half seen
+        with self.assertNumQueries(1):
+            self.assertEqual(BalanceCache.read_balance(self.hot.id), Decimal('18'))
+        self.assertEqual(BalanceCache.read_balance(self.other.id), Decimal('0'))
+
+    @mock.patch.object(CallBankApiService, 'call_bank_api')
+    def test_precheck_leaves_sharded_wallets_to_the_locked_path(self, call_bank_api):
+        WalletService.deposit(self.hot.id, Decimal('5'))
+        with self.assertNumQueries(1):
+            TransferPrecheck.check(self.hot.id, self.other.id, Decimal('100'))
+        self.assertEqual(WalletService.transfer(self.hot.id, self.other.id, Decimal('15'))['new_balance'],
+                         Decimal('0'))
+        with self.assertRaises(WalletService.TransferError):
+            WalletService.transfer(self.hot.id, self.other.id, Decimal('1'))
+
+    @mock.patch.object(CallBankApiService, 'call_bank_api')
+    def test_transfer_folds_shards(self, call_bank_api):
+        for _ in range(4):
+            WalletService.deposit(self.hot.id, Decimal('5'))
+        result = WalletService.transfer(self.hot.id, self.other.id, Decimal('25'))
+        self.assertEqual(result['new_balance'], Decimal('5'))
+        self.assertEqual(Account.objects.get(id=self.hot.id).balance, Decimal('5'))
+        self.assertFalse(BalanceShard.objects.filter(account=self.hot).exclude(balance=0).exists())
+
+        result = WalletService.transfer_many([(self.other.id, self.hot.id, Decimal('1')),
+                                              (self.hot.id, self.other.id, Decimal('100'))], atomic=False)
+        self.assertEqual([item['error'] for item in result['results']], [0, 1])
+        self.assertEqual(BalanceCache.read_balance(self.hot.id), Decimal('6'))
+
+    def test_settle_after_unsharding_credits_account(self):
+        deposit = Deposit.objects.create(account=self.hot, amount=Decimal('2'), shard=3,
+                                         status=DepositStatus.Confirmed)
+        WalletService.shard_wallet(self.hot.id, 0)
+        result = WalletService.settle_deposit(deposit.id, shard=deposit.shard)
+        self.assertEqual(result['new_balance'], Decimal('12'))
+        self.assertEqual(Account.objects.get(id=self.hot.id).balance, Decimal('12'))
+
+    @mock.patch.object(CallBankApiService, 'call_bank_api')
+    def test_resharding_keeps_balance(self, call_bank_api):
+        WalletService.deposit(self.hot.id, Decimal('3'))
+        result = WalletService.shard_wallet(self.hot.id, 2)
+        self.assertEqual(result['balance'], Decimal('13'))
+        self.assertEqual(BalanceShard.objects.filter(account=self.hot).count(), 2)
+        self.assertEqual(BalanceCache.read_balance(self.hot.id), Decimal('13'))
+
+
+class IdempotencyKeyTests(TestCase):
+    def setUp(self):
+        IdempotencyService.reset()
+        self.wallet = create_new_wallet(name="test")
+
+    def post(self, path, data, key):
+        return self.client.post(path, data=json.dumps(data), content_type='application/json',
+                                HTTP_IDEMPOTENCY_KEY=key)
+
+    @mock.patch.object(CallBankApiService, 'call_bank_api')
+    def test_retry_replays_stored_response(self, call_bank_api):
+        data = {'wallet_id': self.wallet.id, 'amount': 10}
+        first = self.post(reverse('deposit'), data, 'deposit-1')
+        # the replay comes from the database once the in-process cache is gone
+        IdempotencyService.reset()
+        with self.assertNumQueries(1):
+            second = self.post(reverse('deposit'), data, 'deposit-1')
+        with self.assertNumQueries(0):
+            third = self.post(reverse('deposit'), data, 'deposit-1')
+
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first.content, third.content)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        call_bank_api.assert_called_once_with()
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('10'))
+
+    @mock.patch.object(CallBankApiService, 'call_bank_api')
+    def test_key_reused_with_different_body(self, call_bank_api):
+        self.post(reverse('deposit'), {'wallet_id': self.wallet.id, 'amount': 10}, 'deposit-1')
+        response = self.post(reverse('deposit'), {'wallet_id': self.wallet.id, 'amount': 20}, 'deposit-1')
+        self.assertEqual(response.status_code, 422)
+        # keys are scoped per api
+        target = create_new_wallet(name="target")
+        response = self.post(reverse('transfer'),
+                             {'from_wallet_id': self.wallet.id, 'to_wallet_id': target.id, 'amount': 4}, 'deposit-1')
+        self.assertEqual(json.loads(response.content)['ResultObject']['new_balance'], '6.00')
+
+    @mock.patch.object(CallBankApiService, 'call_bank_api')
+    def test_unfinished_key_is_taken_over_after_its_lease(self, call_bank_api):
+        data = {'wallet_id': self.wallet.id, 'amount': 10}
+        request = mock.Mock(method='POST', path=reverse('deposit'), body=json.dumps(data).encode('utf-8'))
+        # left by a worker that was killed while running the request
+        IdempotencyKey.objects.create(scope='deposit', key='deposit-1',
+                                      fingerprint=IdempotencyService.fingerprint(request),
+                                      expire_time=timezone.now() + timedelta(seconds=30))
+        with override_settings(WALLET_IDEMPOTENCY=dict(WAIT=0)):
+            self.assertEqual(self.post(reverse('deposit'), data, 'deposit-1').status_code, 409)
+        IdempotencyKey.objects.update(expire_time=timezone.now())
+        response = self.post(reverse('deposit'), data, 'deposit-1')
+        self.assertEqual(json.loads(response.content)['ResultObject']['new_balance'], '10.00')
+        # a completed key is kept for the TTL
+        record = IdempotencyKey.objects.get()
+        self.assertEqual(record.status, KeyStatus.Completed)
+        self.assertGreater(record.expire_time, timezone.now() + timedelta(hours=23))
+
+    def test_request_finishing_after_a_takeover_keeps_the_new_claim(self):
+        stale, stored = IdempotencyService.begin('deposit', 'deposit-1', 'x')
+        self.assertIsNone(stored)
+        IdempotencyKey.objects.update(expire_time=timezone.now())
+        claim, stored = IdempotencyService.begin('deposit', 'deposit-1', 'x')
+        self.assertNotEqual(claim, stale)
+
+        # the request that lost its lease neither stores its response nor frees the key
+        self.assertFalse(IdempotencyService.complete('deposit', 'deposit-1', stale, 'x', 200, '{"stale": 1}'))
+        self.assertFalse(IdempotencyService.release(stale))
+        with override_settings(WALLET_IDEMPOTENCY=dict(WAIT=0)):
+            with self.assertRaises(IdempotencyService.InProgressError):
+                IdempotencyService.begin('deposit', 'deposit-1', 'x')
+        self.assertTrue(IdempotencyService.complete('deposit', 'deposit-1', claim, 'x', 200, '{"new": 1}'))
+        self.assertEqual(IdempotencyService.begin('deposit', 'deposit-1', 'x'), (None, (200, '{"new": 1}')))
+
+    def test_async_duplicate_waits_on_the_event_loop(self):
+        IdempotencyKey.objects.create(scope='deposit', key='deposit-1', fingerprint='x',
+                                      expire_time=timezone.now() + timedelta(seconds=30))
+        attempts = []
+
+        async def run(func, *args):
+            attempts.append(func)
+            return await sync_to_async(func)(*args)
+        with override_settings(WALLET_IDEMPOTENCY=dict(WAIT=0.2)), \
+                mock.patch('app.idempotency.asyncio.sleep', wraps=asyncio.sleep) as sleep:
+            with self.assertRaises(IdempotencyService.InProgressError):
+                async_to_sync(IdempotencyService.abegin)('deposit', 'deposit-1', 'x', run)
+        # every wait but the last is followed by another attempt
+        self.assertEqual(len(attempts), sleep.call_count + 1)
+        self.assertGreater(sleep.call_count, 1)
+
+    def test_purge_expired(self):
+        now = timezone.now()
+        IdempotencyKey.objects.create(scope='deposit', key='old', fingerprint='x', expire_time=now)
+        IdempotencyKey.objects.create(scope='deposit', key='new', fingerprint='x',
+                                      expire_time=now + timedelta(hours=1))
+        self.assertEqual(IdempotencyService.purge_expired(batch_size=1), 1)
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['new'])
+
+
+class ConcurrentIdempotencyKeyTests(TransactionTestCase):
+    def test_duplicate_waits_for_first_request(self):
+        IdempotencyService.reset()
+        wallet = create_new_wallet(name="test")
+
+        def slow_bank():
+            time.sleep(0.3)
+
+        def post(_):
+            response = self.client_class().post(reverse('deposit'), content_type='application/json',
+                                                data=json.dumps({'wallet_id': wallet.id, 'amount': 5}),
+                                                HTTP_IDEMPOTENCY_KEY='deposit-1')
+            connection.close()
+            return response
+
+        with mock.patch.object(CallBankApiService, 'call_bank_api', side_effect=slow_bank) as call_bank_api:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                responses = list(executor.map(post, range(3)))
+
+        call_bank_api.assert_called_once_with()
+        self.assertEqual(len({response.content for response in responses}), 1)
+        self.assertEqual(Account.objects.get(id=wallet.id).balance, Decimal('5'))
+
+
+class BenchmarkCommandTests(TransactionTestCase):
+    def test_report(self):
+        out = StringIO()
+        call_command('benchmark', requests=40, concurrency=2, wallets=3, bank_delay=0, seed=1, stdout=out)
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['requests'], 40)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(sum(operation['requests'] for operation in report['operations'].values()), 40)
+        self.assertEqual(set(report['latency_ms']), {'p50', 'p95', 'p99', 'max'})
+        self.assertGreater(report['operations']['transfer']['queries_per_request'], 0)
+        # benchmark wallets are removed afterwards
+        self.assertFalse(Account.objects.exists())
+
+    @skipUnless(settings.DATABASES['default']['ENGINE'].startswith('app.backends.'), 'needs a pooled engine')
+    def test_db_pool_report(self):
+        out = StringIO()
+        call_command('benchmark_db_pool', requests=20, concurrency=4, pool_size=2, stdout=out)
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['per_request']['connections_opened'], 20)
+        self.assertLessEqual(report['pooled']['connections_opened'], 2)
+        self.assertEqual(report['pooled']['errors'], 0)
+
+    @override_settings(WALLET_LOCK_RETRIES=50, WALLET_LOCK_RETRY_BACKOFF=0.005)
+    def test_concurrency_report(self):
+        # a real wallet that happens to share the benchmark's name prefix
+        real = create_new_wallet(name="benchmark-concurrency-0")
+        out = StringIO()
+        call_command('benchmark_concurrency', operations=20, threads=2, low_contention_wallets=5, stdout=out)
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(set(report), {'low_contention_pessimistic', 'low_contention_optimistic',
+                                       'high_contention_pessimistic', 'high_contention_optimistic'})
+        self.assertEqual(sum(run['errors'] for run in report.values()), 0)
+        self.assertEqual(list(Account.objects.values_list('id', 'balance')), [(real.id, Decimal('0'))])
+
+
+class ProfilingMiddlewareTests(TestCase):
+    def test_server_timing(self):
+        wallet = create_new_wallet(name="test")
+        with StubBankServer() as bank, override_settings(BANK_API=dict(URL=bank.url, MAX_RETRIES=0)):
+            response = self.client.post(reverse('deposit'), data=json.dumps({'wallet_id': wallet.id, 'amount': 5}),
+                                        content_type='application/json')
+        phases = {item.split(';')[0]: item for item in response['Server-Timing'].split(', ')}
+        self.assertEqual(set(phases), {'bank', 'atomic', 'db', 'serialize', 'total'})
+        self.assertRegex(phases['db'], r'desc="\d+ queries"')
+
+        text = self.client.get(reverse('metrics')).content.decode('utf-8')
+        self.assertIn('wallet_request_seconds_count{view="deposit"}', text)
+        self.assertIn('wallet_phase_seconds_bucket{phase="bank",le="+Inf"}', text)
+
+    def test_slow_request_profile_dump(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config = dict(CPROFILE_SAMPLE_RATE=1, CPROFILE_SLOW_SECONDS=0, CPROFILE_DIR=directory)
+            with override_settings(WALLET_PROFILING=config):
+                self.client.get(reverse('index'))
+            self.assertEqual(len([name for name in os.listdir(directory) if name.endswith('.prof')]), 1)
+
+
+class LoggingPipelineTests(SimpleTestCase):
+    def setUp(self):
+        self.records = queue.Queue(maxsize=1)
+        self.handler = NonBlockingQueueHandler(self.records)
+        self.logger = logging.getLogger('wallet-test')
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def test_json_record_with_request_context(self):
+        with log.activate(dict(request_id='abc')):
+            log.bind(wallet_ids=[1, 2])
+            self.logger.warning('transfer %s failed', 'x', extra={'amount': Decimal('1.50')})
+        data = json.loads(JsonFormatter().format(self.records.get_nowait()))
+        self.assertEqual(data['message'], 'transfer x failed')
+        self.assertEqual(data['request_id'], 'abc')
+        self.assertEqual(data['wallet_ids'], [1, 2])
+        self.assertEqual(data['amount'], '1.50')
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        dropped = log.records_dropped.value(level='WARNING')
+        self.logger.warning('first')
+        start = time.monotonic()
+        self.logger.warning('second')
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(log.records_dropped.value(level='WARNING'), dropped + 1)
+        self.assertEqual(self.records.get_nowait().getMessage(), 'first')
+
+    def test_listener_of_each_process(self):
+        target = mock.Mock(level=logging.NOTSET)
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=10), target=target)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        self.logger.warning('parent')
+        parent_queue, parent_listener = handler.queue, handler.listener
+        # a forked child starts its own listener on a new queue
+        with mock.patch('app.log.os.getpid', return_value=-1):
+            self.logger.warning('child')
+            self.assertIsNot(handler.queue, parent_queue)
+            handler.stop_listener()
+        parent_listener.stop()
+        self.assertEqual(sorted(call.args[0].getMessage() for call in target.handle.call_args_list),
+                         ['child', 'parent'])
+
+    def test_request_id_header(self):
+        response = self.client.get(reverse('index'), HTTP_X_REQUEST_ID='req-1')
+        self.assertEqual(response['X-Request-ID'], 'req-1')
+
+
+class SchemaTests(SimpleTestCase):
+    def test_deposit_schema_matches_form_rules(self):
+        self.assertEqual(DepositSchema.load(b'{"wallet_id": "8", "amount": 12.34}'),
+                         {'wallet_id': 8, 'amount': Decimal('12.34')})
+        for body in (b'{"wallet_id": 8}', b'{"wallet_id": true, "amount": 1}', b'{"wallet_id": 8, "amount": 0}',
+                     b'{"wallet_id": 8, "amount": 1.234}', b'{"wallet_id": 8, "amount": 1e20}',
+                     b'{"wallet_id": 8, "amount": "NaN"}'):
+            with self.assertRaises(Schema.ValidationError, msg=body):
+                DepositSchema.load(body)
+        for body in (b'not json', b'[1, 2]', b'\xff'):
+            with self.assertRaises(Schema.InvalidBodyError, msg=body):
+                DepositSchema.load(body)
+
+    def test_encoder(self):
+        self.assertEqual(json.dumps({'balance': Decimal('6.00'), 'ids': [1, 2]}, cls=WalletJSONEncoder),
+                         '{"balance":"6.00","ids":[1,2]}')
+
+
+@override_settings(WALLET_LEDGER=dict(ENABLED=True, SNAPSHOT_EVERY=2, SNAPSHOT_INTERVAL=3600, SETTLE_LAG=0))
+@mock.patch.object(CallBankApiService, 'call_bank_api')
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.wallet = create_new_wallet(name="test")
+
+    def deposit(self, *amounts):
+        for amount in amounts:
+            WalletService.deposit(self.wallet.id, Decimal(amount))
+
+    def test_snapshot_every_n_entries(self, call_bank_api):
+        self.deposit('10')
+        self.assertEqual(LedgerService.take_snapshots()['snapshots'], 1)
+        self.deposit('5')
+        # one statement since the last snapshot is not due yet, and stays ahead of the cursor
+        self.assertEqual(LedgerService.take_snapshots()['snapshots'], 0)
+        self.deposit('2.50')
+        self.assertEqual(LedgerService.take_snapshots()['snapshots'], 1)
+
+        latest = BalanceSnapshot.objects.order_by('-id').first()
+        self.assertEqual((latest.balance, latest.entries), (Decimal('17.50'), 2))
+        self.assertEqual(LedgerService.balance(self.wallet.id), Decimal('17.50'))
+        self.deposit('1')
+        with self.assertNumQueries(2):
+            self.assertEqual(LedgerService.balance(self.wallet.id), Decimal('18.50'))
+
+    def test_verify_only_new_snapshots(self, call_bank_api):
+        self.deposit('10')
+        LedgerService.take_snapshots()
+        self.assertEqual(LedgerService.verify(), dict(verified=1, mismatched=[], drifted=[]))
+
+        self.deposit('5', '5')
+        LedgerService.take_snapshots()
+        changed = self.wallet.statement_set.order_by('-id').first()
+        # changed behind the application's back
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE statement_tab SET amount = %s WHERE id = %s', ['50', changed.id])
+        latest = BalanceSnapshot.objects.order_by('-id').first()
+        self.assertEqual(LedgerService.verify(), dict(verified=0, mismatched=[latest.id], drifted=[self.wallet.id]))
+        self.assertEqual(LedgerService.verify(), dict(verified=0, mismatched=[], drifted=[]))
+
+    def test_statements_are_append_only(self, call_bank_api):
+        self.deposit('10')
+        statement = self.wallet.statement_set.get()
+        statement.amount = Decimal('20')
+        with self.assertRaises(Statement.ImmutableError):
+            statement.save()
+        with self.assertRaises(Statement.ImmutableError):
+            Statement.objects.filter(id=statement.id).update(amount=Decimal('20'))
+        with self.assertRaises(Statement.ImmutableError):
+            self.wallet.statement_set.all().delete()
+        with self.assertRaises(ProtectedError):
+            Account.objects.get(id=self.wallet.id).delete()
+        # a wallet without statements can still be deleted
+        create_new_wallet(name="empty").delete()
+
+    def test_balance_of_a_sharded_wallet_is_reconciled(self, call_bank_api):
+        self.deposit('10')
+        WalletService.shard_wallet(self.wallet.id, 2)
+        self.deposit('5')
+        self.assertEqual(LedgerService.reconcile([self.wallet.id]), {})
+        BalanceShard.objects.filter(account_id=self.wallet.id, index=0).update(balance=F('balance') + 1)
+        self.assertEqual(LedgerService.reconcile([self.wallet.id]),
+                         {self.wallet.id: (Decimal('16'), Decimal('15'))})
+
+
+@override_settings(WALLET_LEDGER=dict(SETTLE_LAG=0))
+@mock.patch.object(CallBankApiService, 'call_bank_api')
+class DailyRollupTests(TestCase):
+    def setUp(self):
+        self.wallet = create_new_wallet(name="test")
+        self.other = create_new_wallet(name="other")
+
+    def deposit(self, amount, day):
+        WalletService.deposit(self.wallet.id, Decimal(amount))
+        Statement.objects.filter(id=Statement.objects.latest('id').id).update(
+            create_time=datetime(2020, 7, day, 12, tzinfo=timezone.utc))
+
+    def summary(self):
+        return {(row.day.day, row.type): (row.count, row.total) for row in DailyStatementSummary.objects.all()}
+
+    def test_roll_up_is_incremental(self, call_bank_api):
+        self.deposit('10', 1)
+        self.deposit('5', 1)
+        self.assertEqual(DailyRollupService.roll_up()['groups'], 1)
+        self.deposit('2.50', 1)
+        self.deposit('1', 2)
+        self.assertEqual(DailyRollupService.roll_up()['groups'], 2)
+        self.assertEqual(DailyRollupService.roll_up()['groups'], 0)
+        self.assertEqual(self.summary(), {(1, 1): (3, Decimal('17.50')), (2, 1): (1, Decimal('1'))})
+
+    def test_backfill_rebuilds_summaries(self, call_bank_api):
+        self.deposit('10', 1)
+        self.deposit('5', 2)
+        DailyRollupService.roll_up()
+        DailyStatementSummary.objects.update(count=99)
+        result = DailyRollupService.backfill(since=date(2020, 7, 2), until=date(2020, 7, 2))
+        self.assertEqual(result['groups'], 1)
+        self.assertEqual(self.summary(), {(1, 1): (99, Decimal('10')), (2, 1): (1, Decimal('5'))})
+
+        DailyStatementSummary.objects.all().delete()
+        call_command('backfill_rollup', stdout=StringIO())
+        self.assertEqual(self.summary(), {(1, 1): (1, Decimal('10')), (2, 1): (1, Decimal('5'))})
+
+    def test_daily_report(self, call_bank_api):
+        for day in (1, 1, 2, 3, 3, 3):
+            self.deposit('10', day)
+        WalletService.transfer(self.wallet.id, self.other.id, Decimal('4'))
+        Statement.objects.filter(type=TransactionType.Transfer).update(
+            create_time=datetime(2020, 7, 2, 12, tzinfo=timezone.utc))
+        DailyRollupService.roll_up()
+
+        url = reverse('daily_report', args=(self.wallet.id,))
+        with self.assertNumQueries(4):
+            response = self.client.get(url, {'since': '2020-07-02', 'until': '2020-07-31'})
+        days = response.json()['ResultObject']['days']
+        self.assertEqual(days, [
+            {'day': '2020-07-02', 'deposit': {'count': 1, 'total': '10.00'},
+             'transfer': {'count': 1, 'total': '-4.00'}},
+            {'day': '2020-07-03', 'deposit': {'count': 3, 'total': '30.00'}, 'transfer': {'count': 0, 'total': 0}},
+        ])
+
+        response = self.client.get(url, {'since': '2020-07-31', 'until': '2020-07-01'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'since': '2019-01-01', 'until': '2020-07-01'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(WALLET_REPLICAS=dict(DATABASES=['replica'], MAX_LAG=2, STICKY_SECONDS=5))
+@mock.patch.object(CallBankApiService, 'call_bank_api')
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        self.wallet = create_new_wallet(name="test")
+
+    def test_choose(self, call_bank_api):
+        with mock.patch.object(Replicas, 'measure_lag', return_value=0.5) as measure_lag:
+            self.assertEqual(Replicas.choose([self.wallet.id]), 'replica')
+            self.assertEqual(Replicas.choose(), 'replica')
+            # the lag is measured once per LAG_CHECK_INTERVAL
+            self.assertEqual(measure_lag.call_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            WalletService.deposit(self.wallet.id, Decimal('10'))
+        self.assertEqual(Replicas.choose([self.wallet.id]), 'default')
+        self.assertEqual(Replicas.choose([self.wallet.id + 1]), 'replica')
+
+        Replicas.reset()
+        with mock.patch.object(Replicas, 'measure_lag', return_value=3):
+            self.assertEqual(Replicas.choose([self.wallet.id]), 'default')
+
+    def test_new_wallets_are_sticky(self, call_bank_api):
+        Replicas.reset()
+        with mock.patch.object(Replicas, 'measure_lag', return_value=0):
+            wallet_id = WalletService.create_wallet("new")['wallet_id']
+            self.assertEqual(Replicas.choose([wallet_id]), 'default')
+            wallet_ids = WalletService.create_wallets(["a", "b"])['wallet_ids']
+            self.assertEqual(Replicas.choose(wallet_ids[1:]), 'default')
+            self.assertEqual(Replicas.choose([self.wallet.id]), 'replica')
+
+    def test_router(self, call_bank_api):
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Statement))
+        with mock.patch('app.routers.connections') as connections, activate_database('replica'):
+            connections.__getitem__.return_value.in_atomic_block = False
+            self.assertEqual(router.db_for_read(Statement), 'replica')
+            self.assertEqual(router.db_for_read(Deposit), 'default')
+            self.assertEqual(router.db_for_write(Statement), 'default')
+            # reads inside a transaction on the primary stay on the primary
+            connections.__getitem__.return_value.in_atomic_block = True
+            self.assertEqual(router.db_for_read(Statement), 'default')
+
+
+@skipUnless('replica' in settings.DATABASES and not settings.DATABASES['replica'].get('TEST', {}).get('MIRROR'),
+            'needs a separate replica database, e.g. a second SQLite file')
+@mock.patch.object(CallBankApiService, 'call_bank_api')
+class ReplicaReadTests(TransactionTestCase):
+    """reads against a real second database that does not get the primary's writes"""
+    # computed, django checks the databases of skipped classes too
+    databases = {'default', 'replica'} & set(settings.DATABASES)
+
+    def setUp(self):
+        Replicas.reset()
+        self.wallet = create_new_wallet(name="test")
+        Account.objects.using('replica').create(id=self.wallet.id, name="test")
+        self.url = reverse('statements', args=(self.wallet.id,))
+
+    def statements(self):
+        return len(self.client.get(self.url).json()['ResultObject']['statements'])
+
+    def test_read_your_writes_and_lag_fallback(self, call_bank_api):
+        with override_settings(WALLET_REPLICAS=dict(DATABASES=['replica'], MAX_LAG=60, STICKY_SECONDS=60)):
+            WalletService.deposit(self.wallet.id, Decimal('10'))
+            # the wallet was just written: its reads stay on the primary
+            self.assertEqual(self.statements(), 1)
+        with override_settings(WALLET_REPLICAS=dict(DATABASES=['replica'], MAX_LAG=60)):
+            # the replica has not caught up yet, but is within MAX_LAG
+            self.assertEqual(self.statements(), 0)
+        with override_settings(WALLET_REPLICAS=dict(DATABASES=['replica'], MAX_LAG=0)):
+            self.assertEqual(self.statements(), 1)
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def pool(self, max_size=2, max_lifetime=60, wait_timeout=0.05, ping=lambda connection: True):
+        self.connect = mock.Mock(side_effect=lambda: mock.Mock(name='connection'))
+        return ConnectionPool('test', self.connect, ping, max_size, max_lifetime, wait_timeout, pre_ping=True)
+
+    def test_bounded_with_wait_timeout(self):
+        pool = self.pool()
+        first, second = pool.acquire(), pool.acquire()
+        with self.assertRaises(ConnectionPool.PoolTimeoutError):
+            pool.acquire()
+
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+        self.assertEqual(first.uses, 2)
+        self.assertEqual(self.connect.call_count, 2)
+
+    def test_waiter_gets_released_connection(self):
+        pool = self.pool(max_size=1, wait_timeout=5)
+        pooled = pool.acquire()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            waiting = executor.submit(pool.acquire)
+            time.sleep(0.05)
+            pool.release(pooled)
+            self.assertIs(waiting.result(timeout=5), pooled)
+
+    def test_recycle_and_pre_ping(self):
+        pool = self.pool(max_lifetime=0)
+        pooled = pool.acquire()
+        pool.release(pooled)
+        pooled.connection.close.assert_called_once_with()
+        self.assertEqual(pool.idle, [])
+
+        healthy = {'ok': False}
+        pool = self.pool(ping=lambda connection: healthy['ok'])
+        broken = pool.acquire()
+        pool.release(broken)
+        self.assertIsNot(pool.acquire(), broken)
+        broken.connection.close.assert_called_once_with()
+        self.assertEqual(pool.size, 1)
+
+        # a connection left in a transaction is closed, not reused
+        pooled = pool.acquire()
+        pool.release(pooled, reusable=False)
+        self.assertEqual(pool.size, 1)
+
+
+@override_settings(WALLET_GROUP_COMMIT=dict(ENABLED=True, MAX_BATCH=50, MAX_DELAY=0.05),
+                   WALLET_LOCK_RETRIES=50, WALLET_LOCK_RETRY_BACKOFF=0.005)
+@mock.patch.object(CallBankApiService, 'call_bank_api')
+class GroupCommitTests(TransactionTestCase):
+    # the batch waits for all ten deposits, however slowly they reach it
+    @override_settings(WALLET_GROUP_COMMIT=dict(ENABLED=True, MAX_BATCH=10, MAX_DELAY=30))
+    def test_concurrent_deposits_share_a_commit(self, call_bank_api):
+        wallets = [create_new_wallet(name=f"test{i}").id for i in range(2)]
+        batches = DepositBatcher.batch_sizes.count()
+
+        def deposit(amount):
+            try:
+                return WalletService.deposit(wallets[amount % 2], Decimal(amount))['new_balance']
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            balances = list(executor.map(deposit, range(1, 11)))
+
+        self.assertEqual(DepositBatcher.batch_sizes.count() - batches, 1)
+        self.assertEqual(list(Account.objects.order_by('id').values_list('balance', flat=True)),
+                         [Decimal('30'), Decimal('25')])
+        # every caller got the balance right after its own deposit, as recorded by its statement
+        for deposit in Deposit.objects.select_related('statement'):
+            self.assertEqual(deposit.status, DepositStatus.Settled)
+            self.assertEqual(deposit.statement.amount, deposit.amount)
+            self.assertEqual(balances[int(deposit.amount) - 1], deposit.statement.balance_after_transaction)
+
+    def test_settle_batch(self, call_bank_api):
+        wallet = create_new_wallet(name="test")
+        settled = WalletService.deposit(wallet.id, Decimal('5'))
+        pending = Deposit.objects.create(account=wallet, amount=Decimal('1'), status=DepositStatus.Pending)
+        confirmed = Deposit.objects.create(account=wallet, amount=Decimal('2'), status=DepositStatus.Confirmed)
+        settled_id = Deposit.objects.get(status=DepositStatus.Settled).id
+
+        results = DepositBatcher.settle_batch([settled_id, pending.id, confirmed.id])
+        self.assertEqual(results[settled_id], settled)
+        self.assertIsInstance(results[pending.id], WalletService.DepositError)
+        self.assertEqual(results[confirmed.id], dict(error=0, new_balance=Decimal('7')))
+
+    def test_failed_batch_is_accepted_not_failed(self, call_bank_api):
+        wallet = create_new_wallet(name="test")
+        with mock.patch.object(DepositBatcher, 'settle_batch', side_effect=OperationalError('disk I/O error')):
+            response = self.client.post(reverse('deposit'), data={'wallet_id': wallet.id, 'amount': 5},
+                                        content_type='application/json')
+        # the bank deducted the deposit, so the client is sent to its status instead of told it failed
+        self.assertEqual(response.status_code, 202)
+        deposit = Deposit.objects.get()
+        self.assertEqual(response['Location'], reverse('deposit_status', args=(deposit.id,)))
+        self.assertEqual(self.client.get(response['Location']).json()['ResultObject']['status'], 'confirmed')
+        Deposit.objects.update(modified_time=timezone.now() - timedelta(minutes=10))
+        self.assertEqual(WalletService.recover_deposits(older_than=60), dict(settled=1, review=0))
+        self.assertEqual(Account.objects.get(id=wallet.id).balance, Decimal('5'))
+
+
+@override_settings(WALLET_LOCK_RETRIES=50, WALLET_LOCK_RETRY_BACKOFF=0.005)
+@mock.patch.object(CallBankApiService, 'call_bank_api')
+class DepositJobTests(TransactionTestCase):
+    def deposit(self, wallet_id, amount, **headers):
+        return self.client.post(reverse('deposit'), data=json.dumps({'wallet_id': wallet_id, 'amount': amount}),
+                                content_type='application/json', **headers)
+
+    def test_accepted_deposits_are_settled_by_workers(self, call_bank_api):
+        wallet = create_new_wallet(name="test")
+        response = self.deposit(wallet.id, 5, HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 202)
+        deposit_id = response.json()['ResultObject']['deposit_id']
+        self.assertEqual(response['Location'], reverse('deposit_status', args=(deposit_id,)))
+        with override_settings(WALLET_DEPOSIT_JOBS=dict(ACCEPT=True)):
+            self.assertEqual(self.deposit(wallet.id, 7).status_code, 202)
+            self.assertEqual(self.deposit(999999, 7).json()['Result'], 2)
+        call_bank_api.assert_not_called()
+
+        status = self.client.get(response['Location']).json()['ResultObject']
+        self.assertEqual((status['status'], status['job']['status']), ('pending', 'queued'))
+        self.assertIn('wallet_deposit_jobs{state="queued"} 2', self.client.get(reverse('metrics')).content.decode())
+        # queued deposits are not put under review as stale intents
+        self.assertEqual(WalletService.recover_deposits(older_than=0)['review'], 0)
+
+        out = StringIO()
+        call_command('deposit_worker', drain=True, concurrency=2, stdout=out)
+        self.assertEqual(json.loads(out.getvalue()), dict(claimed=2, queued=0, running=0, oldest_queued_seconds=0))
+        self.assertEqual(call_bank_api.call_count, 2)
+        status = self.client.get(response['Location']).json()['ResultObject']
+        self.assertEqual((status['status'], status['job']['status']), ('settled', 'done'))
+        self.assertEqual(Account.objects.get(id=wallet.id).balance, Decimal('12'))
+        self.assertEqual(Statement.objects.filter(account=wallet, type=TransactionType.Deposit).count(), 2)
+
+    def test_failures_and_expired_leases(self, call_bank_api):
+        wallet = create_new_wallet(name="test")
+        call_bank_api.side_effect = CallBankApiService.CallBankServiceError('bank is down')
+        failed = DepositJobService.enqueue(wallet.id, Decimal('5'))['deposit_id']
+        DepositWorker(1, 0).run(drain=True)
+        status = DepositJobService.status(failed)
+        self.assertEqual((status['status'], status['job']['status']), ('failed', 'failed'))
+
+        # jobs of a worker that died: a confirmed deposit is settled, an unconfirmed one is not charged twice
+        call_bank_api.reset_mock(side_effect=True)
+        confirmed, unknown = (DepositJobService.enqueue(wallet.id, Decimal(amount))['deposit_id'] for amount in (3, 4))
+        Deposit.objects.filter(id=confirmed).update(status=DepositStatus.Confirmed)
+        DepositJob.objects.filter(deposit_id__in=[confirmed, unknown]).update(
+            status=JobStatus.Running, attempts=1, lease_time=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(DepositWorker(2, 0).run(drain=True), 2)
+        call_bank_api.assert_not_called()
+        self.assertEqual(DepositJobService.status(confirmed)['new_balance'], Decimal('3'))
+        self.assertEqual(DepositJobService.status(unknown)['status'], 'review')
+        self.assertEqual(WalletService.resolve_deposit(unknown, False)['status'], 'failed')
+
+    def test_stopped_worker_claims_no_more_jobs(self, call_bank_api):
+        wallet = create_new_wallet(name="test")
+        for _ in range(2):
+            DepositJobService.enqueue(wallet.id, Decimal('1'))
+        worker = DepositWorker(1, 0)
+
+        def bank_call():
+            # SIGTERM while the main thread waits for this job's slot
+            time.sleep(0.1)
+            worker.stopping.set()
+        call_bank_api.side_effect = bank_call
+        self.assertEqual(worker.run(drain=True), 1)
+        self.assertEqual(DepositJobService.queue_stats()['queued'], 1)
+
+    def test_claim_without_skip_locked(self, call_bank_api):
+        wallet = create_new_wallet(name="test")
+        for _ in range(3):
+            DepositJobService.enqueue(wallet.id, Decimal('1'))
+        for skip_locked in (True, False):
+            with mock.patch.object(connection.features, 'has_select_for_update_skip_locked', skip_locked):
+                DepositJob.objects.update(status=JobStatus.Queued, attempts=0)
+                first, second = DepositJobService.claim('a', 2), DepositJobService.claim('b', 5)
+                self.assertEqual([len(first), len(second)], [2, 1])
+                self.assertEqual(sorted(DepositJob.objects.values_list('worker', flat=True)), ['a', 'a', 'b'])
+                self.assertEqual(DepositJobService.claim('c', 5), [])
+
@@ -1,13 +1,32 @@
+from django.conf import settings
 from django.urls import path
-from app.views import CreateWalletView, DepositView, TransferView, QueryStatementView
+from app.views import CreateWalletView, DepositView, TransferView, BatchTransferView, QueryStatementView
+from app.views import StatementListView, StatementExportView, BalanceView, DailyReportView
+from app.views import AsyncCreateWalletView, AsyncDepositView, AsyncTransferView, BulkCreateWalletView
+from app.views import AccountSearchView, DepositStatusView
 from . import views
 
+# the ASGI entry point (wallet.asgi) serves the async api views
+if settings.WALLET_ASYNC_VIEWS:
+    create_wallet_view, deposit_view, transfer_view = AsyncCreateWalletView, AsyncDepositView, AsyncTransferView
+else:
+    create_wallet_view, deposit_view, transfer_view = CreateWalletView, DepositView, TransferView
+
 
 urlpatterns = [
     path('', views.index, name='index'),
-    path('api/user/new/', CreateWalletView.as_view(), name='create_wallet'),
-    path('api/wallet/deposit/', DepositView.as_view(), name='deposit'),
-    path('api/wallet/transfer/', TransferView.as_view(), name='transfer'),
+    path('api/metrics/', views.metrics, name='metrics'),
+    path('api/user/new/', create_wallet_view.as_view(), name='create_wallet'),
+    path('api/user/bulk/', BulkCreateWalletView.as_view(), name='create_wallets'),
+    path('api/wallet/deposit/', deposit_view.as_view(), name='deposit'),
+    path('api/wallet/deposits/<int:deposit_id>/', DepositStatusView.as_view(), name='deposit_status'),
+    path('api/wallet/transfer/', transfer_view.as_view(), name='transfer'),
+    path('api/wallet/transfer/batch/', BatchTransferView.as_view(), name='transfer_batch'),
+    path('api/wallet/search/', AccountSearchView.as_view(), name='search_wallets'),
+    path('api/wallet/<int:account_id>/balance/', BalanceView.as_view(), name='balance'),
+    path('api/wallet/<int:account_id>/statements/', StatementListView.as_view(), name='statements'),
+    path('api/wallet/<int:account_id>/statements/export/', StatementExportView.as_view(), name='statements_export'),
+    path('api/wallet/<int:account_id>/reports/daily/', DailyReportView.as_view(), name='daily_report'),
     path('web/wallet/statements/', views.query, name='query_statement'),
     path('web/wallet/statements/<int:account_id>/<int:count>', QueryStatementView.as_view(), name='results'),
 ]
\ No newline at end of file
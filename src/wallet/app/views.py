@@ -1,17 +1,38 @@
+import asyncio
+import csv
+import functools
 import json
 import logging
+import re
+import time
 
+from datetime import timedelta
+from decimal import Decimal
 from enum import IntEnum
+from django.conf import settings
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, HttpResponseBadRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django import http
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest, StreamingHttpResponse
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.text import compress_sequence
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
 from typing import NamedTuple
 from app.models import Account
-from app.forms import CreateWalletForm, DepositForm, TransferForm
-from app.services import WalletService, CallBankApiService
+from app.forms import StatementQueryForm, StatementExportForm, DailyReportForm, AccountSearchForm
+from app import metrics as wallet_metrics, profiling, routers
+from app.cache import BalanceCache
+from app.idempotency import IdempotencyService
+from app.jobs import DepositJobService
+from app.rollup import DailyRollupService
+from app.routers import reads_from_replica
+from app.schemas import BulkCreateWalletSchema, CreateWalletSchema, DepositSchema, Schema, TransferSchema
+from app.schemas import WalletJSONEncoder
+from app.search import AccountIndex
+from app.services import WalletService, CallBankApiService, OrmExecutor, StatementService
 
 logger = logging.getLogger('default')
 
@@ -20,6 +41,23 @@ def index(request):
     return HttpResponse("Hello world. You're at the e-wallet api index.")
 
 
+def metrics(request):
+    """Prometheus scrape endpoint"""
+    # the deposit job queue is shared by all processes, read its depth and age at scrape time
+    DepositJobService.queue_stats()
+    return HttpResponse(wallet_metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class JsonResponse(http.JsonResponse):
+    """
+    JsonResponse encoded by the compact, Decimal-first `WalletJSONEncoder`; its encoding time is
+    reported as the `serialize` phase of the request
+    """
+    def __init__(self, data, encoder=WalletJSONEncoder, **kwargs):
+        with profiling.timed('serialize'):
+            super().__init__(data, encoder=encoder, **kwargs)
+
+
 class WalletResponse(NamedTuple):
     Result: int
     Message: str = None
@@ -32,9 +70,102 @@ class ResultCode(IntEnum):
     InvalidRequestParameter = 9
 
 
+def idempotent(scope):
+    """
+    Honour an optional `Idempotency-Key` header on a post handler: the first request with a key runs
+    and its response is stored, retries with the same key and body replay that response without running
+    the handler again, and concurrent duplicates wait for the first request to finish.
+    """
+    def decorator(post):
+        if asyncio.iscoroutinefunction(post):
+            @functools.wraps(post)
+            async def wrapper(self, request, *args, **kwargs):
+                key = request.headers.get('Idempotency-Key')
+                if not key:
+                    return await post(self, request, *args, **kwargs)
+                if len(key) > 128:
+                    return idempotency_key_invalid()
+                fingerprint = IdempotencyService.fingerprint(request)
+                try:
+                    claim, stored = await IdempotencyService.abegin(scope, key, fingerprint, OrmExecutor.run)
+                except (IdempotencyService.KeyReusedError, IdempotencyService.InProgressError) as e:
+                    return idempotency_conflict(e)
+                if stored is not None:
+                    return idempotency_replay(*stored)
+                try:
+                    response = await post(self, request, *args, **kwargs)
+                except BaseException:
+                    await OrmExecutor.run(IdempotencyService.release, claim)
+                    raise
+                await OrmExecutor.run(idempotency_finish, scope, key, claim, fingerprint, response)
+                return response
+        else:
+            @functools.wraps(post)
+            def wrapper(self, request, *args, **kwargs):
+                key = request.headers.get('Idempotency-Key')
+                if not key:
+                    return post(self, request, *args, **kwargs)
+                if len(key) > 128:
+                    return idempotency_key_invalid()
+                fingerprint = IdempotencyService.fingerprint(request)
+                try:
+                    claim, stored = IdempotencyService.begin(scope, key, fingerprint)
+                except (IdempotencyService.KeyReusedError, IdempotencyService.InProgressError) as e:
+                    return idempotency_conflict(e)
+                if stored is not None:
+                    return idempotency_replay(*stored)
+                try:
+                    response = post(self, request, *args, **kwargs)
+                except BaseException:
+                    IdempotencyService.release(claim)
+                    raise
+                idempotency_finish(scope, key, claim, fingerprint, response)
+                return response
+        return wrapper
+    return decorator
+
+
+def idempotency_finish(scope, key, claim, fingerprint, response):
+    # server errors are not stored, the client may retry them with the same key
+    if response.status_code >= 500:
+        IdempotencyService.release(claim)
+    else:
+        IdempotencyService.complete(scope, key, claim, fingerprint, response.status_code,
+                                    response.content.decode('utf-8'))
+
+
+def idempotency_replay(status_code, content):
+    response = HttpResponse(content, status=status_code, content_type='application/json')
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotency_key_invalid():
+    return JsonResponse(
+        status=HttpResponseBadRequest.status_code,
+        data=WalletResponse(
+            Result=ResultCode.InvalidRequestParameter.value,
+            Message="Idempotency-Key must be at most 128 characters"
+        )._asdict())
+
+
+def idempotency_conflict(e):
+    logger.error(f"Error: {e}")
+    if isinstance(e, IdempotencyService.KeyReusedError):
+        status, message = 422, "Idempotency-Key was already used with a different request"
+    else:
+        status, message = 409, "A request with this Idempotency-Key is still in progress"
+    return JsonResponse(
+        status=status,
+        data=WalletResponse(
+            Result=ResultCode.Fail.value,
+            Message=message
+        )._asdict())
+
+
 # create new wallet
 class CreateWalletView(View):
-    form_class = CreateWalletForm
+    schema = CreateWalletSchema
 
     @csrf_exempt
     def dispatch(self, request, *args, **kwargs):
@@ -53,9 +184,9 @@ class CreateWalletView(View):
         curl -X POST -H "Content-Type: application/json" -d '{"name":"Bob"}' "http://localhost:8080/api/user/new/"
         """
         try:
-            body = json.loads(request.body.decode('utf-8'))
-        except Exception as e:
-            logger.error(f'invalid body: %s\n%s', request.body, e)
+            data = self.schema.load(request.body)
+        except Schema.InvalidBodyError as e:
+            logger.error('invalid body: %s\n%s', request.body[:200], e)
             return JsonResponse(
                 status=HttpResponseBadRequest.status_code,
                 data=WalletResponse(
@@ -63,18 +194,51 @@ class CreateWalletView(View):
                     Message='資料驗證錯誤'
                 )._asdict()
             )
-
-        form = self.form_class(body)
-        if form.is_valid():
-            name = form.cleaned_data['name']
-            # create wallet service
-            result_object = WalletService.create_wallet(name)
+        except Schema.ValidationError:
             return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
                 data=WalletResponse(
-                    Result=ResultCode.Success.value,
-                    ResultObject=result_object
+                    Result=ResultCode.Fail.value,
+                    Message="Invalid request parameters"
                 )._asdict())
-        else:
+
+        name = data['name']
+        # create wallet service
+        result_object = WalletService.create_wallet(name)
+        return JsonResponse(
+            data=WalletResponse(
+                Result=ResultCode.Success.value,
+                ResultObject=result_object
+            )._asdict())
+
+
+class BulkCreateWalletView(View):
+    schema = BulkCreateWalletSchema
+
+    @csrf_exempt
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def post(self, request):
+        """
+        create a wallet per name, the new wallet ids are returned in the order of the names:
+            curl -X POST -H "Content-Type: application/json" -d '{"names": ["Bob", "Alice"]}'
+            "http://localhost:8080/api/user/bulk/"
+        """
+        try:
+            names = self.schema.load(request.body)['names']
+            if len(names) > settings.WALLET_CREATE_BULK_MAX:
+                raise Schema.ValidationError({'names': f'1 to {settings.WALLET_CREATE_BULK_MAX} names'})
+        except Schema.InvalidBodyError as e:
+            logger.error('invalid body: %s\n%s', request.body[:200], e)
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.InvalidRequestParameter.value,
+                    Message='資料驗證錯誤'
+                )._asdict()
+            )
+        except Schema.ValidationError:
             return JsonResponse(
                 status=HttpResponseBadRequest.status_code,
                 data=WalletResponse(
@@ -82,9 +246,20 @@ class CreateWalletView(View):
                     Message="Invalid request parameters"
                 )._asdict())
 
+        # bulk create wallet service
+        start = time.perf_counter()
+        result_object = WalletService.create_wallets(names)
+        elapsed = time.perf_counter() - start
+        logger.info('Created %s wallets in %.3fs (%.0f wallets/s)', len(names), elapsed, len(names) / elapsed)
+        return JsonResponse(
+            data=WalletResponse(
+                Result=ResultCode.Success.value,
+                ResultObject=result_object
+            )._asdict())
+
 
 class DepositView(View):
-    form_class = DepositForm
+    schema = DepositSchema
 
     @csrf_exempt
     def dispatch(self, request, *args, **kwargs):
@@ -98,15 +273,17 @@ class DepositView(View):
                 ResultObject=result_object
             )._asdict())
 
+    @idempotent('deposit')
     def post(self, request):
         """
-        curl -X POST -H "Content-Type: application/json" -d '{"wallet_id":1, "amount":12.34}'
+        curl -X POST -H "Content-Type: application/json" -H "Idempotency-Key: 3f0c..."
+        -d '{"wallet_id":1, "amount":12.34}'
         "http://localhost:8080/api/wallet/deposit/"
         """
         try:
-            body = json.loads(request.body.decode('utf-8'))
-        except Exception as e:
-            logger.error(f'invalid body: %s\n%s', request.body, e)
+            data = self.schema.load(request.body)
+        except Schema.InvalidBodyError as e:
+            logger.error('invalid body: %s\n%s', request.body[:200], e)
             return JsonResponse(
                 status=HttpResponseBadRequest.status_code,
                 data=WalletResponse(
@@ -114,28 +291,7 @@ class DepositView(View):
                     Message='資料驗證錯誤'
                 )._asdict()
             )
-
-        form = self.form_class(body)
-        if form.is_valid():
-            wallet_id = form.cleaned_data['wallet_id']
-            amount = form.cleaned_data['amount']
-            try:
-                # deposit service
-                result_object = WalletService.deposit(wallet_id, amount)
-                return JsonResponse(
-                    data=WalletResponse(
-                        Result=ResultCode.Success.value,
-                        ResultObject=result_object
-                    )._asdict())
-            # DepositError include: Account.DoesNotExist, CallBankServiceError, InsufficientMoneyError
-            except WalletService.DepositError as e:
-                logger.error(f"Error: {e}")
-                return JsonResponse(
-                    data=WalletResponse(
-                        Result=ResultCode.Fail.value,
-                        Message="Deposit failed"
-                    )._asdict())
-        else:
+        except Schema.ValidationError:
             return JsonResponse(
                 status=HttpResponseBadRequest.status_code,
                 data=WalletResponse(
@@ -143,9 +299,67 @@ class DepositView(View):
                     Message="Invalid request parameters"
                 )._asdict())
 
+        wallet_id = data['wallet_id']
+        amount = data['amount']
+        try:
+            if DepositJobService.accepts(request):
+                return accepted(DepositJobService.enqueue(wallet_id, amount))
+            # deposit service
+            result_object = WalletService.deposit(wallet_id, amount)
+            if 'new_balance' not in result_object:
+                # deducted by the bank but not settled yet, not a failure
+                return accepted(result_object)
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Success.value,
+                    ResultObject=result_object
+                )._asdict())
+        # DepositError include: Account.DoesNotExist, CallBankServiceError, InsufficientMoneyError
+        except WalletService.DepositError as e:
+            logger.error(f"Error: {e}")
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="Deposit failed"
+                )._asdict())
+
+
+def accepted(result_object):
+    """202 answer of an accepted deposit, its status is polled at the Location"""
+    status_url = reverse('deposit_status', args=(result_object['deposit_id'],))
+    response = JsonResponse(
+        status=202,
+        data=WalletResponse(
+            Result=ResultCode.Success.value,
+            ResultObject=dict(result_object, status_url=status_url)
+        )._asdict())
+    response['Location'] = status_url
+    return response
+
+
+class DepositStatusView(View):
+    def get(self, request, deposit_id):
+        """
+        status of a deposit, pending, confirmed, settled (with new_balance) or failed:
+            http://localhost:8080/api/wallet/deposits/1/
+        """
+        result_object = DepositJobService.status(deposit_id)
+        if result_object is None:
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="The deposit does not exist"
+                )._asdict())
+        return JsonResponse(
+            data=WalletResponse(
+                Result=ResultCode.Success.value,
+                ResultObject=result_object
+            )._asdict())
+
 
 class TransferView(View):
-    form_class = TransferForm
+    schema = TransferSchema
 
     @csrf_exempt
     def dispatch(self, request, *args, **kwargs):
@@ -159,15 +373,73 @@ class TransferView(View):
                 ResultObject=result_object
             )._asdict())
 
+    @idempotent('transfer')
     def post(self, request):
         """
-        curl -X POST -H "Content-Type: application/json" -d '{"from_wallet_id":2, "to_wallet_id": 1, "amount":10}'
+        curl -X POST -H "Content-Type: application/json" -H "Idempotency-Key: 3f0c..."
+        -d '{"from_wallet_id":2, "to_wallet_id": 1, "amount":10}'
         "http://localhost:8080/api/wallet/transfer/"
         """
         try:
-            body = json.loads(request.body.decode('utf-8'))
+            data = self.schema.load(request.body)
+        except Schema.InvalidBodyError as e:
+            logger.error('invalid body: %s\n%s', request.body[:200], e)
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.InvalidRequestParameter.value,
+                    Message='資料驗證錯誤'
+                )._asdict()
+            )
+        except Schema.ValidationError:
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="Invalid request parameters"
+                )._asdict())
+
+        from_wallet_id = data['from_wallet_id']
+        to_wallet_id = data['to_wallet_id']
+        amount = data['amount']
+        try:
+            # transfer service
+            result_object = WalletService.transfer(from_wallet_id, to_wallet_id, amount)
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Success.value,
+                    ResultObject=result_object
+                )._asdict())
+        # TransferError include: WalletService.MoneyValueError, Account.DoesNotExist
+        except WalletService.TransferError as e:
+            logger.error(f"Error: {e}")
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="Transfer failed"
+                )._asdict())
+
+
+class BatchTransferView(View):
+    schema = TransferSchema
+
+    @csrf_exempt
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def post(self, request):
+        """
+        curl -X POST -H "Content-Type: application/json"
+        -d '{"atomic": true, "transfers": [{"from_wallet_id":2, "to_wallet_id": 1, "amount":10}]}'
+        "http://localhost:8080/api/wallet/transfer/batch/"
+        """
+        try:
+            body = json.loads(request.body, parse_float=Decimal)
+            items, atomic = body['transfers'], body.get('atomic', True)
+            if not isinstance(items, list) or not isinstance(atomic, bool):
+                raise ValueError('transfers must be a list and atomic a boolean')
         except Exception as e:
-            logger.error(f'invalid body: %s\n%s', request.body, e)
+            logger.error('invalid body: %s\n%s', request.body[:200], e)
             return JsonResponse(
                 status=HttpResponseBadRequest.status_code,
                 data=WalletResponse(
@@ -176,40 +448,265 @@ class TransferView(View):
                 )._asdict()
             )
 
-        form = self.form_class(body)
-        if form.is_valid():
-            from_wallet_id = form.cleaned_data['from_wallet_id']
-            to_wallet_id = form.cleaned_data['to_wallet_id']
-            amount = form.cleaned_data['amount']
-            try:
-                # transfer service
-                result_object = WalletService.transfer(from_wallet_id, to_wallet_id, amount)
-                return JsonResponse(
-                    data=WalletResponse(
-                        Result=ResultCode.Success.value,
-                        ResultObject=result_object
-                    )._asdict())
-            # TransferError include: WalletService.MoneyValueError, Account.DoesNotExist
-            except WalletService.TransferError as e:
-                logger.error(f"Error: {e}")
-                return JsonResponse(
-                    data=WalletResponse(
-                        Result=ResultCode.Fail.value,
-                        Message="Transfer failed"
-                    )._asdict())
-        else:
+        try:
+            if not items or len(items) > settings.WALLET_TRANSFER_BATCH_MAX:
+                raise Schema.ValidationError({'transfers': f'1 to {settings.WALLET_TRANSFER_BATCH_MAX} transfers'})
+            transfers = [(data['from_wallet_id'], data['to_wallet_id'], data['amount'])
+                         for data in map(self.schema.validate, items)]
+        except (Schema.InvalidBodyError, Schema.ValidationError):
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="Invalid request parameters"
+                )._asdict())
+        try:
+            # batch transfer service
+            result_object = WalletService.transfer_many(transfers, atomic=atomic)
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Success.value,
+                    ResultObject=result_object
+                )._asdict())
+        except WalletService.TransferError as e:
+            logger.error(f"Error: {e}")
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="Transfer failed"
+                )._asdict())
+
+
+class AsyncWalletView(View):
+    """
+    Base class of the async api views served by `wallet.asgi`. The bank call is awaited on the
+    async bank client and ORM work runs on the bounded `OrmExecutor` pool. Subclasses set `schema` and
+    define `async def handle(...)`, which `post` calls with the fields the schema loaded.
+    """
+    schema = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        # class-based views are sync-only before Django 4.1, a coroutine function makes the handler await it
+        async def async_view(request, *args, **kwargs):
+            return await view(request, *args, **kwargs)
+
+        # keeps view_class, view_initkwargs and csrf_exempt
+        return functools.update_wrapper(async_view, view)
+
+    @csrf_exempt
+    async def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        # options and http_method_not_allowed answer synchronously
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    async def get(self, request):
+        result_object = {"error": 0}
+        return JsonResponse(
+            data=WalletResponse(
+                Result=ResultCode.Success.value,
+                ResultObject=result_object
+            )._asdict())
+
+    async def post(self, request):
+        try:
+            data = self.schema.load(request.body)
+        except Schema.InvalidBodyError as e:
+            logger.error('invalid body: %s\n%s', request.body[:200], e)
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.InvalidRequestParameter.value,
+                    Message='資料驗證錯誤'
+                )._asdict()
+            )
+        except Schema.ValidationError:
             return JsonResponse(
                 status=HttpResponseBadRequest.status_code,
                 data=WalletResponse(
                     Result=ResultCode.Fail.value,
                     Message="Invalid request parameters"
                 )._asdict())
+        return await self.handle(**data)
 
 
+class AsyncCreateWalletView(AsyncWalletView):
+    schema = CreateWalletSchema
+
+    async def handle(self, name):
+        result_object = await OrmExecutor.run(WalletService.create_wallet, name)
+        return JsonResponse(
+            data=WalletResponse(
+                Result=ResultCode.Success.value,
+                ResultObject=result_object
+            )._asdict())
+
+
+class AsyncDepositView(AsyncWalletView):
+    schema = DepositSchema
+    post = idempotent('deposit')(AsyncWalletView.post)
+
+    async def handle(self, wallet_id, amount):
+        try:
+            if DepositJobService.accepts(self.request):
+                return accepted(await OrmExecutor.run(DepositJobService.enqueue, wallet_id, amount))
+            result_object = await WalletService.adeposit(wallet_id, amount)
+            if 'new_balance' not in result_object:
+                return accepted(result_object)
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Success.value,
+                    ResultObject=result_object
+                )._asdict())
+        except WalletService.DepositError as e:
+            logger.error(f"Error: {e}")
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="Deposit failed"
+                )._asdict())
+
+
+class AsyncTransferView(AsyncWalletView):
+    schema = TransferSchema
+    post = idempotent('transfer')(AsyncWalletView.post)
+
+    async def handle(self, from_wallet_id, to_wallet_id, amount):
+        try:
+            result_object = await OrmExecutor.run(WalletService.transfer, from_wallet_id, to_wallet_id, amount)
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Success.value,
+                    ResultObject=result_object
+                )._asdict())
+        except WalletService.TransferError as e:
+            logger.error(f"Error: {e}")
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="Transfer failed"
+                )._asdict())
+
+
+class BalanceView(View):
+    @reads_from_replica
+    def get(self, request, account_id):
+        """
+        get the balance of a wallet from the balance cache:
+            http://localhost:8080/api/wallet/1/balance/
+        """
+        try:
+            balance = BalanceCache.get_balance(account_id)
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Success.value,
+                    ResultObject=dict(error=0, wallet_id=account_id, balance=balance)
+                )._asdict())
+        except Account.DoesNotExist:
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="The wallet does not exist"
+                )._asdict())
+
+
+class DailyReportView(View):
+    form_class = DailyReportForm
+
+    @reads_from_replica
+    def get(self, request, account_id):
+        """
+        daily deposit and transfer count and sum of a wallet from the precomputed summaries,
+        the last 30 days by default:
+            http://localhost:8080/api/wallet/1/reports/daily/?since=2020-07-01&until=2020-07-31
+        """
+        form = self.form_class(request.GET)
+        valid = form.is_valid()
+        if valid:
+            until = form.cleaned_data['until'] or timezone.now().date()
+            since = form.cleaned_data['since'] or until - timedelta(days=30)
+            valid = since <= until and (until - since).days < settings.WALLET_REPORT_MAX_DAYS
+        if not valid:
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.InvalidRequestParameter.value,
+                    Message="Invalid request parameters"
+                )._asdict())
+
+        if not Account.objects.filter(id=account_id).exists():
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="The wallet does not exist"
+                )._asdict())
+
+        return JsonResponse(
+            data=WalletResponse(
+                Result=ResultCode.Success.value,
+                ResultObject=dict(DailyRollupService.report(account_id, since, until), wallet_id=account_id,
+                                  since=since, until=until)
+            )._asdict())
+
+
+class AccountSearchView(View):
+    form_class = AccountSearchForm
+
+    @reads_from_replica
+    def get(self, request):
+        """
+        typeahead search of wallets by name or id prefix, id, name and balance of each:
+            http://localhost:8080/api/wallet/search/?q=bo&limit=20
+        get the next page:
+            http://localhost:8080/api/wallet/search/?q=bo&limit=20&cursor=<next_cursor>
+        a query of digits searches ids unless field=name
+        """
+        form = self.form_class(request.GET)
+        if not form.is_valid():
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.InvalidRequestParameter.value,
+                    Message="Invalid request parameters"
+                )._asdict())
+
+        try:
+            result_object = AccountIndex.search(**form.cleaned_data)
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Success.value,
+                    ResultObject=result_object
+                )._asdict())
+        except AccountIndex.InvalidCursorError as e:
+            logger.error(f"Error: {e}")
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.InvalidRequestParameter.value,
+                    Message="Invalid cursor"
+                )._asdict())
+
+
+@reads_from_replica
 def query(request):
-    account_list = Account.objects.all()
+    # one page of the account search instead of every account
+    form = AccountSearchForm(request.GET)
+    search = form.cleaned_data if form.is_valid() else {}
+    try:
+        result_object = AccountIndex.search(**search)
+    except AccountIndex.InvalidCursorError:
+        search = dict(search, cursor=None)
+        result_object = AccountIndex.search(**search)
     context = {
-        'account_list': account_list,
+        'account_list': result_object['wallets'],
+        'q': search.get('q', ''),
+        'next_cursor': result_object['next_cursor'],
     }
     return render(request, 'app/query.html', context)
 
@@ -222,6 +719,7 @@ class QueryStatementView(View):
     def dispatch(self, request, *args, **kwargs):
         return super().dispatch(request, *args, **kwargs)
 
+    @reads_from_replica
     def get(self, request, account_id, count=0):
         """
         get all transaction statements:
@@ -231,11 +729,10 @@ class QueryStatementView(View):
         """
         try:
             account = Account.objects.get(id=account_id)
-            selected_wallet = account.statement_set.filter(wallet_id=account_id)
-            if count != 0:
-                statement_list = selected_wallet.order_by('-create_time')[:count]
-            else:
-                statement_list = selected_wallet.order_by('-create_time')
+            # the page is capped, /api/wallet/<id>/statements/ pages through the full history
+            if count == 0 or count > settings.WALLET_STATEMENT_PAGE_SIZE_MAX:
+                count = settings.WALLET_STATEMENT_PAGE_SIZE_MAX
+            statement_list = account.statement_set.order_by('-create_time', '-id')[:count]
             return render(request, 'app/results.html', {'account': account, 'statement_list': statement_list})
 
         except Account.DoesNotExist:
@@ -262,3 +759,113 @@ class QueryStatementView(View):
                     Result=ResultCode.Fail.value,
                     Message="The wallet does not exist"
                 )._asdict())
+
+
+class StatementListView(View):
+    form_class = StatementQueryForm
+
+    @reads_from_replica
+    def get(self, request, account_id):
+        """
+        get the newest 50 transaction statements:
+            http://localhost:8080/api/wallet/1/statements/?limit=50
+        get the next page:
+            http://localhost:8080/api/wallet/1/statements/?limit=50&cursor=<next_cursor>
+        filters: type, min_amount, max_amount, since, until
+        """
+        form = self.form_class(request.GET)
+        if not form.is_valid():
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.InvalidRequestParameter.value,
+                    Message="Invalid request parameters"
+                )._asdict())
+
+        if not Account.objects.filter(id=account_id).exists():
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="The wallet does not exist"
+                )._asdict())
+
+        try:
+            result_object = StatementService.query(account_id, **form.cleaned_data)
+            return JsonResponse(
+                data=WalletResponse(
+                    Result=ResultCode.Success.value,
+                    ResultObject=result_object
+                )._asdict())
+        except StatementService.InvalidCursorError as e:
+            logger.error(f"Error: {e}")
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.InvalidRequestParameter.value,
+                    Message="Invalid cursor"
+                )._asdict())
+
+
+class Echo:
+    """file-like object whose write returns the value, so csv.writer can feed a generator"""
+    def write(self, value):
+        return value
+
+
+class StatementExportView(View):
+    form_class = StatementExportForm
+    accepts_gzip = re.compile(r'\bgzip\b')
+
+    @reads_from_replica
+    def get(self, request, account_id):
+        """
+        stream all transaction statements as csv (default) or ndjson, gzip encoded if the client accepts it:
+            curl --compressed "http://localhost:8080/api/wallet/1/statements/export/?format=ndjson&since=2020-07-01"
+        """
+        form = self.form_class(request.GET)
+        if not form.is_valid():
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.InvalidRequestParameter.value,
+                    Message="Invalid request parameters"
+                )._asdict())
+
+        if not Account.objects.filter(id=account_id).exists():
+            return JsonResponse(
+                status=HttpResponseBadRequest.status_code,
+                data=WalletResponse(
+                    Result=ResultCode.Fail.value,
+                    Message="The wallet does not exist"
+                )._asdict())
+
+        export_format = form.cleaned_data['format'] or 'csv'
+        rows = StatementService.export(account_id, since=form.cleaned_data['since'], until=form.cleaned_data['until'])
+        if export_format == 'csv':
+            content, content_type = self.csv_lines(rows), 'text/csv'
+        else:
+            content, content_type = self.ndjson_lines(rows), 'application/x-ndjson'
+        # the rows are read while the response streams, after the view returned
+        content = (line.encode('utf-8') for line in routers.stream(content, routers.current()))
+
+        if self.accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            response = StreamingHttpResponse(compress_sequence(content), content_type=content_type)
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = StreamingHttpResponse(content, content_type=content_type)
+        response['Vary'] = 'Accept-Encoding'
+        response['Content-Disposition'] = f'attachment; filename="wallet-{account_id}-statements.{export_format}"'
+        return response
+
+    @staticmethod
+    def csv_lines(rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(StatementService.FIELDS)
+        for row in rows:
+            yield writer.writerow([row[field] for field in StatementService.FIELDS])
+
+    @staticmethod
+    def ndjson_lines(rows):
+        for row in rows:
+            yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
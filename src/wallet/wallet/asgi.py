@@ -0,0 +1,23 @@
+"""
+ASGI config for wallet project.
+
+It exposes the ASGI callable as a module-level variable named ``application``
+and serves the async api views.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "wallet.settings")
+os.environ.setdefault("WALLET_ASYNC_VIEWS", "1")
+
+application = get_asgi_application()
+
+# warm the account search index of the serving process outside of its requests
+from app.search import AccountIndex  # noqa: E402
+
+AccountIndex.start_refresher()
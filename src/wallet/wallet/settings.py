@@ -40,6 +40,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.profiling.ProfilingMiddleware',
+    'app.log.RequestLogMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -69,18 +71,23 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'wallet.wsgi.application'
 
+ASGI_APPLICATION = 'wallet.asgi.application'
+
 
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        # django's MySQL backend taking its connections from a pool, see WALLET_DB_POOL
+        'ENGINE': 'app.backends.mysql',
         'NAME': 'wallet_db',  # Or path to database file if using sqlite3.
         'USER': 'wallet_db_admin',  # Not used with sqlite3.
         'PASSWORD': '1234',  # Not used with sqlite3.
         'HOST': '',  # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',  # Set to empty string for default. Not used with sqlite3.
+        # connections go back to the pool at the end of every request
+        'CONN_MAX_AGE': 0,
         'OPTIONS': {
             'charset': 'utf8mb4',
         },
@@ -90,6 +97,15 @@ DATABASES = {
     }
 }
 
+# a read replica of the default database, see WALLET_REPLICAS
+if os.environ.get('WALLET_REPLICA_HOST'):
+    DATABASES['replica'] = dict(DATABASES['default'], HOST=os.environ['WALLET_REPLICA_HOST'],
+                                TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['app.routers.ReplicaRouter']
+
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -115,10 +131,17 @@ LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'handlers': {
+        # JSON lines written by a background thread, see app.log.queue_file_handler
         'file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': 'wallet-project.log'
+            '()': 'app.log.queue_file_handler',
+            # appended to by every process and rotated externally, e.g. by logrotate; None writes to stdout
+            'filename': os.environ.get('WALLET_LOG_FILE', 'wallet-project.log') or None,
+            'queue_size': 10000,
+            # when the queue is full, records below block_level are dropped, the others wait up to
+            # block_timeout seconds for space (0: never block the request thread)
+            'block_level': 'ERROR',
+            'block_timeout': 0,
         },
     },
     'loggers': {
@@ -135,6 +158,132 @@ LOGGING = {
     },
 }
 
+# wallet
+# serve the async api views, set by the ASGI entry point (wallet.asgi)
+WALLET_ASYNC_VIEWS = os.environ.get('WALLET_ASYNC_VIEWS', '0') == '1'
+# size of the thread pool async views use for ORM work
+WALLET_ORM_THREADS = 20
+# retries (and base backoff in seconds) of transfers aborted by a deadlock or lock wait timeout
+WALLET_LOCK_RETRIES = 3
+WALLET_LOCK_RETRY_BACKOFF = 0.02
+# wallets inserted per transaction by bulk wallet creation, and max number of names in one /api/user/bulk/ request
+WALLET_CREATE_BATCH_SIZE = 5000
+WALLET_CREATE_BULK_MAX = 10000
+# max number of transfers in one /api/wallet/transfer/batch/ request
+WALLET_TRANSFER_BATCH_MAX = 5000
+# default and max page size of statement queries
+WALLET_STATEMENT_PAGE_SIZE = 50
+WALLET_STATEMENT_PAGE_SIZE_MAX = 500
+# rows read per query by the streaming statement export
+WALLET_EXPORT_CHUNK_SIZE = 2000
+# max number of days in one daily report request
+WALLET_REPORT_MAX_DAYS = 366
+
+# balance cache, see app.cache.DEFAULT_BALANCE_CACHE for all keys
+WALLET_BALANCE_CACHE = {
+    'MAX_SIZE': 100000,
+    'TTL': 5,
+    'SHARED_BACKEND': None,
+}
+
+# bank api client, see app.bank.DEFAULT_BANK_API for all keys
+BANK_API = {
+    'URL': os.environ.get('WALLET_BANK_API_URL', 'http://www.mocky.io/v2/5acadd1b2e00005600bbaa36?mocky-delay=3000ms'),
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    'POOL_SIZE': 10,
+    'ASYNC_POOL_SIZE': 100,
+    'MAX_RETRIES': 2,
+    # the bank deduplicates on Idempotency-Key, so calls that may have reached it can be retried as well
+    'IDEMPOTENT': os.environ.get('WALLET_BANK_API_IDEMPOTENT', '0') == '1',
+    'CIRCUIT_FAILURE_THRESHOLD': 5,
+    'CIRCUIT_RESET_TIMEOUT': 30,
+}
+
+# seconds before an unfinished deposit intent is picked up by `manage.py recover_deposits`
+WALLET_DEPOSIT_RECOVERY_AGE = 60
+
+# accepted deposits settled by `manage.py deposit_worker`, see app.jobs.DEFAULT_DEPOSIT_JOBS for all keys
+WALLET_DEPOSIT_JOBS = {
+    'ACCEPT': os.environ.get('WALLET_DEPOSIT_ACCEPT', '0') == '1',
+    'CONCURRENCY': int(os.environ.get('WALLET_DEPOSIT_WORKERS', 8)),
+    'PROCESSES': 1,
+    'LEASE': 60,
+}
+
+# group commit of deposits, see app.services.DEFAULT_GROUP_COMMIT for all keys
+WALLET_GROUP_COMMIT = {
+    'ENABLED': os.environ.get('WALLET_GROUP_COMMIT', '0') == '1',
+    'MAX_BATCH': 100,
+    'MAX_DELAY': 0.005,
+    'TIMEOUT': 10,
+}
+
+# transfer and deposit engine, 'pessimistic' (row locks) or 'optimistic' (version columns),
+# see app.services.DEFAULT_CONCURRENCY for all keys
+WALLET_CONCURRENCY = {
+    'ENGINE': os.environ.get('WALLET_CONCURRENCY_ENGINE', 'pessimistic'),
+    'MAX_ATTEMPTS': 3,
+}
+
+# lock-free checks of transfers before their transaction, see app.services.DEFAULT_TRANSFER_PRECHECK for all keys
+WALLET_TRANSFER_PRECHECK = {
+    'ENABLED': True,
+    'MISSING_TTL': 5,
+}
+
+# in-process account search index, see app.search.DEFAULT_ACCOUNT_INDEX for all keys
+WALLET_ACCOUNT_INDEX = {
+    'REFRESH_INTERVAL': 5,
+    'REBUILD_INTERVAL': 3600,
+    'REBUILD_FRACTION': 0.05,
+    'PAGE_SIZE': 20,
+    'PAGE_SIZE_MAX': 100,
+}
+
+# request profiling, see app.profiling.DEFAULT_PROFILING for all keys
+WALLET_PROFILING = {
+    'SERVER_TIMING': True,
+    'CPROFILE_SAMPLE_RATE': 0,
+    'CPROFILE_SLOW_SECONDS': 1,
+    'CPROFILE_DIR': None,
+}
+
+# append-only ledger and balance snapshots, see app.ledger.DEFAULT_LEDGER for all keys
+WALLET_LEDGER = {
+    'ENABLED': False,
+    'SNAPSHOT_EVERY': 1000,
+    'SNAPSHOT_INTERVAL': 3600,
+    'SETTLE_LAG': 5,
+}
+
+# database connection pool of the app.backends engines, see app.dbpool.DEFAULT_DB_POOL for all keys
+WALLET_DB_POOL = {
+    'ENABLED': os.environ.get('WALLET_DB_POOL', '1') == '1',
+    'MAX_SIZE': 20,
+    'MAX_LIFETIME': 1800,
+    'WAIT_TIMEOUT': 5,
+    'PRE_PING': True,
+}
+
+# read replicas of the statement and account read paths, see app.routers.DEFAULT_REPLICAS for all keys
+WALLET_REPLICAS = {
+    'DATABASES': ['replica'] if 'replica' in DATABASES else [],
+    'STICKY_SECONDS': 5,
+    'MAX_LAG': 2,
+    'LAG_CHECK_INTERVAL': 1,
+    'SHARED_BACKEND': None,
+}
+
+# Idempotency-Key handling of the deposit and transfer apis, see app.idempotency.DEFAULT_IDEMPOTENCY for all keys
+WALLET_IDEMPOTENCY = {
+    'TTL': 24 * 60 * 60,
+    'WAIT': 15,
+    'LEASE': 60,
+    'CACHE_SIZE': 10000,
+    'PURGE_INTERVAL': 300,
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/2.0/topics/i18n/
 
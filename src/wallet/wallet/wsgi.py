@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "wallet.settings")
 
 application = get_wsgi_application()
+
+# warm the account search index of the serving process outside of its requests
+from app.search import AccountIndex  # noqa: E402
+
+AccountIndex.start_refresher()